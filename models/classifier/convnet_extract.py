@@ -14,6 +14,9 @@ from keras.utils import to_categorical
 
 from data import DataGenerator
 import utils
+import sys
+sys.path.append("../prednet")
+import session_config
 
 import argparse
 import cPickle as pkl
@@ -88,10 +91,13 @@ def save_bottleneck_features(config_name, data_dir, base_results_dir,
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Extract VGG features.')
     parser.add_argument('config', help='experiment config name defined in settings.py')
+    session_config.add_arguments(parser, ['extract'])
     FLAGS, unparsed = parser.parse_known_args()
     
     #config = configs[FLAGS.config]
     config_name, config = utils.get_config(vars(FLAGS))
+    session_config.update_config(config, vars(FLAGS))
+    session_config.setup_session('extract', config)
     print('\n==> Starting feature extraction: {}'.format(config['description']))
     config_str = utils.get_config_str(config)
     print('\n==> Using configuration:\n{}'.format(config_str))
@@ -4,11 +4,16 @@ from keras import backend as K
 
 import glob
 import os
+import collections
 import numpy as np
 import pickle as pkl
 import random as rn
+import threading
+from multiprocessing.pool import ThreadPool
 
 import utils
+from frame_cache import FrameCache, LRUFrameCache, cache_dir
+import sequence_index
 
 # Getting reproducible results:
 # https://keras.io/getting-started/faq/#how-can-i-obtain-reproducible-results-using-keras-during-development
@@ -27,7 +32,11 @@ class DataGenerator(Sequence):
                  sample_step=1, seq_overlap=0, target_size=None, 
                  classes=None, data_format=K.image_data_format(), 
                  output_mode=None, rescale=None, max_seq_per_source=None, 
-                 min_seq_length=1, pad_sequences=False, return_sources=False):
+                 min_seq_length=1, pad_sequences=False, return_sources=False, 
+                 bucket_by_length=False, consecutive_windows=False, shard=None, 
+                 seed=None, frame_cache_dir=None, frame_cache_config=None, 
+                 sequence_index_dir=None, decode_threads=None, batch_buffers=None, 
+                 frame_lru_bytes=None, padding_value=0.):
         
         'Initialization'
         self.batch_size = batch_size
@@ -50,6 +59,42 @@ class DataGenerator(Sequence):
         self.max_seq_per_source = max_seq_per_source
         self.source_count = {}
         self.pad_sequences = pad_sequences
+        # value of the padding frames, ex. a value the frames can't take to mask them
+        self.padding_value = padding_value
+        # batches of sequences of similar length, without the padding past the longest one
+        self.bucket_by_length = bucket_by_length
+        # consecutive windows of each video in fixed batch slots, see slot_schedule
+        self.consecutive_windows = consecutive_windows
+        self.slot_resets = None
+        # (shard_index, n_shards): only a disjoint part of the sequences of each epoch, 
+        # the same size for every shard (data-parallel training)
+        self.shard = shard
+        # with a seed, the permutation of each epoch only depends on the epoch (see set_epoch)
+        self.seed = seed
+        # preprocessed frames stored once on disk as uint8, see frame_cache.py. fn_preprocess 
+        # is described by frame_cache_config and must keep the pixel range (ex. resize)
+        self.frame_cache = None
+        if frame_cache_dir:
+            config = (frame_cache_config, self.target_size)
+            self.frame_cache = FrameCache(cache_dir(frame_cache_dir, config))
+        # sequences of flow_from_directory saved once as arrays, see sequence_index.py
+        self.sequence_index_dir = sequence_index_dir
+        # frames of a batch decoded concurrently by a pool of threads (PIL and NumPy 
+        # release the GIL), in each process of the Keras workers. None to decode serially
+        self.decode_threads = decode_threads
+        self.decode_pool = None
+        self.decode_pool_pid = None
+        # batches assembled in a ring of batch_buffers preallocated float buffers, in the 
+        # layout of data_format. A buffer is overwritten batch_buffers batches later, so the 
+        # ring must hold all the batches in use (ex. max_queue_size + workers + 2 with Keras)
+        self.batch_buffers = batch_buffers
+        self.buffer_ring = None
+        self.buffer_next = 0
+        self.buffer_lock = threading.Lock()
+        # decoded frames kept in memory up to frame_lru_bytes, for the frames of 
+        # overlapping sequences in the same and the next batches
+        self.frame_lru = LRUFrameCache(frame_lru_bytes) if frame_lru_bytes else None
+        self.epoch = -1
         
     def flow_from_directory(self, data_dir):
         self.data_dir = data_dir
@@ -58,6 +103,17 @@ class DataGenerator(Sequence):
             self.classes = sorted(os.walk(data_dir).next()[1])
         data_pattern = '{}/*'
         
+        index_file = None
+        if self.sequence_index_dir and self.seq_length:
+            index_file = sequence_index.index_file(self.sequence_index_dir, data_dir, 
+                                                   self.__sequence_config())
+            index = sequence_index.load(index_file, data_dir, self.classes)
+            if index is not None:
+                print('Loaded {} sequences from {}'.format(len(index), index_file))
+                self.X, self.y = index, index.y
+                self.__postprocess()
+                return self
+        
         total_samples = 0
         for i, c in enumerate(self.classes):
             class_samples = sorted(glob.glob(os.path.join(data_dir, data_pattern.format(c))))
@@ -67,7 +123,15 @@ class DataGenerator(Sequence):
         print(msg.format(total_samples, len(self.classes), self.data_dir))
 
         self.__postprocess()
+        if index_file and len(self.X) > 0:
+            sequence_index.save(index_file, data_dir, self.classes, self.X, self.y, self.sources)
         return self
+    
+    def __sequence_config(self):
+        # options of the sequences built by flow_from_directory
+        return (self.classes, self.seq_length, self.seq_overlap, self.sample_step, 
+                self.min_seq_length, self.index_start, self.max_per_class, 
+                self.max_seq_per_source, self.pad_sequences)
         
     def flow(self, X, y, sources=None):
         if self.classes is None:
@@ -119,6 +183,10 @@ class DataGenerator(Sequence):
         self.n_classes = len(self.classes)
         if len(self.X) == 0:
             print('No data found in {}!'.format(self.data_dir))
+        elif isinstance(self.X, sequence_index.SequenceIndex):
+            self.__describe_index()
+            self.data_shape = self.__load_data(0).shape
+            print('Data shape: {}'.format(self.data_shape))
         else:
             self.sources = []
             
@@ -165,10 +233,21 @@ class DataGenerator(Sequence):
             print('Data shape: {}'.format(self.data_shape))
         self.on_epoch_end()
     
+    def __describe_index(self):
+        # same summary as __postprocess, from the arrays of the index
+        msg = 'Found {} sequences belonging to {} classes'
+        print(msg.format(len(self.X), self.n_classes))
+        print('Sequence distribution:')
+        lengths = np.bincount(self.X.lengths())
+        for length in np.nonzero(lengths)[0]:
+            print('- {} sequences of length {}'.format(lengths[length], length))
+        print('Total samples used: {}'.format(len(self.X.frames)))
+        self.sources = self.X.sources
+        print('Total sources used: {}'.format(len(self.sources)))
         
     def __len__(self):
         'Denotes the number of batches per epoch'
-        return int(np.floor(len(self.X) / self.batch_size))
+        return int(np.floor(len(self.indexes) / self.batch_size))
 
     def __getitem__(self, index):
         'Generate one batch of data'
@@ -180,27 +259,145 @@ class DataGenerator(Sequence):
 
     def on_epoch_end(self):
         'Updates indexes after each epoch'
+        self.epoch += 1
+        if self.consecutive_windows and self.seq_length:
+            self.indexes, self.slot_resets = self.slot_schedule(self.epoch)
+            return
+        
+        random_state = self.__random_state()
         self.indexes = np.arange(len(self.X))
         if self.shuffle == True:
-            np.random.shuffle(self.indexes)
+            random_state.shuffle(self.indexes)
+        if self.shard:
+            shard_index, n_shards = self.shard
+            self.indexes = self.indexes[shard_index::n_shards][:len(self.indexes) // n_shards]
+        if self.bucket_by_length and self.seq_length:
+            self.__bucket_indexes(random_state)
+            
+    def set_epoch(self, epoch):
+        '''Sets the indexes of the given epoch, ex. to resume training. 
+        The permutations only depend on the epoch with a seed or shards.'''
+        self.epoch = epoch - 1
+        self.on_epoch_end()
+        
+    def __random_state(self):
+        if self.seed is not None:
+            return np.random.RandomState(self.seed + self.epoch)
+        if self.shard:
+            # all the shards split the same permutation
+            return np.random.RandomState(self.epoch)
+        return np.random
+            
+    def slot_schedule(self, epoch):
+        '''Returns (indexes, slot_resets) for the given epoch. Each sample of a batch 
+        (slot) gets the consecutive windows of one video, then moves to a new video. 
+        slot_resets[i] lists the slots of batch i that start a new video, whose 
+        states must be reset. Needs seq_overlap=0 so that windows are consecutive. 
+        With shards, the videos are scheduled in the slots of all the shards and each 
+        shard gets its own batch_size slots, so all the shards have the same batches.'''
+        videos = collections.OrderedDict()
+        for index, seq in enumerate(self.X):
+            # windows of a video are in order in self.X
+            source = '__'.join(seq[0].split('__')[:-1])
+            videos.setdefault(source, []).append(index)
+        videos = list(videos.values())
+        if self.shuffle == True:
+            # only depends on the epoch (and seed), the callbacks compute the same schedule
+            seed = epoch if self.seed is None else (self.seed, epoch)
+            order = np.random.RandomState(seed).permutation(len(videos))
+            videos = [videos[i] for i in order]
+        
+        n_shards = self.shard[1] if self.shard else 1
+        n_slots = self.batch_size * n_shards
+        slots = [[] for _ in range(n_slots)]
+        starts = [set() for _ in range(n_slots)]
+        for video in videos:
+            slot = min(range(n_slots), key=lambda k: len(slots[k]))
+            starts[slot].add(len(slots[slot]))
+            slots[slot].extend(video)
+        
+        n_batches = min(len(slot) for slot in slots)
+        if self.shard:
+            shard_slots = slice(self.shard[0] * self.batch_size, (self.shard[0] + 1) * self.batch_size)
+            slots, starts = slots[shard_slots], starts[shard_slots]
+        indexes = np.array([slots[k][i] for i in range(n_batches) 
+                            for k in range(self.batch_size)], dtype=int)
+        slot_resets = [[k for k in range(self.batch_size) if i in starts[k]] 
+                       for i in range(n_batches)]
+        return indexes, slot_resets
+    
+    def __seq_length(self, index):
+        return len([s for s in self.X[index] if s != 'padding'])
+    
+    def __bucket_indexes(self, random_state=np.random):
+        # sort the (shuffled) sequences by length and shuffle the order of the batches
+        lengths = np.array([self.__seq_length(i) for i in self.indexes])
+        indexes = self.indexes[np.argsort(-lengths, kind='mergesort')]
+        batches = [indexes[i*self.batch_size:(i+1)*self.batch_size] for i in range(len(self))]
+        if self.shuffle == True:
+            random_state.shuffle(batches)
+        if len(batches) > 0:
+            self.indexes = np.concatenate(batches)
+
+    def __getstate__(self):
+        # the thread pool is not copied to the processes of the Keras workers
+        state = self.__dict__.copy()
+        state['decode_pool'] = None
+        state['buffer_lock'] = None
+        return state
+    
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.buffer_lock = threading.Lock()
+
+    def __decode_pool(self):
+        # one pool per process, the threads of a pool do not survive a fork
+        if self.decode_pool is None or self.decode_pool_pid != os.getpid():
+            self.decode_pool = ThreadPool(self.decode_threads)
+            self.decode_pool_pid = os.getpid()
+        return self.decode_pool
+
+    def __batch_shape(self, data_shape):
+        # channels before the frame dimensions with channels_first
+        if self.data_format == 'channels_first' and len(data_shape) >= 3:
+            data_shape = data_shape[:-3] + data_shape[-1:] + data_shape[-3:-1]
+        return (self.batch_size,) + tuple(data_shape)
+    
+    def __batch_buffer(self, shape):
+        if not self.batch_buffers:
+            return np.empty(shape, dtype=K.floatx())
+        size = int(np.prod(shape))
+        with self.buffer_lock:
+            if self.buffer_ring is None:
+                self.buffer_ring = [None] * self.batch_buffers
+            buffer = self.buffer_ring[self.buffer_next]
+            if buffer is None or len(buffer) < size:
+                # sized for a full batch, bucketed batches use the beginning of it
+                full_size = int(np.prod(self.__batch_shape(self.data_shape)))
+                buffer = np.empty(max(size, full_size), dtype=K.floatx())
+                self.buffer_ring[self.buffer_next] = buffer
+            self.buffer_next = (self.buffer_next + 1) % self.batch_buffers
+        return buffer[:size].reshape(shape)
 
     def __data_generation(self, indexes):
         'Generates data containing batch_size samples' # X : (n_samples, *shape)
         # Initialization
-        X = np.empty((self.batch_size,) + self.data_shape)
+        data_shape = self.data_shape
+        n_timesteps = None
+        if self.bucket_by_length and self.seq_length:
+            # the padding past the longest sequence of the batch is not loaded
+            n_timesteps = max(self.__seq_length(index) for index in indexes)
+            data_shape = (n_timesteps,) + data_shape[1:]
+        X = self.__batch_buffer(self.__batch_shape(data_shape))
         y = np.empty((self.batch_size), dtype=int)
         sources = []
         
         # Generate data
+        self.__load_batch(X, indexes, n_timesteps)
         for i, index in enumerate(indexes):
-            X[i,] = self.__load_data(index)
-            
             # Store class
             y[i] = self.y[index]
-            sources.append(self.X[index])
-            
-        if self.data_format == 'channels_first':
-            X = np.transpose(X, (0, 1, 4, 2, 3))
+            sources.append(self.X[index][:n_timesteps])
          
         if self.output_mode is not None and self.output_mode == 'error':  
             data = (X, np.zeros(self.batch_size, np.float32))
@@ -222,30 +419,52 @@ class DataGenerator(Sequence):
         return img
     
     def __load_image(self, filename):
+        if self.frame_cache is not None:
+            # uint8 view of the memory map, rescaled after the preprocessing
+            img = self.frame_cache.get(filename)
+            if img is None:
+                img = self.frame_cache.add(filename, self.__load_cached_image(filename))
+            if self.rescale:
+                # straight from uint8 to float32, without a float64 frame
+                return np.multiply(img, self.rescale, dtype=K.floatx())
+            return img.astype(K.floatx())
         img = image.load_img(filename, target_size=self.target_size)
         img = image.img_to_array(img)
         #img = imread(filename)
         return self.__preprocess(img)
     
+    def __load_cached_image(self, filename):
+        # stored in the pixel range of the image, [0, 255]
+        img = image.img_to_array(image.load_img(filename, target_size=self.target_size))
+        img = self.__preprocess(img)
+        return img / self.rescale if self.rescale else img
+    
     def __load_pickle(self, filename):
         with open(filename, 'rb') as f:
             return pkl.load(f)
         
-    def __load_sample(self, filename):
+    def __decode_sample(self, filename):
+        # cast once to the batch dtype, before the frame LRU and the batch copy 
+        # (skimage resize returns float64)
         if filename.lower().endswith('.pkl'):
-            sample = self.__load_pickle(filename)
+            return np.asarray(self.__load_pickle(filename), dtype=K.floatx())
         elif filename.lower().endswith(('.png', '.jpg', '.jpeg')):
-            sample = self.__load_image(filename)
-        elif filename == 'padding':
-            sample = np.zeros(self.sample_shape)
+            return np.asarray(self.__load_image(filename), dtype=K.floatx())
+        raise ValueError('{} format is not supported'.format(filename))
+        
+    def __load_sample(self, filename):
+        if filename == 'padding':
+            sample = np.full(self.sample_shape, self.padding_value, dtype=K.floatx())
+        elif self.frame_lru is not None:
+            sample = self.frame_lru.get(filename, self.__decode_sample)
         else:
-            raise ValueError('{} format is not supported'.format(filename))
+            sample = self.__decode_sample(filename)
             
         self.sample_shape = sample.shape
         return sample
     
-    def __load_seq_data(self, index):
-        seq = self.X[index]
+    def __load_seq_data(self, index, n_timesteps=None):
+        seq = self.X[index][:n_timesteps]
         seq_data = []
         
         for sample in seq:
@@ -253,12 +472,39 @@ class DataGenerator(Sequence):
         
         return np.array(seq_data)
     
-    def __load_data(self, index):
+    def __load_batch(self, X, indexes, n_timesteps=None):
+        '''Loads the samples of indexes into the preallocated batch X, 
+        each frame written in place, in the layout of data_format, by the decode threads.'''
+        if self.seq_length:
+            frames = []
+            for i, index in enumerate(indexes):
+                seq = self.X[index][:n_timesteps]
+                frames.extend((X[i, t], sample) for t, sample in enumerate(seq))
+                # timesteps past the end of a short sequence, as padding
+                X[i, len(seq):] = self.padding_value
+        else:
+            frames = [(X[i], self.X[index]) for i, index in enumerate(indexes)]
+        
+        def load_frame(frame):
+            out, sample = frame
+            sample = self.__load_sample(sample)
+            if self.data_format == 'channels_first' and sample.ndim >= 3:
+                # (height, width, channels) frame into (channels, height, width)
+                sample = np.moveaxis(sample, -1, -3)
+            out[...] = sample
+        
+        if self.decode_threads and len(frames) > 1:
+            self.__decode_pool().map(load_frame, frames)
+        else:
+            for frame in frames:
+                load_frame(frame)
+    
+    def __load_data(self, index, n_timesteps=None):
         if len(self.X) <= index:
             return None
         
         if self.seq_length:
-            data = self.__load_seq_data(index)
+            data = self.__load_seq_data(index, n_timesteps)
         else:
             data = self.__load_sample(self.X[index])
             
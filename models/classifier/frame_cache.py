@@ -0,0 +1,190 @@
+'''
+Caches of preprocessed frames for DataGenerator.
+
+FrameCache: on-disk cache, shared by all the runs with the same preprocessing.
+Each image is decoded and preprocessed (ex. resized) once and stored as uint8
+in a memory-mapped array (frames.dat), one slot per frame. index.log maps the
+(path, mtime) of each source image to its slot, so a modified image is
+preprocessed again. A cache directory holds the frames of one preprocessing
+config (see cache_dir), as all the frames of a cache have the same shape.
+
+The cache is filled lazily, when a frame is first loaded by a batch. Both
+files are append-only: a frame is written at the end of frames.dat, then its
+index line at the end of index.log, under an exclusive lock of the directory
+(fcntl), so processes and threads may fill the same cache concurrently. An
+interrupted write leaves at most a frame without index line, which is
+overwritten by the next one.
+
+LRUFrameCache: in-memory cache of the decoded frames of one DataGenerator,
+ex. for the frames shared by overlapping sequences (seq_overlap > 0).
+'''
+import os
+import fcntl
+import hashlib
+import threading
+import collections
+import numpy as np
+
+
+def cache_dir(base_dir, config):
+    '''Directory of the frames preprocessed with config (ex. target size,
+    preprocessing function name) under base_dir.'''
+    key = hashlib.sha1(repr(config).encode('utf8')).hexdigest()[:16]
+    return os.path.join(base_dir, key)
+
+
+class FrameCache(object):
+    '''Frames are read with get(filename), a uint8 view of the memory map, 
+    and added with add(filename, frame).'''
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.frames_file = os.path.join(cache_dir, 'frames.dat')
+        self.index_file = os.path.join(cache_dir, 'index.log')
+        self.lock_file = os.path.join(cache_dir, 'lock')
+        # (path, mtime) -> slot, read from index.log up to index_offset
+        self.index = {}
+        self.index_offset = 0
+        self.frame_shape = None
+        self.frames = None
+        self.lock = threading.Lock()
+        if os.path.exists(self.index_file):
+            self.__read_index()
+
+    def __getstate__(self):
+        # the memory map and the lock are opened again in the processes of the Keras workers
+        state = self.__dict__.copy()
+        state['frames'] = None
+        state['lock'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def __key(self, filename):
+        return (os.path.abspath(filename), os.path.getmtime(filename))
+
+    def __read_index(self):
+        # new complete lines of index.log: a header with the frame shape, then 'slot mtime path'
+        with open(self.index_file, 'rb') as f:
+            f.seek(self.index_offset)
+            data = f.read()
+        data = data[:data.rfind(b'\n') + 1]
+        self.index_offset += len(data)
+        for line in data.decode('utf8').splitlines():
+            fields = line.split(' ', 2)
+            if fields[0] == 'shape':
+                self.frame_shape = tuple(int(d) for d in fields[1].split('x'))
+            else:
+                self.index[(fields[2], float(fields[1]))] = int(fields[0])
+
+    def __map(self, slot):
+        # maps all the frames written so far, the file grows as frames are added
+        if self.frames is None or slot >= len(self.frames):
+            n_frames = os.path.getsize(self.frames_file) // int(np.prod(self.frame_shape))
+            self.frames = np.memmap(self.frames_file, dtype=np.uint8, mode='r',
+                                    shape=(n_frames,) + self.frame_shape)
+        return self.frames
+
+    def get(self, filename):
+        '''Returns the cached frame of filename, or None if it is not in the cache.'''
+        slot = self.index.get(self.__key(filename), None)
+        if slot is None:
+            return None
+        with self.lock:
+            frames = self.__map(slot)
+        return frames[slot]
+
+    def add(self, filename, frame):
+        '''Adds the frame of filename, of pixel values in [0, 255] rounded to uint8, 
+        and returns it as uint8.'''
+        frame = np.clip(np.round(frame), 0, 255).astype(np.uint8)
+        key = self.__key(filename)
+        with self.lock:
+            if not os.path.exists(self.cache_dir):
+                try:
+                    os.makedirs(self.cache_dir)
+                except OSError:  # created by another process
+                    pass
+            with open(self.lock_file, 'a') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                try:
+                    self.__append(key, frame)
+                finally:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+        return frame
+
+    def __append(self, key, frame):
+        # under the lock of the directory: the frames added by other processes are read first
+        if os.path.exists(self.index_file):
+            self.__read_index()
+        if key in self.index:
+            return
+        with open(self.index_file, 'ab') as index:
+            if self.frame_shape is None:
+                self.frame_shape = frame.shape
+                index.write('shape {}\n'.format('x'.join(str(d) for d in frame.shape)).encode('utf8'))
+            if frame.shape != self.frame_shape:
+                raise ValueError('Frame shape {} of {} differs from the cached frames {}'.format(
+                    frame.shape, key[0], self.frame_shape))
+            with open(self.frames_file, 'ab') as frames:
+                # a partial frame of an interrupted write is overwritten
+                frames.seek(0, os.SEEK_END)
+                slot = frames.tell() // frame.nbytes
+                frames.truncate(slot * frame.nbytes)
+                frames.write(frame.tobytes())
+            index.write('{} {!r} {}\n'.format(slot, key[1], key[0]).encode('utf8'))
+        self.index_offset = os.path.getsize(self.index_file)
+        self.index[key] = slot
+
+
+class LRUFrameCache(object):
+    '''Decoded frames by filename, the least recently used ones evicted past 
+    max_bytes. Safe to use from the decode threads; the cached frames are 
+    read-only. hits and misses count the lookups.'''
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.frames = collections.OrderedDict()
+        self.n_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['lock'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def get(self, filename, load_fn):
+        '''Returns the frame of filename, loaded with load_fn if it is not cached.'''
+        with self.lock:
+            frame = self.frames.pop(filename, None)
+            if frame is not None:
+                # most recently used last
+                self.frames[filename] = frame
+                self.hits += 1
+                return frame
+            self.misses += 1
+
+        frame = load_fn(filename)
+        if frame.nbytes > self.max_bytes:
+            return frame
+        frame.setflags(write=False)
+        with self.lock:
+            if filename not in self.frames:
+                self.frames[filename] = frame
+                self.n_bytes += frame.nbytes
+                while self.n_bytes > self.max_bytes:
+                    _, evicted = self.frames.popitem(last=False)
+                    self.n_bytes -= evicted.nbytes
+        return frame
+
+    def stats(self):
+        lookups = max(self.hits + self.misses, 1)
+        return '{} hits, {} misses ({:.1%} hit rate), {} frames in {:.1f} MB'.format(
+            self.hits, self.misses, float(self.hits) / lookups, len(self.frames),
+            self.n_bytes / 2.**20)
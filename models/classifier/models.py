@@ -126,7 +126,8 @@ def multistream2(input_shape, n_classes, hidden_dims,
     config['input_height'] = input_shape[2]
     config['input_channels'] = input_shape[3]
     
-    model = prednet_model.create_model(train=False, 
+    # the PredNet layers are frozen, so it can't be a cached model
+    model = prednet_model.create_model(train=False, cache=False,
                                        output_mode='representation', 
                                        **config)
     prednet_layer = model.layers[1]
@@ -184,7 +185,8 @@ def multistream(input_shape, n_classes, hidden_dims,
     config['input_height'] = input_shape[2]
     config['input_channels'] = input_shape[3]
         
-    model = prednet_model.create_model(train=False, 
+    # the PredNet layers are frozen, so it can't be a cached model
+    model = prednet_model.create_model(train=False, cache=False,
                                        output_mode='representation', 
                                        **config)
     prednet_layer = model.layers[1]
@@ -224,7 +226,8 @@ def prednet(input_shape, n_classes, hidden_dims,
     config['input_width'] = input_shape[2]
     config['input_channels'] = input_shape[3]
         
-    model = prednet_model.create_model(train=False, 
+    # PredNet is fine-tuned with the classifier, so it can't be a cached model
+    model = prednet_model.create_model(train=False, cache=False,
                                        output_mode='representation', 
                                        **config)
     x = crop(1, -1)(model.outputs[0])   
@@ -0,0 +1,95 @@
+'''
+Precomputed sequence index of DataGenerator.flow_from_directory.
+
+Building the sequences of a large dataset (glob of every class directory,
+source of every frame, sequence length distribution) takes minutes. The index
+stores the result as compact NumPy arrays in one .npz file per data directory
+and sequence config (see index_file):
+    frames:     path of each frame used, relative to the data directory (bytes)
+    seq_frames: (n_sequences, seq_length) frame of each timestep, PADDING for
+                the padding frames and ABSENT past the end of short sequences
+    y:          class of each sequence
+    sources:    sources (videos) of the sequences
+    dir_mtimes: mtimes of the class directories, an index is rebuilt when
+                a file is added to or removed from a class directory
+'''
+import os
+import hashlib
+import numpy as np
+
+PADDING = -1
+ABSENT = -2
+
+
+def index_file(index_dir, data_dir, config):
+    key = hashlib.sha1(repr((os.path.abspath(data_dir), config)).encode('utf8')).hexdigest()[:16]
+    return os.path.join(index_dir, 'sequences_{}.npz'.format(key))
+
+def dir_mtimes(data_dir, classes):
+    return np.array([os.path.getmtime(os.path.join(data_dir, c)) for c in classes])
+
+
+class SequenceIndex(object):
+    '''List-like view of the sequences of an index: index[i] is the list of
+    frame paths of sequence i ('padding' for padding frames), as in DataGenerator.X.'''
+    def __init__(self, data_dir, frames, seq_frames, y, sources):
+        self.data_dir = data_dir
+        self.frames = frames
+        self.seq_frames = seq_frames
+        self.y = y
+        self.sources = sources
+
+    def __len__(self):
+        return len(self.seq_frames)
+
+    def __getitem__(self, index):
+        return [self.frame_path(k) if k != PADDING else 'padding'
+                for k in self.seq_frames[index] if k != ABSENT]
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def frame_path(self, k):
+        return os.path.join(self.data_dir, self.frames[k].decode('utf8'))
+
+    def lengths(self):
+        # padding frames included, as len(DataGenerator.X[i])
+        return np.sum(self.seq_frames != ABSENT, axis=1)
+
+
+def save(filename, data_dir, classes, X, y, sources):
+    '''Saves the sequences X (lists of frame paths) of flow_from_directory.'''
+    frame_ids = {}
+    seq_length = max(len(seq) for seq in X)
+    seq_frames = np.full((len(X), seq_length), ABSENT, dtype=np.int32)
+    for i, seq in enumerate(X):
+        for t, sample in enumerate(seq):
+            if sample == 'padding':
+                seq_frames[i, t] = PADDING
+            else:
+                seq_frames[i, t] = frame_ids.setdefault(sample, len(frame_ids))
+    frames = [None] * len(frame_ids)
+    for sample, k in frame_ids.items():
+        frames[k] = os.path.relpath(sample, data_dir).encode('utf8')
+
+    index_dir = os.path.dirname(filename)
+    if index_dir and not os.path.exists(index_dir):
+        os.makedirs(index_dir)
+    # through a temporary file, so that an interruption never leaves a partial index
+    tmp_filename = filename + '.tmp.npz'
+    np.savez(tmp_filename, frames=np.array(frames), seq_frames=seq_frames,
+             y=np.array(y, dtype=np.int32), sources=np.array(sources),
+             dir_mtimes=dir_mtimes(data_dir, classes))
+    os.rename(tmp_filename, filename)
+
+def load(filename, data_dir, classes):
+    '''Returns the SequenceIndex of filename, or None if there is no index
+    or if the class directories changed since it was built.'''
+    if not os.path.exists(filename):
+        return None
+    data = np.load(filename)
+    if not np.array_equal(data['dir_mtimes'], dir_mtimes(data_dir, classes)):
+        return None
+    return SequenceIndex(data_dir, data['frames'], data['seq_frames'],
+                         data['y'], [str(s) for s in data['sources']])
@@ -11,10 +11,11 @@ from data import DataGenerator
 from settings import configs, tasks
 import models
 import utils
+# models adds ../prednet to the path
+import session_config
 
 from tqdm import tqdm
 import numpy as np
-import tensorflow as tf
 import random as rn
 import pickle as pkl
 
@@ -23,14 +24,10 @@ import pickle as pkl
 os.environ['PYTHONHASHSEED'] = '0'
 np.random.seed(42)
 rn.seed(12345)
-# Force TensorFlow to use single thread.
-# Multiple threads are a potential source of
-# non-reproducible results.
+# The TensorFlow session (seed and threads) of each phase is set up in __main__, 
+# see prednet/session_config.py. Training uses a single thread by default, as
+# multiple threads are a potential source of non-reproducible results.
 # For further details, see: https://stackoverflow.com/questions/42022950/which-seeds-have-to-be-set-where-to-realize-100-reproducibility-of-training-res
-session_conf = tf.ConfigProto(intra_op_parallelism_threads=1, inter_op_parallelism_threads=1)
-tf.set_random_seed(1234)
-sess = tf.Session(graph=tf.get_default_graph(), config=session_conf)
-K.set_session(sess)
 
 def save_experiment_config(config_name, base_results_dir, config):
     results_dir = utils.get_create_results_dir(config_name, base_results_dir)
@@ -265,10 +262,12 @@ if __name__ == '__main__':
     parser.add_argument('--eval', help='perform only evaluation using pretrained model',
                         action='store_true')
     parser.add_argument('--gpus', type=int, nargs='+', help='list of gpus to use')
+    session_config.add_arguments(parser, ['train', 'eval'])
     
     FLAGS, unparsed = parser.parse_known_args()
     
     config_name, config = utils.get_config(vars(FLAGS))
+    session_config.update_config(config, vars(FLAGS))
     
     if FLAGS.gpus:
         os.environ["CUDA_VISIBLE_DEVICES"] = ','.join([str(g) for g in FLAGS.gpus])
@@ -278,10 +277,12 @@ if __name__ == '__main__':
     print('\n==> Using configuration:\n{}'.format(config_str))
     
     if not FLAGS.eval:
+        session_config.setup_session('train', config)
         train(config_name, **config)
         save_experiment_config(config_name, config['base_results_dir'], config)
     
     if config.get('test_data_dir', None) or config.get('ensemble', None):
+        session_config.setup_session('eval', config)
         evaluate(config_name, **config)
 
     
@@ -0,0 +1,71 @@
+'''
+Peak memory and time of a PredNet training step versus n_timesteps, with and
+without gradient checkpointing through time (PredNet checkpoint_timesteps).
+
+Each configuration runs in its own process, as the peak resident memory
+(ru_maxrss) of a process can only grow.
+'''
+import sys
+import time
+import argparse
+import resource
+import subprocess
+import numpy as np
+
+
+def peak_memory_mb():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024. ** 2 if sys.platform == 'darwin' else peak / 1024.
+
+def run_step(n_timesteps, checkpoint_timesteps, batch_size, input_shape, n_steps):
+    import prednet_model
+
+    model = prednet_model.create_model(train=True, n_timesteps=n_timesteps,
+                                       batch_size=batch_size,
+                                       input_height=input_shape[0],
+                                       input_width=input_shape[1],
+                                       input_channels=input_shape[2],
+                                       checkpoint_timesteps=checkpoint_timesteps)
+    model.compile(loss='mean_absolute_error', optimizer='adam')
+    X = np.random.rand(batch_size, n_timesteps, *input_shape).astype(np.float32)
+    y = np.zeros((batch_size, 1), np.float32)
+
+    model.train_on_batch(X, y)  # graph and session setup
+    start = time.time()
+    for _ in range(n_steps):
+        model.train_on_batch(X, y)
+    return (time.time() - start) / n_steps
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark gradient checkpointing through time.')
+    parser.add_argument('--n_timesteps', type=int, nargs='+', default=[10, 30, 60, 90])
+    parser.add_argument('--checkpoint_timesteps', type=int, nargs='+', default=[0, 5, 10],
+                        help='timesteps per segment, 0 for no checkpointing')
+    parser.add_argument('--batch_size', type=int, default=4)
+    parser.add_argument('--input_shape', type=int, nargs=3, default=[128, 160, 3])
+    parser.add_argument('--steps', type=int, default=3)
+    parser.add_argument('--single', action='store_true', help=argparse.SUPPRESS)
+    FLAGS = parser.parse_args()
+
+    if FLAGS.single:
+        step_time = run_step(FLAGS.n_timesteps[0], FLAGS.checkpoint_timesteps[0] or None,
+                             FLAGS.batch_size, tuple(FLAGS.input_shape), FLAGS.steps)
+        print('{} {}'.format(peak_memory_mb(), step_time))
+        sys.exit(0)
+
+    print('{:>12}{:>22}{:>18}{:>16}'.format('n_timesteps', 'checkpoint_timesteps',
+                                            'peak memory (MB)', 's per step'))
+    for n_timesteps in FLAGS.n_timesteps:
+        for checkpoint_timesteps in FLAGS.checkpoint_timesteps:
+            cmd = [sys.executable, __file__, '--single',
+                   '--n_timesteps', str(n_timesteps),
+                   '--checkpoint_timesteps', str(checkpoint_timesteps),
+                   '--batch_size', str(FLAGS.batch_size),
+                   '--steps', str(FLAGS.steps),
+                   '--input_shape'] + [str(d) for d in FLAGS.input_shape]
+            output = subprocess.check_output(cmd).decode('utf8').strip().split('\n')[-1]
+            peak, step_time = [float(v) for v in output.split()]
+            print('{:>12}{:>22}{:>18.0f}{:>16.3f}'.format(n_timesteps, checkpoint_timesteps or '-',
+                                                          peak, step_time))
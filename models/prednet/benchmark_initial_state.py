@@ -0,0 +1,88 @@
+'''
+Benchmark of the PredNet initial state construction.
+
+Compares PredNet.get_initial_state with the previous construction, which
+reduced a zeros_like copy of the input to (samples, channels) and multiplied
+it by a zero (channels, state_size) matrix for every state. Reports the number
+of ops added to the graph, the number of elements of the zero matrices and the
+time to evaluate the initial states for one batch.
+'''
+import time
+import argparse
+import numpy as np
+
+from keras import backend as K
+from keras.layers import Input
+
+from prednet import PredNet
+
+
+def legacy_initial_state(prednet, x, state_shapes):
+    input_shape = prednet.input_spec[0].shape
+    base_initial_state = K.zeros_like(x)  # (samples, timesteps) + image_shape
+    non_channel_axis = -1 if prednet.data_format == 'channels_first' else -2
+    for _ in range(2):
+        base_initial_state = K.sum(base_initial_state, axis=non_channel_axis)
+    base_initial_state = K.sum(base_initial_state, axis=1)  # (samples, nb_channels)
+
+    initial_states = []
+    reducer_size = 0
+    for shape in state_shapes:
+        output_size = int(np.prod(shape))
+        reducer = K.zeros((input_shape[prednet.channel_axis], output_size))
+        reducer_size += input_shape[prednet.channel_axis] * output_size
+        initial_state = K.dot(base_initial_state, reducer)
+        initial_states.append(K.reshape(initial_state, (-1,) + shape))
+    return initial_states, reducer_size
+
+def initial_state_shapes(prednet):
+    return [tuple(K.int_shape(s)[1:]) for s in prednet.get_initial_state(prednet.input)]
+
+
+def n_ops():
+    import tensorflow as tf
+    return len(tf.get_default_graph().get_operations())
+
+def time_states(states, x, X, n_runs):
+    f = K.function([x], states)
+    f([X])  # warm up
+    start = time.time()
+    for _ in range(n_runs):
+        f([X])
+    return (time.time() - start) / n_runs
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark PredNet initial state construction.')
+    parser.add_argument('--batch_size', type=int, default=16)
+    parser.add_argument('--n_timesteps', type=int, default=10)
+    parser.add_argument('--input_shape', type=int, nargs=3, default=[128, 160, 3])
+    parser.add_argument('--runs', type=int, default=100)
+    FLAGS = parser.parse_args()
+
+    stack_sizes = (FLAGS.input_shape[-1], 48, 96, 192)
+    prednet = PredNet(stack_sizes=stack_sizes, R_stack_sizes=stack_sizes,
+                      A_filt_sizes=(3, 3, 3), Ahat_filt_sizes=(3, 3, 3, 3),
+                      R_filt_sizes=(3, 3, 3, 3), output_mode='error',
+                      return_sequences=True)
+    x = Input(shape=(FLAGS.n_timesteps,) + tuple(FLAGS.input_shape))
+    prednet(x)
+    X = np.random.rand(FLAGS.batch_size, FLAGS.n_timesteps,
+                       *FLAGS.input_shape).astype(K.floatx())
+    state_shapes = initial_state_shapes(prednet)
+
+    start_ops = n_ops()
+    states = prednet.get_initial_state(x)
+    direct_ops = n_ops() - start_ops
+    direct_time = time_states(states, x, X, FLAGS.runs)
+
+    start_ops = n_ops()
+    states, reducer_size = legacy_initial_state(prednet, x, state_shapes)
+    legacy_ops = n_ops() - start_ops
+    legacy_time = time_states(states, x, X, FLAGS.runs)
+
+    state_size = sum(int(np.prod(s)) for s in state_shapes) * FLAGS.batch_size
+    print('==> {} states, {} elements per batch'.format(len(state_shapes), state_size))
+    print('{:<10}{:>10}{:>20}{:>16}'.format('', 'graph ops', 'reducer elements', 'ms per batch'))
+    print('{:<10}{:>10}{:>20}{:>16.3f}'.format('legacy', legacy_ops, reducer_size, 1000 * legacy_time))
+    print('{:<10}{:>10}{:>20}{:>16.3f}'.format('direct', direct_ops, 0, 1000 * direct_time))
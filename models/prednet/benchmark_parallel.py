@@ -0,0 +1,90 @@
+'''
+Throughput of the data-parallel trainer (train_parallel.py) versus the number
+of worker processes, on random batches so that data loading is not measured.
+
+The sequences per second of each number of workers are compared with those of
+a single worker. The speedup is only near-linear while the workers have a core
+each (threads_per_worker * workers <= cores) and the all-reduce of the
+gradients is small compared to a training step, which is also reported.
+'''
+import time
+import argparse
+import multiprocessing
+import numpy as np
+
+from train_parallel import SharedMemoryAllReduce
+
+
+def run_worker(worker, n_workers, all_reduce, results, threads_per_worker,
+               batch_size, n_timesteps, input_shape, n_steps):
+    import session_config
+    import prednet_model
+    from train_parallel import ReplicaTrainer
+
+    session_config.setup_session('train', {'train_threads': (threads_per_worker, 1)})
+    model = prednet_model.create_model(train=True, n_timesteps=n_timesteps,
+                                       batch_size=batch_size,
+                                       input_height=input_shape[0],
+                                       input_width=input_shape[1],
+                                       input_channels=input_shape[2])
+    trainer = ReplicaTrainer(model)
+    X = np.random.rand(batch_size, n_timesteps, *input_shape).astype(np.float32)
+    y = np.zeros(batch_size, np.float32)
+
+    def step():
+        loss, gradients = trainer.compute_gradients(X, y)
+        start = time.time()
+        averaged = all_reduce.average(worker, np.append(gradients, loss))
+        all_reduce_time = time.time() - start
+        trainer.update(averaged[:-1])
+        return all_reduce_time
+
+    step()  # graph and session setup
+    all_reduce.barrier.wait()
+    start = time.time()
+    all_reduce_time = sum(step() for _ in range(n_steps))
+    elapsed = time.time() - start
+    if worker == 0:
+        results.put((n_workers * batch_size * n_steps / elapsed, all_reduce_time / elapsed))
+
+def run(n_workers, threads_per_worker, batch_size, n_timesteps, input_shape, n_steps):
+    all_reduce = SharedMemoryAllReduce(n_workers)
+    results = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=run_worker,
+                                         args=(k, n_workers, all_reduce, results,
+                                               threads_per_worker, batch_size,
+                                               n_timesteps, input_shape, n_steps))
+                 for k in range(n_workers)]
+    for p in processes:
+        p.start()
+    while results.empty():
+        if any(p.exitcode not in (None, 0) for p in processes):
+            for p in processes:
+                p.terminate()
+            raise RuntimeError('A benchmark worker failed')
+        time.sleep(1)
+    result = results.get()
+    for p in processes:
+        p.join()
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the data-parallel trainer versus the number of workers.')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--threads_per_worker', type=int, default=1)
+    parser.add_argument('--batch_size', type=int, default=4, help='batch size of each worker')
+    parser.add_argument('--n_timesteps', type=int, default=10)
+    parser.add_argument('--input_shape', type=int, nargs=3, default=[128, 160, 3])
+    parser.add_argument('--steps', type=int, default=5)
+    FLAGS = parser.parse_args()
+
+    print('{} cores'.format(multiprocessing.cpu_count()))
+    print('{:>8}{:>18}{:>10}{:>16}'.format('workers', 'sequences/s', 'speedup', 'all-reduce'))
+    base = None
+    for n_workers in FLAGS.workers:
+        throughput, all_reduce_ratio = run(n_workers, FLAGS.threads_per_worker, FLAGS.batch_size,
+                                           FLAGS.n_timesteps, tuple(FLAGS.input_shape), FLAGS.steps)
+        base = base or throughput
+        print('{:>8}{:>18.2f}{:>10.2f}{:>15.1%}'.format(n_workers, throughput, throughput / base,
+                                                        all_reduce_ratio))
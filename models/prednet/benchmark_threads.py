@@ -0,0 +1,75 @@
+'''
+Throughput of PredNet training and feature extraction versus the number of
+TensorFlow threads (session_config.py).
+
+Each configuration runs in its own process, as TensorFlow sizes its thread
+pools when the first session of a process is created.
+'''
+import sys
+import time
+import argparse
+import subprocess
+import numpy as np
+
+
+def run_phase(phase, intra_op_threads, inter_op_threads, batch_size, n_timesteps,
+              input_shape, n_steps):
+    import session_config
+    import prednet_model
+
+    session_config.setup_session(phase, {phase + '_threads': (intra_op_threads, inter_op_threads)})
+    train = phase == 'train'
+    model = prednet_model.create_model(train=train, n_timesteps=n_timesteps,
+                                       batch_size=batch_size,
+                                       input_height=input_shape[0],
+                                       input_width=input_shape[1],
+                                       input_channels=input_shape[2],
+                                       output_mode='error' if train else 'representation')
+    X = np.random.rand(batch_size, n_timesteps, *input_shape).astype(np.float32)
+    if train:
+        model.compile(loss='mean_absolute_error', optimizer='adam')
+        y = np.zeros((batch_size, 1), np.float32)
+        run = lambda: model.train_on_batch(X, y)
+    else:
+        run = lambda: model.predict(X, batch_size=batch_size)
+
+    run()  # graph and session setup
+    start = time.time()
+    for _ in range(n_steps):
+        run()
+    return n_steps * batch_size / (time.time() - start)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark PredNet throughput versus TensorFlow threads.')
+    parser.add_argument('--phases', nargs='+', default=['train', 'extract'], choices=['train', 'eval', 'extract'])
+    parser.add_argument('--intra_op_threads', type=int, nargs='+', default=[1, 2, 4, 8, 0],
+                        help='0 for all the cores')
+    parser.add_argument('--inter_op_threads', type=int, nargs='+', default=[1, 2])
+    parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument('--n_timesteps', type=int, default=10)
+    parser.add_argument('--input_shape', type=int, nargs=3, default=[128, 160, 3])
+    parser.add_argument('--steps', type=int, default=5)
+    parser.add_argument('--single', action='store_true', help=argparse.SUPPRESS)
+    FLAGS = parser.parse_args()
+
+    if FLAGS.single:
+        throughput = run_phase(FLAGS.phases[0], FLAGS.intra_op_threads[0], FLAGS.inter_op_threads[0],
+                               FLAGS.batch_size, FLAGS.n_timesteps, tuple(FLAGS.input_shape), FLAGS.steps)
+        print(throughput)
+        sys.exit(0)
+
+    print('{:>10}{:>12}{:>12}{:>18}'.format('phase', 'intra_op', 'inter_op', 'sequences/s'))
+    for phase in FLAGS.phases:
+        for intra_op_threads in FLAGS.intra_op_threads:
+            for inter_op_threads in FLAGS.inter_op_threads:
+                cmd = [sys.executable, __file__, '--single', '--phases', phase,
+                       '--intra_op_threads', str(intra_op_threads),
+                       '--inter_op_threads', str(inter_op_threads),
+                       '--batch_size', str(FLAGS.batch_size),
+                       '--n_timesteps', str(FLAGS.n_timesteps),
+                       '--steps', str(FLAGS.steps),
+                       '--input_shape'] + [str(d) for d in FLAGS.input_shape]
+                output = subprocess.check_output(cmd).decode('utf8').strip().split('\n')[-1]
+                print('{:>10}{:>12}{:>12}{:>18.2f}'.format(phase, intra_op_threads or 'all',
+                                                           inter_op_threads or 'all', float(output)))
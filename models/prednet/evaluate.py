@@ -16,6 +16,7 @@ from keras import backend as K
 from prednet import PredNet
 import utils
 import prednet_model
+import session_config
 import sys
 sys.path.append("../classifier")
 from data import DataGenerator
@@ -24,10 +25,13 @@ from tqdm import tqdm
 import argparse
 import csv
 import cPickle as pkl
-from skimage.measure import block_reduce
 
 FLAGS = None
 
+# value of the padding frames of padded sequences, masked in PredNet. Frames are in 
+# [0, 1] (or [0, 255] without rescale), so it can't be the value of a real black frame
+PADDING_VALUE = -1.
+
 
 def save_predictions(X, X_hat, mse_model, mse_prev, results_dir, 
                      n_plot=20, **config):
@@ -53,6 +57,7 @@ def save_predictions(X, X_hat, mse_model, mse_prev, results_dir,
     
     for i in plot_idx:
         for t in range(n_timesteps):
+            if np.all(X[i,t] == PADDING_VALUE): continue  # padding frame, not plotted
             plt.subplot(gs[t])
             plt.imshow(X[i,t], interpolation='none')
             plt.tick_params(axis='both', which='both', 
@@ -90,46 +95,86 @@ def save_representation(rep, sources, results_dir, config):
         with open(filename, 'w') as f:
             pkl.dump(rep[i].reshape(rep.shape[2:]), f)
         
+def pad_timesteps(X, n_timesteps=None):
+    '''Returns a copy of the sequences of X padded to n_timesteps with padding frames.'''
+    if n_timesteps is None or X.shape[1] >= n_timesteps:
+        return np.copy(X)
+    padding = np.full((X.shape[0], n_timesteps - X.shape[1]) + X.shape[2:], PADDING_VALUE, X.dtype)
+    return np.concatenate([X, padding], axis=1)
+    
+def update_prediction_scores(scores, X_, pred, n_timesteps=None, in_memory_ratio=20):
+    if scores['n'] % in_memory_ratio == 0:
+        # copied, the batches are reused by the generator. Bucketed batches only have 
+        # the timesteps of their longest sequence, all are padded to n_timesteps
+        scores['X'].extend(pad_timesteps(X_, n_timesteps))
+        scores['preds'].extend(pad_timesteps(pred, n_timesteps))
+        
+    # padding frames are scored as black frames
+    X_ = np.where(X_ == PADDING_VALUE, 0., X_)
+    scores['mse_model'] += np.mean((X_[:, 1:] - pred[:, 1:]) ** 2)  # look at all timesteps except the first
+    scores['mse_prev'] += np.mean((X_[:, :-1] - X_[:, 1:]) ** 2)
+    scores['n'] += 1
+    
+def save_prediction_scores(scores, batch_size, results_dir, 
+                           data_format=K.image_data_format(), **config):
+    X = np.array(scores['X'])
+    preds = np.array(scores['preds'])
+
+    mse_model = scores['mse_model'] / (scores['n'] * batch_size)
+    mse_prev = scores['mse_prev'] / (scores['n'] * batch_size)
+            
+    if data_format == 'channels_first':
+        X = np.transpose(X, (0, 1, 3, 4, 2))
+        preds = np.transpose(preds, (0, 1, 3, 4, 2))
+        
+    save_predictions(X, preds, mse_model, mse_prev, results_dir, **config)
+    
+def save_representation_batch(rep, sources_, results_dir, config,
+                              timestep_start=-1, timestep_end=None, 
+                              data_format=K.image_data_format()):
+    rep = rep[:, timestep_start:timestep_end]
+    sources_ = sources_[:, timestep_start:timestep_end].flatten()
+    source_batch = []
+    
+    for s in sources_:
+        path, source = os.path.split(s)
+        path, category = os.path.split(path)
+        path, data_split = os.path.split(path)
+        source = source.replace('.jpg', '')
+        source_batch.append((category, source))
+    
+    if data_format == 'channels_first' and rep.ndim == 5:
+        rep = np.transpose(rep, (0, 1, 3, 4, 2))
+        
+    save_representation(rep, source_batch, results_dir, config)
+    return source_batch
+
+def save_sources(sources, results_dir):
+    # Save labels in csv file
+    f = os.path.join(results_dir, 'sources.csv')
+    with open(f, 'wb') as out:
+        csv_out=csv.writer(out)
+        csv_out.writerow(['category','source'])
+        for row in sources:
+            csv_out.writerow(row)
+        
 def evaluate_prediction(model, dataset, experiment_name, 
                         data_generator, n_batches, base_results_dir,
                         data_format=K.image_data_format(), **config):
     
-    n = 0
-    in_memory_ratio = 20
-    X = []
-    preds = []
-    mse_model = 0
-    mse_prev = 0
-    
+    scores = {'n': 0, 'X': [], 'preds': [], 'mse_model': 0, 'mse_prev': 0}
     data_iterator = iter(data_generator)
     
     for i in tqdm(range(n_batches)):
         X_, y_, _ = next(data_iterator)
         pred = model.predict(X_, data_generator.batch_size)
-
-        mse_model += np.mean((X_[:, 1:] - pred[:, 1:]) ** 2)  # look at all timesteps except the first
-        mse_prev += np.mean((X_[:, :-1] - X_[:, 1:]) ** 2)
-        
-        if n % in_memory_ratio == 0:
-            X.extend(X_)
-            preds.extend(pred)
-            
-        n += 1
-
-    X = np.array(X)
-    preds = np.array(preds)
-
-    mse_model /= (n * data_generator.batch_size)
-    mse_prev /= (n * data_generator.batch_size)  
-            
-    if data_format == 'channels_first':
-        X = np.transpose(X, (0, 1, 3, 4, 2))
-        preds = np.transpose(preds, (0, 1, 3, 4, 2))
+        update_prediction_scores(scores, X_, pred, data_generator.seq_length)
         
     results_dir = utils.get_create_results_dir(experiment_name, 
                                                base_results_dir, 
                                                dataset=dataset)
-    save_predictions(X, preds, mse_model, mse_prev, results_dir, **config)
+    save_prediction_scores(scores, data_generator.batch_size, results_dir, 
+                           data_format=data_format, **config)
     
     
     
@@ -146,71 +191,85 @@ def evaluate_representation(model, dataset, experiment_name, output_mode,
     for i in tqdm(range(n_batches)):
         X_, y_, sources_ = next(data_iterator)
         rep = model.predict(X_, data_generator.batch_size)
+        sources += save_representation_batch(rep, sources_, results_dir, config,
+                                             timestep_start=timestep_start, 
+                                             timestep_end=timestep_end,
+                                             data_format=data_format)
+    save_sources(sources, results_dir)
+    
+    
+def evaluate_multiple(model, dataset, experiment_name, output_modes, 
+                      data_generator, n_batches, base_results_dir,
+                      timestep_start=-1, timestep_end=None,
+                      data_format=K.image_data_format(), **config):
+    '''
+    Evaluates several PredNet outputs (ex. ['prediction', 'E0', 'R3']) 
+    with a single pass over the dataset. Prediction scores and plots are saved
+    as in evaluate_prediction and every other output is saved as a
+    representation in a subfolder named after its output mode.
+    '''
+    dataset_dir = utils.get_create_results_dir(experiment_name, 
+                                               base_results_dir, 
+                                               dataset=dataset)
+    results_dirs = {}
+    for mode in output_modes:
+        if mode != 'prediction':
+            results_dirs[mode] = utils.get_create_results_dir(experiment_name, 
+                                                              base_results_dir, 
+                                                              dataset=os.path.join(dataset, mode))
+    
+    scores = {'n': 0, 'X': [], 'preds': [], 'mse_model': 0, 'mse_prev': 0}
+    sources = []
+    data_iterator = iter(data_generator)
+    for i in tqdm(range(n_batches)):
+        X_, y_, sources_ = next(data_iterator)
+        outputs = model.predict(X_, data_generator.batch_size)
         
-        rep = rep[:, timestep_start:timestep_end]
-        sources_ = sources_[:, timestep_start:timestep_end].flatten()
-        source_batch = []
-        
-        for s in sources_:
-            path, source = os.path.split(s)
-            path, category = os.path.split(path)
-            path, data_split = os.path.split(path)
-            source = source.replace('.jpg', '')
-            category_source = (category, source)
-            source_batch.append(category_source)
-            sources.append(category_source)
-        
-        if output_mode == 'representation':
-            rep_layers = model.layers[1].unflatten_features(X_.shape, rep)
-            rep = []
-            
-            width_index = 3
-            channel_index = -1
-            block_size = [1, 1, 1, 1, 1]
-            if data_format == 'channels_first':
-                width_index = -1
-                channel_index = 2
-            
-            for i, rep_layer in enumerate(rep_layers): 
-                # Do avg spatial pooling to make all representation layers have 
-                # the same dimension as the higher-level representation layer.
-                ratio = rep_layer.shape[width_index] / rep_layers[-1].shape[width_index]
-                if ratio > 1:
-                    block_size[width_index-1] = ratio
-                    block_size[width_index] = ratio
-                    rep_layer = block_reduce(rep_layer, block_size=tuple(block_size), 
-                                             func=np.mean)
-                rep.append(rep_layer)
-            rep = np.concatenate(rep, axis=channel_index)
-            
-        if data_format == 'channels_first':
-            rep = np.transpose(rep, (0, 1, 3, 4, 2))
-            
-        save_representation(rep, source_batch, results_dir, config)
+        for mode, output in zip(output_modes, outputs):
+            if mode == 'prediction':
+                update_prediction_scores(scores, X_, output, data_generator.seq_length)
+            else:
+                source_batch = save_representation_batch(output, sources_, results_dirs[mode], 
+                                                         config, timestep_start=timestep_start, 
+                                                         timestep_end=timestep_end,
+                                                         data_format=data_format)
+        if results_dirs:
+            sources += source_batch
+    
+    if 'prediction' in output_modes:
+        save_prediction_scores(scores, data_generator.batch_size, dataset_dir, 
+                               data_format=data_format, **config)
+    for results_dir in results_dirs.values():
+        save_sources(sources, results_dir)
     
-    # Save labels in csv file
-    f = os.path.join(results_dir, 'sources.csv')
-    with open(f, 'wb') as out:
-        csv_out=csv.writer(out)
-        csv_out.writerow(['category','source'])
-        for row in sources:
-            csv_out.writerow(row)
-
             
 def evaluate(config_name, dataset, data_dir, output_mode, 
              classes=None, n_timesteps=10, frame_step=3, 
              seq_overlap=0, input_width=160, input_height=128, 
              shuffle=False, batch_size=5, max_per_class=None,
              index_start=0, stateful=False, rescale=None, 
-             min_seq_length=0, pad_sequences=False, **config):
+             min_seq_length=0, pad_sequences=False, bucket_by_length=False, 
+             frame_cache_dir=None, sequence_index_dir=None, decode_threads=None, 
+             frame_lru_bytes=None, **config):
     
-    config['n_timesteps'] = n_timesteps
+    # with bucketing, the number of timesteps is the longest sequence of each batch
+    config['n_timesteps'] = None if bucket_by_length else n_timesteps
+    output_modes = output_mode if isinstance(output_mode, (list, tuple)) else [output_mode]
+    # representation layers are pooled to the top layer resolution 
+    # inside the model instead of flattened and pooled in NumPy
+    model_output_mode = ['pooled_representation' if m == 'representation' else m 
+                         for m in output_modes]
+    if len(model_output_mode) == 1:
+        model_output_mode = model_output_mode[0]
+        
     model = prednet_model.create_model(train=False, 
                                        stateful=stateful, 
                                        batch_size=batch_size, 
                                        input_width=input_width, 
                                        input_height=input_height,
-                                       output_mode=output_mode, **config)
+                                       output_mode=model_output_mode, 
+                                       mask_value=PADDING_VALUE if pad_sequences else None,
+                                       **config)
     model.summary()
     
     layer_config = model.layers[1].get_config()
@@ -219,12 +278,17 @@ def evaluate(config_name, dataset, data_dir, output_mode,
     print('Creating generator...')
     resize = lambda img: utils.resize_img(img, target_size=(input_height, 
                                                             input_width))
+    if config.get('dynamic_size', False):
+        resize = None  # frames are fed at their original size
+        frame_cache_dir = None  # cached frames must have the same size
     
     data_generator = DataGenerator(classes=classes,
                                    seq_length=n_timesteps,
                                    seq_overlap=seq_overlap,
                                    min_seq_length=min_seq_length,
                                    pad_sequences=pad_sequences,
+                                   padding_value=PADDING_VALUE,
+                                   bucket_by_length=bucket_by_length,
                                    sample_step=frame_step,
                                    target_size=None,
                                    rescale=rescale,
@@ -234,7 +298,13 @@ def evaluate(config_name, dataset, data_dir, output_mode,
                                    return_sources=True,
                                    max_per_class=max_per_class,
                                    index_start=index_start,
-                                   data_format=data_format)
+                                   data_format=data_format, 
+                                   frame_cache_dir=frame_cache_dir, 
+                                   frame_cache_config='resize_{}x{}'.format(input_height, input_width), 
+                                   sequence_index_dir=sequence_index_dir, 
+                                   decode_threads=decode_threads, 
+                                   batch_buffers=2, 
+                                   frame_lru_bytes=frame_lru_bytes)
     
     data_generator = data_generator.flow_from_directory(data_dir)
     
@@ -244,15 +314,23 @@ def evaluate(config_name, dataset, data_dir, output_mode,
     n_batches = len(data_generator)
     print('Number of batches: {}'.format(n_batches))
     
-    if output_mode == 'prediction':
+    if len(output_modes) > 1:
+        evaluate_multiple(model, dataset, config_name, output_modes, 
+                          data_generator, n_batches,
+                          data_format=data_format, **config)
+        
+    elif output_mode == 'prediction':
         evaluate_prediction(model, dataset, config_name, 
                             data_generator, n_batches, 
                             data_format=data_format, **config)
         
-    elif output_mode == 'representation' or output_mode[:1] == 'R':
+    elif output_mode in ['representation', 'pooled_representation'] or output_mode[:1] == 'R':
         evaluate_representation(model, dataset, config_name, output_mode, 
                                 data_generator, n_batches,
                                 data_format=data_format, **config)
+    
+    if data_generator.frame_lru is not None:
+        print('Decoded frame cache: {}'.format(data_generator.frame_lru.stats()))
         
         
     
@@ -262,13 +340,19 @@ if __name__ == '__main__':
     parser.add_argument('--stateful', help='use stateful PredNet model', action='store_true')
     parser.add_argument('--task', help='choose dataset to evaluate', choices=['3c', '10c', 'full'])
     parser.add_argument('--pretrained', help='choose pre-trained model dataset', choices=['3c', '10c', 'full'])
+    session_config.add_arguments(parser, ['eval', 'extract'])
     FLAGS, unparsed = parser.parse_known_args()
     config_name, config = utils.get_config(vars(FLAGS))
+    session_config.update_config(config, vars(FLAGS))
     
     print('\n==> Starting experiment: {}\n'.format(config['description']))
     config_str = utils.get_config_str(config)
     print('==> Using configuration:\n{}'.format(config_str))
     
+    # prediction and error outputs are evaluated, the other outputs are extracted features
+    phase = 'eval' if config['output_mode'] in ['prediction', 'error'] else 'extract'
+    session_config.setup_session(phase, config)
+    
     for split in ['training', 'validation', 'test']:
         img_dir = config.get(split + '_data_dir', None)
         index_start = config.get(split + '_index_start', 0)
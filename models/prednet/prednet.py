@@ -6,6 +6,7 @@ from keras.layers import Recurrent
 from keras.layers import Conv2D, UpSampling2D, MaxPooling2D
 from keras.engine import InputSpec
 from keras_utils import legacy_prednet_support
+from prednet_weights import LSTM_GATES, pack_gate_weights
 
 class PredNet(Recurrent):
     '''PredNet architecture - Lotter 2016.
@@ -44,14 +45,58 @@ class PredNet(Recurrent):
             If 'all', the output will be the frame prediction concatenated with the mean layer errors.
                 The frame prediction is flattened before concatenation.
                 Nomenclature of 'all' is kept for backwards compatibility, but should not be confused with returning all of the layers of the model
+            If 'representation', the R units of all layers are flattened and concatenated.
+            If 'pooled_representation', the R units of each layer are average-pooled to the spatial
+                resolution of the top layer and concatenated along the channel axis.
+                The output shape will be (top_nb_row, top_nb_col, sum(R_stack_sizes)) for 'channels_last'.
             For returning the features of a particular layer, output_mode should be of the form unit_type + layer_number.
                 For instance, to return the features of the LSTM "representational" units in the lowest layer, output_mode should be specificied as 'R0'.
                 The possible unit types are 'R', 'Ahat', 'A', and 'E' corresponding to the 'representation', 'prediction', 'target', and 'error' units respectively.
+            A list of output modes (ex. ['prediction', 'E0', 'R3']) returns one output per mode, in the same order,
+                computed in a single forward pass.
         extrap_start_time: time step for which model will start extrapolating.
             Starting at this time step, the prediction from the previous time step will be treated as the "actual"
         data_format: 'channels_first' or 'channels_last'.
             It defaults to the `image_data_format` value found in your
             Keras config file at `~/.keras/keras.json`.
+            The height and width of the input can be None, in which case the same graph runs 
+            on frames of any size. Frames whose height or width is not a multiple of 2**(nb_layers - 1) 
+            are zero-padded at the bottom and right, and the outputs are cropped back to the 
+            part of each layer computed from the frame (ceil(size / 2**layer_num)).
+        fused_gates: if True, the i, f, c and o gates of each LSTM are computed by a single convolution
+            with 4 * R_stack_sizes[l] output channels, which is then split into the gates.
+            Weights saved by an unfused model (e.g. the KITTI checkpoints) are packed automatically
+            when passed to `set_weights` (or through the `weights` argument).
+        truncate_inference: if True, the last timestep only computes the parts of the feedforward (A, Ahat, E)
+            path that the requested output_mode depends on. The states of that timestep are not used anymore,
+            so the outputs are unchanged. Not applied for stateful models, masked inputs or extrapolation,
+            where the states of the last timestep are still needed. Useful to extract R features, for which
+            the feedforward path of the last timestep is not computed at all.
+        compute_dtype: dtype of the states and activations, ex. 'float16'.
+            Weights are kept in floatx (float32) as master copies and cast for each convolution, 
+            and outputs are cast back to floatx. Defaults to floatx. Only use a dtype for which 
+            the backend has convolution kernels on the target device. 'bfloat16' needs 
+            TensorFlow 2: TensorFlow 1 has no bfloat16 Conv2D CPU kernel and its upsampling 
+            does not accept bfloat16.
+        checkpoint_timesteps: if set, gradient checkpointing through time (TensorFlow backend only). 
+            Timesteps are run in segments of checkpoint_timesteps and only the states between 
+            segments are kept for the backward pass; the activations of each segment are recomputed 
+            from its initial states when its gradients are computed. Smaller segments use less memory
+            (about n_timesteps / checkpoint_timesteps states plus the activations of one segment)
+            for the cost of one more forward pass. Not applied to masked inputs or extrapolation.
+        error_layers: indices of the layers whose mean error is output by the 'error' and 'all' modes,
+            in that order. Defaults to all the layers. The errors of the other layers are still computed,
+            as the representation units depend on them, but they are not reduced to an output.
+
+    # Masking
+        The layer accepts a (samples, timesteps) mask, or a mask that also has the 
+        spatial axes of the frames (ex. from `Masking(mask_value=-1.)` on padded sequences). 
+        Samples keep their states over the masked timesteps and their output is zero there. 
+        If return_sequences is False, the output of the last unmasked timestep is returned.
+        With TensorFlow, a timestep masked for all the samples of the batch (ex. the padding 
+        past the longest sequence) is skipped; otherwise it is computed and its result dropped. 
+        The mask value must be a value that the frames can't take, as black frames 
+        would be masked too with `mask_value=0.`.
 
     # References
         - [Deep predictive coding networks for video prediction and unsupervised learning](https://arxiv.org/abs/1605.08104)
@@ -65,7 +110,9 @@ class PredNet(Recurrent):
                  pixel_max=1., error_activation='relu', A_activation='relu',
                  LSTM_activation='tanh', LSTM_inner_activation='hard_sigmoid',
                  output_mode='error', extrap_start_time=None,
-                 data_format=K.image_data_format(), **kwargs):
+                 data_format=K.image_data_format(), fused_gates=False, 
+                 truncate_inference=False, compute_dtype=None, 
+                 checkpoint_timesteps=None, error_layers=None, **kwargs):
         self.stack_sizes = stack_sizes
         self.nb_layers = len(stack_sizes)
         assert len(R_stack_sizes) == self.nb_layers, 'len(R_stack_sizes) must equal len(stack_sizes)'
@@ -84,13 +131,15 @@ class PredNet(Recurrent):
         self.LSTM_inner_activation = activations.get(LSTM_inner_activation)
 
         #default_output_modes = ['prediction', 'error', 'all']
-        default_output_modes = ['prediction', 'error', 'all', 'representation']
+        default_output_modes = ['prediction', 'error', 'all', 'representation', 'pooled_representation']
         layer_output_modes = [layer + str(n) for n in range(self.nb_layers) for layer in ['R', 'E', 'A', 'Ahat']]
-        assert output_mode in default_output_modes + layer_output_modes, 'Invalid output_mode: ' + str(output_mode)
+        self.output_modes = list(output_mode) if isinstance(output_mode, (list, tuple)) else [output_mode]
+        assert len(self.output_modes) > 0, 'Invalid output_mode: ' + str(output_mode)
+        for mode in self.output_modes:
+            assert mode in default_output_modes + layer_output_modes, 'Invalid output_mode: ' + str(mode)
         self.output_mode = output_mode
-        if self.output_mode in layer_output_modes:
-            self.output_layer_type = self.output_mode[:-1]
-            self.output_layer_num = int(self.output_mode[-1])
+        if len(self.output_modes) == 1 and self.output_modes[0] in layer_output_modes:
+            self.output_layer_type, self.output_layer_num = self.__parse_layer_mode(self.output_modes[0])
         else:
             self.output_layer_type = None
             self.output_layer_num = None
@@ -101,9 +150,37 @@ class PredNet(Recurrent):
         self.channel_axis = -3 if data_format == 'channels_first' else -1
         self.row_axis = -2 if data_format == 'channels_first' else -3
         self.column_axis = -1 if data_format == 'channels_first' else -2
+        self.fused_gates = fused_gates
+        self.truncate_inference = truncate_inference
+        self.compute_dtype = compute_dtype or K.floatx()
+        self.checkpoint_timesteps = checkpoint_timesteps
+        self.error_layers = list(range(self.nb_layers)) if error_layers is None else list(error_layers)
+        assert len(self.error_layers) > 0 and all(0 <= l < self.nb_layers for l in self.error_layers), 'Invalid error_layers: ' + str(error_layers)
+        self.__weight_values = None  # weights passed to a checkpointed segment
+        assert self.compute_dtype in {'float16', 'bfloat16', 'float32', 'float64'}, 'Invalid compute_dtype: ' + str(compute_dtype)
+        if self.compute_dtype == 'bfloat16':
+            self.__check_bfloat16()
         super(PredNet, self).__init__(**kwargs)
         self.input_spec = [InputSpec(ndim=5)]
+        self.__input_size = None  # (rows, cols) of the frames before padding, set in call()
+        self.__cropped = False
+        self.__samples_reset = None  # (states, function) of reset_samples
         
+    def __check_bfloat16(self):
+        if K.backend() == 'tensorflow':
+            import tensorflow as tf
+            if int(tf.__version__.split('.')[0]) >= 2:
+                return
+        raise ValueError("compute_dtype='bfloat16' needs the TensorFlow 2 backend (TensorFlow 1 "
+                         "has no bfloat16 Conv2D CPU kernel nor bfloat16 upsampling), use 'float16'")
+        
+    def __parse_layer_mode(self, mode):
+        # ex. 'Ahat2' => ('Ahat', 2)
+        for layer_type in ['Ahat', 'A', 'R', 'E']:
+            if mode.startswith(layer_type) and mode[len(layer_type):].isdigit():
+                return layer_type, int(mode[len(layer_type):])
+        return None, None
+
     def __compute_layer_shape(self, input_shape, layer_type=None, layer_num=None):
         
         if layer_type is None: layer_type = self.output_layer_type
@@ -113,14 +190,34 @@ class PredNet(Recurrent):
         stack_mult = 2 if layer_type == 'E' else 1
         
         out_stack_size = stack_mult * getattr(self, stack_str)[layer_num]
-        out_nb_row = input_shape[self.row_axis] / 2**layer_num
-        out_nb_col = input_shape[self.column_axis] / 2**layer_num
+        out_nb_row = self.__layer_size(input_shape[self.row_axis], layer_num)
+        out_nb_col = self.__layer_size(input_shape[self.column_axis], layer_num)
         if self.data_format == 'channels_first':
             out_shape = (out_stack_size, out_nb_row, out_nb_col)
         else:
             out_shape = (out_nb_row, out_nb_col, out_stack_size)
         return out_shape
     
+    def __layer_size(self, size, layer_num):
+        # size (int, tensor or None) of a layer_num feature map for an input of size `size`
+        if size is None:
+            return None
+        ds_factor = 2 ** layer_num
+        return (size + ds_factor - 1) // ds_factor
+
+    def __padded_size(self, size):
+        # input size padded to a multiple of 2**(nb_layers - 1)
+        multiple = 2 ** (self.nb_layers - 1)
+        return self.__layer_size(size, self.nb_layers - 1) * multiple
+
+    def __flat_size(self, shape):
+        size = 1
+        for d in shape:
+            if d is None:
+                return None
+            size = size * d
+        return size
+
     def unflatten_features(self, input_shape, feature_batch):
         r = []
         r_index = 0
@@ -133,41 +230,334 @@ class PredNet(Recurrent):
             r_index += flat_shape
         return r
 
-    def compute_output_shape(self, input_shape):
-        if self.output_mode == 'prediction':
+    def __compute_mode_shape(self, input_shape, mode):
+        if mode == 'prediction':
             out_shape = input_shape[2:]
-        elif self.output_mode == 'error':
-            out_shape = (self.nb_layers,)
-        elif self.output_mode == 'all':
-            out_shape = (np.prod(input_shape[2:]) + self.nb_layers,)
-        elif self.output_mode == 'representation':
+        elif mode == 'error':
+            out_shape = (len(self.error_layers),)
+        elif mode == 'all':
+            flat_shape = self.__flat_size(input_shape[2:])
+            out_shape = (flat_shape + len(self.error_layers) if flat_shape is not None else None,)
+        elif mode == 'representation':
             out_shape = 0
             for l in range(self.nb_layers):
                 layer_shape = self.__compute_layer_shape(input_shape, 'R', l)
-                flat_shape = np.prod(layer_shape)
+                flat_shape = self.__flat_size(layer_shape)
                 print('Layer {} shape: {} ({})'.format(l, layer_shape, flat_shape))
-                out_shape += flat_shape
+                if out_shape is not None:
+                    out_shape = out_shape + flat_shape if flat_shape is not None else None
             out_shape = (out_shape,)
+        elif mode == 'pooled_representation':
+            top_shape = self.__compute_layer_shape(input_shape, 'R', self.nb_layers - 1)
+            out_shape = list(top_shape)
+            out_shape[self.channel_axis] = sum(self.R_stack_sizes)
+            out_shape = tuple(out_shape)
         else:
-            out_shape = self.__compute_layer_shape(input_shape)
+            out_shape = self.__compute_layer_shape(input_shape, *self.__parse_layer_mode(mode))
+        return out_shape
 
+    def compute_output_shape(self, input_shape):
+        output_shapes = []
+        for mode in self.output_modes:
+            out_shape = self.__compute_mode_shape(input_shape, mode)
+            if self.return_sequences:
+                output_shapes.append((input_shape[0], input_shape[1]) + out_shape)
+            else:
+                output_shapes.append((input_shape[0],) + out_shape)
+
+        if len(output_shapes) == 1:
+            return output_shapes[0]
+        return output_shapes
+
+    def compute_mask(self, inputs, mask):
+        output_mask = super(PredNet, self).compute_mask(inputs, self.__sequence_mask(mask))
+        if len(self.output_modes) == 1:
+            return output_mask
+        return [output_mask] * len(self.output_modes)
+
+    def call(self, inputs, mask=None, training=None, initial_state=None):
+        inputs = self.__pad_inputs(inputs)
+        mask = self.__sequence_mask(mask)
+        if mask is not None:
+            outputs = self.__masked_call(inputs, mask, initial_state)
+        elif self.__can_checkpoint(inputs, initial_state):
+            outputs = self.__checkpointed_call(inputs)
+        elif self.__can_truncate(inputs, mask, initial_state):
+            outputs = self.__truncated_call(inputs)
+        else:
+            outputs = super(PredNet, self).call(inputs, mask=mask, training=training, 
+                                                initial_state=initial_state)
+        if len(self.output_modes) == 1:
+            return outputs
+        return self.__split_outputs(outputs)
+
+    def __spatial_size(self, x):
+        # (rows, cols) of x, as ints when they are known when building the graph
+        shape = K.int_shape(x)
+        size = [shape[self.row_axis], shape[self.column_axis]]
+        for i, axis in enumerate([self.row_axis, self.column_axis]):
+            if size[i] is None:
+                size[i] = K.shape(x)[axis]
+        return tuple(size)
+
+    def __pad_axis(self, x, pad, axis):
+        # append `pad` (int or tensor) rows of zeros to x along axis
+        index = [slice(None)] * K.ndim(x)
+        index[axis] = slice(0, 1)
+        reps = [1] * K.ndim(x)
+        reps[axis] = pad
+        zeros = K.tile(K.zeros_like(x[tuple(index)]), reps)
+        return K.concatenate([x, zeros], axis=axis)
+
+    def __pad_inputs(self, inputs):
+        # zero-pad the frames at the bottom and right to a multiple of 2**(nb_layers - 1), 
+        # outputs are cropped back in __crop
+        if isinstance(inputs, list):
+            return [self.__pad_inputs(inputs[0])] + inputs[1:]
+        self.__input_size = self.__spatial_size(inputs)
+        self.__cropped = False
+        for size, axis in zip(self.__input_size, [self.row_axis, self.column_axis]):
+            pad = self.__padded_size(size) - size
+            if isinstance(pad, int) and pad == 0:
+                continue
+            inputs = self.__pad_axis(inputs, pad, axis)
+            self.__cropped = True
+        return inputs
+
+    def __crop(self, x, layer_num):
+        # crop a layer_num feature map to the part computed from the frames before padding
+        if not self.__cropped:
+            return x
+        rows, cols = [self.__layer_size(size, layer_num) for size in self.__input_size]
+        if self.data_format == 'channels_first':
+            return x[:, :, :rows, :cols]
+        return x[:, :rows, :cols]
+
+    def __sequence_mask(self, mask):
+        # (samples, timesteps) mask from the mask of the frames, which can also have
+        # spatial axes (ex. Masking(mask_value=-1.) masks each pixel of the padding frames)
+        if isinstance(mask, list):
+            mask = mask[0]
+        if mask is None:
+            return None
+        while K.ndim(mask) > 2:
+            mask = K.any(mask, axis=-1)
+        return mask
+
+    def __masked_call(self, inputs, mask, initial_state=None):
+        # Keras' rnn only masks 2D states, so the mask is applied in __masked_step: 
+        # the states of the masked samples are kept and their output is zero
+        if isinstance(inputs, list):
+            initial_state = inputs[1:]
+            inputs = inputs[0]
+        if initial_state is not None:
+            initial_states = list(initial_state)
+        elif self.stateful:
+            initial_states = list(self.states)
+        else:
+            initial_states = self.get_initial_state(inputs)
+        mask = K.cast(mask, K.floatx())
+        if self.go_backwards:
+            # in the order of the timesteps run by K.rnn
+            mask = K.reverse(mask, 1)
+        timestep = K.constant(0, dtype='int32')
+        last_output, outputs, states = K.rnn(self.__masked_step, inputs, 
+                                             initial_states + [timestep],
+                                             go_backwards=self.go_backwards,
+                                             constants=[K.transpose(mask)],
+                                             unroll=self.unroll,
+                                             input_length=K.int_shape(inputs)[1])
+        states = states[:-1]
+        if self.stateful:
+            self.add_update([(self.states[i], states[i]) for i in range(len(states))], inputs)
         if self.return_sequences:
-            return (input_shape[0], input_shape[1]) + out_shape
+            return outputs
+        return self.__last_unmasked(outputs, mask)
+
+    def __masked_step(self, a, states):
+        # states are the PredNet states + [timestep, mask (timesteps, samples)]
+        states_tm1 = states[:-2]
+        timestep, mask = states[-2:]
+        mask_t = K.gather(mask, timestep)  # (samples,)
+
+        def masked_step():
+            output, states = self.step(a, states_tm1)
+            output = self.__apply_mask(mask_t, output, K.zeros_like(output))
+            states = [self.__apply_mask(mask_t, state, state_tm1) if K.ndim(state) > 0 else state
+                      for state, state_tm1 in zip(states, states_tm1)]
+            return [output] + states
+
+        if K.backend() == 'tensorflow':
+            import tensorflow as tf
+            # no convolution when the timestep is masked for the whole batch
+            outputs = tf.cond(K.any(K.greater(mask_t, 0)), masked_step, 
+                              lambda: self.__skipped_step(a, states_tm1))
         else:
-            return (input_shape[0],) + out_shape
-        
-    def get_initial_state(self, x):
-        input_shape = self.input_spec[0].shape
-        init_nb_row = input_shape[self.row_axis]
-        init_nb_col = input_shape[self.column_axis]
+            outputs = masked_step()
+        return outputs[0], list(outputs[1:]) + [timestep + 1]
+
+    def __skipped_step(self, a, states_tm1):
+        # zero output of a timestep masked for all the samples, from zero units 
+        # shaped as those of the step. The states are kept, the timestep counted
+        r_tm1 = states_tm1[:self.nb_layers]
+        e_tm1 = states_tm1[2*self.nb_layers:3*self.nb_layers]
+        a_layers = [K.zeros_like(K.cast(a, self.compute_dtype))]
+        for l in range(1, self.nb_layers):
+            a_layers.append(K.zeros_like(self.__slice_channels(e_tm1[l], 0, self.stack_sizes[l])))
+        units = {'A': a_layers, 'Ahat': a_layers, 'R': [K.zeros_like(r) for r in r_tm1], 
+                 'E': [K.zeros_like(e) for e in e_tm1]}
+        output = self.__step_output(a_layers[0], units)
+        states = [state if K.ndim(state) > 0 else state + 1 for state in states_tm1]
+        return [output] + states
+
+    def __apply_mask(self, mask_t, x, x_tm1):
+        # x where mask_t is 1, x_tm1 where it is 0
+        mask_t = K.cast(mask_t, K.dtype(x))
+        for _ in range(K.ndim(x) - 1):
+            mask_t = K.expand_dims(mask_t)
+        return mask_t * x + (1 - mask_t) * x_tm1
+
+    def __last_unmasked(self, outputs, mask):
+        # output of the last unmasked timestep of each sample
+        n_after = K.cumsum(mask[:, ::-1], axis=1)[:, ::-1] - mask  # unmasked timesteps after t
+        last = mask * K.cast(K.equal(n_after, 0), K.floatx())
+        for _ in range(K.ndim(outputs) - 2):
+            last = K.expand_dims(last)
+        return K.sum(outputs * last, axis=1)
+
+    def __can_checkpoint(self, inputs, initial_state):
+        if not self.checkpoint_timesteps or K.backend() != 'tensorflow':
+            return False
+        if self.extrap_start_time is not None or self.go_backwards:
+            return False
+        if isinstance(inputs, list) or initial_state is not None:
+            return False
+        n_timesteps = K.int_shape(inputs)[1]
+        return n_timesteps is not None and n_timesteps > self.checkpoint_timesteps
+
+    def __conv_variables(self):
+        variables = []
+        for c in sorted(self.conv_layers.keys()):
+            for conv in self.conv_layers[c]:
+                variables += [conv.kernel, conv.bias]
+        return variables
+
+    def __checkpointed_call(self, inputs):
+        n_timesteps = K.int_shape(inputs)[1]
+        states = list(self.states) if self.stateful else self.get_initial_state(inputs)
+        weights = [K.identity(w) for w in self.__conv_variables()]
+        outputs = []
+        for start in range(0, n_timesteps, self.checkpoint_timesteps):
+            segment = inputs[:, start:start + self.checkpoint_timesteps]
+            segment_outputs, states = self.__checkpointed_segment(segment, states, weights)
+            outputs.append(segment_outputs)
 
-        base_initial_state = K.zeros_like(x)  # (samples, timesteps) + image_shape
-        non_channel_axis = -1 if self.data_format == 'channels_first' else -2
-        for _ in range(2):
-            base_initial_state = K.sum(base_initial_state, axis=non_channel_axis)
-        base_initial_state = K.sum(base_initial_state, axis=1)  # (samples, nb_channels)
+        if self.stateful:
+            self.add_update([(self.states[i], states[i]) for i in range(len(states))], inputs)
+        outputs = K.concatenate(outputs, axis=1)
+        if not self.return_sequences:
+            return outputs[:, -1]
+        return outputs
+
+    def __segment_forward(self, segment, states, weights):
+        # run the timesteps of a segment with the weights given as tensors
+        names = [w.name for w in self.__conv_variables()]
+        self.__weight_values = dict(zip(names, weights))
+        try:
+            _, outputs, states = K.rnn(self.step, segment, list(states), 
+                                       unroll=self.unroll, 
+                                       input_length=K.int_shape(segment)[1])
+        finally:
+            self.__weight_values = None
+        return [outputs] + list(states)
+
+    def __checkpointed_segment(self, segment, states, weights):
+        import tensorflow as tf
+        n_states = len(states)
+
+        @tf.custom_gradient
+        def checkpointed(*args):
+            # only the inputs of the segment are kept for the backward pass
+            results = self.__segment_forward(args[0], args[1:1 + n_states], args[1 + n_states:])
+
+            def grad(*grad_ys):
+                # recompute the segment once the gradients of its outputs are available
+                with tf.control_dependencies(grad_ys):
+                    inputs = [tf.identity(x) for x in args]
+                recomputed = self.__segment_forward(inputs[0], inputs[1:1 + n_states], inputs[1 + n_states:])
+                grad_ys = [g if g is not None else tf.zeros_like(y) for g, y in zip(grad_ys, recomputed)]
+                grads = tf.gradients(recomputed, inputs, grad_ys=grad_ys)
+                return [g if g is not None else tf.zeros_like(x) for g, x in zip(grads, inputs)]
+            return results, grad
+
+        results = checkpointed(segment, *(list(states) + list(weights)))
+        return results[0], list(results[1:])
+
+    def __can_truncate(self, inputs, mask, initial_state):
+        if not self.truncate_inference or self.stateful or self.go_backwards:
+            return False
+        if self.extrap_start_time is not None:
+            return False
+        if isinstance(inputs, list) or initial_state is not None or mask is not None:
+            return False
+        return K.int_shape(inputs)[1] is not None
+
+    def __truncated_layers(self):
+        # number of layers of the feedforward path needed by the outputs 
+        # when the states of the step are not used anymore
+        nb_ff_layers = 0
+        for mode in self.output_modes:
+            layer_type, layer_num = self.__parse_layer_mode(mode)
+            if layer_type in ['A', 'Ahat', 'E']:
+                nb_ff_layers = max(nb_ff_layers, layer_num + 1)
+            elif mode == 'prediction':
+                nb_ff_layers = max(nb_ff_layers, 1)
+            elif mode in ['error', 'all']:
+                nb_ff_layers = max(nb_ff_layers, max(self.error_layers) + 1)
+        return nb_ff_layers
+
+    def __truncated_call(self, inputs):
+        # Run all timesteps but the last one as usual (their states are 
+        # carried), then run the last one with the truncated feedforward path.
+        n_timesteps = K.int_shape(inputs)[1]
+        states = self.get_initial_state(inputs)
+        if n_timesteps > 1:
+            _, outputs, states = K.rnn(self.step, inputs[:, :-1], states,
+                                       unroll=self.unroll,
+                                       input_length=n_timesteps - 1)
+            
+        output, _ = self.__step(inputs[:, -1], states, self.__truncated_layers())
+        if not self.return_sequences:
+            return output
+        output = K.expand_dims(output, axis=1)
+        if n_timesteps > 1:
+            output = K.concatenate([outputs, output], axis=1)
+        return output
+
+    def __split_outputs(self, outputs):
+        # step() concatenates the flattened outputs of each mode; unflatten them here
+        input_shape = list(self.input_spec[0].shape)
+        input_shape[self.row_axis], input_shape[self.column_axis] = self.__input_size
+        if self.return_sequences:
+            n_timesteps = input_shape[1] if input_shape[1] is not None else K.shape(outputs)[1]
+            batch_shape = (-1, n_timesteps)
+        else:
+            batch_shape = (-1,)
+
+        split = []
+        index = 0
+        for mode in self.output_modes:
+            out_shape = tuple(self.__compute_mode_shape(input_shape, mode))
+            flat_size = self.__flat_size(out_shape)
+            split.append(K.reshape(outputs[..., index:index + flat_size], batch_shape + out_shape))
+            index += flat_size
+        return split
+        
+    def __state_shapes(self, init_nb_row, init_nb_col):
+        # shapes (without the samples axis) of the r, c, e (and ahat) states 
+        # for padded frames of size (init_nb_row, init_nb_col)
 
-        initial_states = []
+        state_shapes = []
         states_to_pass = ['r', 'c', 'e']
         nlayers_to_pass = {u: self.nb_layers for u in states_to_pass}
         if self.extrap_start_time is not None:
@@ -184,16 +574,24 @@ class PredNet(Recurrent):
                     stack_size = 2 * self.stack_sizes[l]
                 elif u == 'ahat':
                     stack_size = self.stack_sizes[l]
-                output_size = stack_size * nb_row * nb_col  # flattened size
-
-                reducer = K.zeros((input_shape[self.channel_axis], output_size)) # (nb_channels, output_size)
-                initial_state = K.dot(base_initial_state, reducer) # (samples, output_size)
                 if self.data_format == 'channels_first':
-                    output_shp = (-1, stack_size, nb_row, nb_col)
+                    state_shapes.append((stack_size, nb_row, nb_col))
                 else:
-                    output_shp = (-1, nb_row, nb_col, stack_size)
-                initial_state = K.reshape(initial_state, output_shp)
-                initial_states += [initial_state]
+                    state_shapes.append((nb_row, nb_col, stack_size))
+        return state_shapes
+
+    def __batch_zeros(self, x, shape):
+        # zeros of shape (samples,) + shape, where samples is the (dynamic) batch size of x
+        if K.backend() == 'tensorflow':
+            import tensorflow as tf
+            return tf.zeros(K.stack([K.shape(x)[0]] + list(shape)), dtype=self.compute_dtype)
+        zeros = K.zeros_like(K.reshape(x[:, 0, 0, 0, 0], (-1, 1, 1, 1)))  # (samples, 1, 1, 1)
+        return K.cast(K.tile(zeros, (1,) + tuple(shape)), self.compute_dtype)
+
+    def get_initial_state(self, x):
+        nb_row, nb_col = [self.__padded_size(size) for size in self.__spatial_size(x)]
+        state_shapes = self.__state_shapes(nb_row, nb_col)
+        initial_states = [self.__batch_zeros(x, shape) for shape in state_shapes]
 
         if K._BACKEND == 'theano':
             from theano import tensor as T
@@ -207,14 +605,21 @@ class PredNet(Recurrent):
 
     def build(self, input_shape):
         self.input_spec = [InputSpec(shape=input_shape)]
-        self.conv_layers = {c: [] for c in ['i', 'f', 'c', 'o', 'a', 'ahat']}
+        lstm_convs = ['lstm'] if self.fused_gates else LSTM_GATES
+        self.conv_layers = {c: [] for c in lstm_convs + ['a', 'ahat']}
 
         for l in range(self.nb_layers):
-            for c in ['i', 'f', 'c', 'o']:
-                act = self.LSTM_activation if c == 'c' else self.LSTM_inner_activation
-                self.conv_layers[c].append(Conv2D(self.R_stack_sizes[l], self.R_filt_sizes[l], 
-                                                  padding='same', activation=act, 
-                                                  data_format=self.data_format))
+            if self.fused_gates:
+                # activations are applied after splitting the gates in step()
+                self.conv_layers['lstm'].append(Conv2D(len(LSTM_GATES) * self.R_stack_sizes[l], 
+                                                       self.R_filt_sizes[l], padding='same', 
+                                                       data_format=self.data_format))
+            else:
+                for c in LSTM_GATES:
+                    act = self.LSTM_activation if c == 'c' else self.LSTM_inner_activation
+                    self.conv_layers[c].append(Conv2D(self.R_stack_sizes[l], self.R_filt_sizes[l], 
+                                                      padding='same', activation=act, 
+                                                      data_format=self.data_format))
 
             act = 'relu' if l == 0 else self.A_activation
             self.conv_layers['ahat'].append(Conv2D(self.stack_sizes[l], self.Ahat_filt_sizes[l], 
@@ -233,7 +638,6 @@ class PredNet(Recurrent):
         nb_row, nb_col = (input_shape[-2], input_shape[-1]) if self.data_format == 'channels_first' else (input_shape[-3], input_shape[-2])
         for c in sorted(self.conv_layers.keys()):
             for l in range(len(self.conv_layers[c])):
-                ds_factor = 2 ** l
                 if c == 'ahat':
                     nb_channels = self.R_stack_sizes[l]
                 elif c == 'a':
@@ -242,7 +646,7 @@ class PredNet(Recurrent):
                     nb_channels = self.stack_sizes[l] * 2 + self.R_stack_sizes[l]
                     if l < self.nb_layers - 1:
                         nb_channels += self.R_stack_sizes[l+1]
-                in_shape = (input_shape[0], nb_channels, nb_row // ds_factor, nb_col // ds_factor)
+                in_shape = (input_shape[0], nb_channels, self.__layer_size(nb_row, l), self.__layer_size(nb_col, l))
                 if self.data_format == 'channels_last': in_shape = (in_shape[0], in_shape[2], in_shape[3], in_shape[1])
                 with K.name_scope('layer_' + c + '_' + str(l)):
                     self.conv_layers[c][l].build(in_shape)
@@ -256,7 +660,59 @@ class PredNet(Recurrent):
         
         if self.stateful:
             self.reset_states()
+
+    def set_weights(self, weights):
+        if self.fused_gates and len(weights) == len(self.weights) + 2 * (len(LSTM_GATES) - 1) * self.nb_layers:
+            weights = pack_gate_weights(weights, self.nb_layers)
+        super(PredNet, self).set_weights(weights)
+
+    def __slice_channels(self, x, start, stop):
+        if self.data_format == 'channels_first':
+            return x[:, start:stop]
+        return x[..., start:stop]
+
+    def __conv(self, conv, x):
+        if self.compute_dtype == K.floatx() and self.__weight_values is None:
+            return conv.call(x)
+        kernel, bias = conv.kernel, conv.bias
+        if self.__weight_values is not None:
+            kernel = self.__weight_values[kernel.name]
+            bias = self.__weight_values[bias.name]
+        # cast the float32 master weights to the compute dtype
+        out = K.conv2d(x, K.cast(kernel, self.compute_dtype), 
+                       strides=conv.strides, padding=conv.padding, 
+                       data_format=conv.data_format, dilation_rate=conv.dilation_rate)
+        if conv.use_bias:
+            out = K.bias_add(out, K.cast(bias, self.compute_dtype), data_format=conv.data_format)
+        if conv.activation is not None:
+            out = conv.activation(out)
+        return out
+
+    def __lstm_gates(self, l, inputs):
+        if not self.fused_gates:
+            return [self.__conv(self.conv_layers[c][l], inputs) for c in LSTM_GATES]
+
+        z = self.__conv(self.conv_layers['lstm'][l], inputs)
+        size = self.R_stack_sizes[l]
+        gates = []
+        for g, c in enumerate(LSTM_GATES):
+            act = self.LSTM_activation if c == 'c' else self.LSTM_inner_activation
+            gates.append(act(self.__slice_channels(z, g * size, (g + 1) * size)))
+        return gates
             
+    def __pool_representation(self, r):
+        # Do avg spatial pooling to make all representation layers have 
+        # the same dimension as the higher-level representation layer.
+        pooled = []
+        for l in range(self.nb_layers):
+            ratio = 2 ** (self.nb_layers - 1 - l)
+            r_l = r[l]
+            if ratio > 1:
+                r_l = K.pool2d(r_l, (ratio, ratio), strides=(ratio, ratio), 
+                               pool_mode='avg', data_format=self.data_format)
+            pooled.append(r_l)
+        return K.concatenate(pooled, axis=self.channel_axis)
+
     def reset_states(self, states=None):
         if not self.stateful:
             raise AttributeError('Layer must be stateful.')
@@ -272,20 +728,28 @@ class PredNet(Recurrent):
                              '- If using the functional API, specify '
                              'the time dimension by passing a '
                              '`batch_shape` argument to your Input layer.')
+        input_shape = self.input_spec[0].shape
+        if input_shape[self.row_axis] is None or input_shape[self.column_axis] is None:
+            raise ValueError('A stateful PredNet needs to know the height and width of its input.')
         
-        initial_states = self.get_initial_state(K.zeros(self.input_spec[0].shape))
+        nb_row, nb_col = [self.__padded_size(input_shape[axis]) for axis in [self.row_axis, self.column_axis]]
+        state_shapes = [(batch_size,) + shape for shape in self.__state_shapes(nb_row, nb_col)]
+        state_dtypes = [self.compute_dtype] * len(state_shapes)
+        if self.extrap_start_time is not None:
+            state_shapes.append(())  # current timestep
+            state_dtypes.append('int32')
         
         # initialize state if None
         if self.states[0] is None:
             #self.states = [K.zeros((batch_size, self.units))
             #               for _ in self.states]
-            self.states = [K.zeros(s.shape)
-                           for s in initial_states]
+            self.states = [K.zeros(shape, dtype=dtype)
+                           for shape, dtype in zip(state_shapes, state_dtypes)]
         elif states is None:
             #for state in self.states:
                 #K.set_value(state, np.zeros((batch_size, self.units)))
-            for i, state in enumerate(self.states):
-                K.set_value(state, np.zeros(initial_states[i].shape))
+            for state, shape in zip(self.states, state_shapes):
+                K.set_value(state, np.zeros(shape, dtype=K.dtype(state)))
         else:
             if not isinstance(states, (list, tuple)):
                 states = [states]
@@ -305,18 +769,72 @@ class PredNet(Recurrent):
                 K.set_value(state, value)
                 
 
+    def reset_samples(self, samples):
+        '''Resets the states of the given samples of the batch of a stateful layer, 
+        ex. when a batch slot moves to a new video.'''
+        if not self.stateful:
+            raise AttributeError('Layer must be stateful.')
+        if len(samples) == 0:
+            return
+        if self.__samples_reset is None or any(s is not t for s, t in zip(self.__samples_reset[0], self.states)):
+            self.__samples_reset = (list(self.states), self.__build_samples_reset())
+        keep = np.ones(K.int_shape(self.states[0])[0], dtype=K.floatx())
+        keep[list(samples)] = 0
+        self.__samples_reset[1]([keep])
+        
+    def __build_samples_reset(self):
+        # the states are multiplied in the graph by a mask of the batch samples to keep
+        keep = K.placeholder(shape=(None,))
+        updates = []
+        for state in self.states:
+            if K.ndim(state) == 0:  # extrapolation timestep
+                continue
+            mask = K.reshape(K.cast(keep, K.dtype(state)), (-1,) + (1,) * (K.ndim(state) - 1))
+            updates.append(K.update(state, state * mask))
+        return K.function([keep], [], updates=updates)
+
     def step(self, a, states):
+        return self.__step(a, states, self.nb_layers)
+
+    def __step(self, a, states, nb_ff_layers):
         r_tm1 = states[:self.nb_layers]
         c_tm1 = states[self.nb_layers:2*self.nb_layers]
         e_tm1 = states[2*self.nb_layers:3*self.nb_layers]
 
+        if self.compute_dtype != K.floatx():
+            a = K.cast(a, self.compute_dtype)
+
         if self.extrap_start_time is not None:
             t = states[-1]
             a = K.switch(t >= self.t_extrap, states[-2], a)  # if past self.extrap_start_time, the previous prediction will be treated as the actual
 
+        r, c = self.update_representation(r_tm1, c_tm1, e_tm1)
+        e, a_layers, ahat_layers = self.update_errors(a, r, nb_ff_layers)
+        frame_prediction = ahat_layers[0] if nb_ff_layers > 0 else None
+
+        units = {'A': a_layers, 'Ahat': ahat_layers, 'R': r, 'E': e}
+        output = self.__step_output(frame_prediction, units)
+
+        states = r + c + e + list(e_tm1[nb_ff_layers:])
+        if self.extrap_start_time is not None:
+            states += [frame_prediction, t + 1]
+        return output, states
+
+    def __step_output(self, frame_prediction, units):
+        outputs = [self.__get_output(mode, frame_prediction, units) for mode in self.output_modes]
+        if len(outputs) == 1:
+            output = outputs[0]
+        else:
+            output = K.concatenate([K.batch_flatten(o) for o in outputs], axis=-1)
+        if self.compute_dtype != K.floatx():
+            output = K.cast(output, K.floatx())
+        return output
+
+    def update_representation(self, r_tm1, c_tm1, e_tm1):
+        '''Top-down update of the R units (and LSTM cells) of all layers.
+        Returns the lists of R and cell tensors, from the bottom layer up.'''
         c = []
         r = []
-        e = []
 
         # Update R units starting from the top
         for l in reversed(range(self.nb_layers)):
@@ -325,23 +843,37 @@ class PredNet(Recurrent):
                 inputs.append(r_up)
 
             inputs = K.concatenate(inputs, axis=self.channel_axis)
-            i = self.conv_layers['i'][l].call(inputs)
-            f = self.conv_layers['f'][l].call(inputs)
-            o = self.conv_layers['o'][l].call(inputs)
-            _c = f * c_tm1[l] + i * self.conv_layers['c'][l].call(inputs)
+            i, f, c_hat, o = self.__lstm_gates(l, inputs)
+            _c = f * c_tm1[l] + i * c_hat
             _r = o * self.LSTM_activation(_c)
             c.insert(0, _c)
             r.insert(0, _r)
 
             if l > 0:
                 r_up = self.upsample.call(_r)
+        return r, c
+
+    def predict_frame(self, r):
+        '''Frame prediction (Ahat of layer 0) from the R units.'''
+        ahat = self.__conv(self.conv_layers['ahat'][0], r[0])
+        return K.minimum(ahat, self.pixel_max)
+
+    def update_errors(self, a, r, nb_ff_layers=None):
+        '''Bottom-up pass computing the targets (A), predictions (Ahat) and errors (E)
+        of the first nb_ff_layers layers (all layers by default) for the input frame a.
+        Returns the lists of E, A and Ahat tensors. Ahat of layer 0 is the frame prediction.'''
+        if nb_ff_layers is None:
+            nb_ff_layers = self.nb_layers
+        e = []
+        a_layers = []
+        ahat_layers = []
 
         # Update feedforward path starting from the bottom
-        for l in range(self.nb_layers):
-            ahat = self.conv_layers['ahat'][l].call(r[l])
+        for l in range(nb_ff_layers):
             if l == 0:
-                ahat = K.minimum(ahat, self.pixel_max)
-                frame_prediction = ahat
+                ahat = self.predict_frame(r)
+            else:
+                ahat = self.__conv(self.conv_layers['ahat'][l], r[l])
 
             # compute errors
             e_up = self.error_activation(ahat - a)
@@ -349,38 +881,32 @@ class PredNet(Recurrent):
 
             e.append(K.concatenate((e_up, e_down), axis=self.channel_axis))
 
-            if self.output_layer_num == l:
-                if self.output_layer_type == 'A':
-                    output = a
-                elif self.output_layer_type == 'Ahat':
-                    output = ahat
-                elif self.output_layer_type == 'R':
-                    output = r[l]
-                elif self.output_layer_type == 'E':
-                    output = e[l]
+            a_layers.append(a)
+            ahat_layers.append(ahat)
 
-            if l < self.nb_layers - 1:
-                a = self.conv_layers['a'][l].call(e[l])
+            if l < nb_ff_layers - 1:
+                a = self.__conv(self.conv_layers['a'][l], e[l])
                 a = self.pool.call(a)  # target for next layer
-
-        if self.output_layer_type is None:
-            if self.output_mode == 'prediction':
-                output = frame_prediction
-            elif self.output_mode == 'representation':
-                output = K.concatenate([K.batch_flatten(r[l]) for l in range(self.nb_layers)], axis=-1)
-            else:
-                for l in range(self.nb_layers):
-                    layer_error = K.mean(K.batch_flatten(e[l]), axis=-1, keepdims=True)
-                    all_error = layer_error if l == 0 else K.concatenate((all_error, layer_error), axis=-1)
-                if self.output_mode == 'error':
-                    output = all_error
-                else: # output_mode == 'all'
-                    output = K.concatenate((K.batch_flatten(frame_prediction), all_error), axis=-1)
-
-        states = r + c + e
-        if self.extrap_start_time is not None:
-            states += [frame_prediction, t + 1]
-        return output, states
+        return e, a_layers, ahat_layers
+
+    def __get_output(self, mode, frame_prediction, units):
+        layer_type, layer_num = self.__parse_layer_mode(mode)
+        if layer_type is not None:
+            return self.__crop(units[layer_type][layer_num], layer_num)
+
+        if mode == 'prediction':
+            return self.__crop(frame_prediction, 0)
+        elif mode == 'representation':
+            return K.concatenate([K.batch_flatten(self.__crop(r_l, l)) for l, r_l in enumerate(units['R'])], axis=-1)
+        elif mode == 'pooled_representation':
+            return self.__crop(self.__pool_representation(units['R']), self.nb_layers - 1)
+
+        all_error = K.concatenate([K.mean(K.batch_flatten(self.__crop(units['E'][l], l)), axis=-1, keepdims=True)
+                                   for l in self.error_layers], axis=-1)
+        if mode == 'error':
+            return all_error
+        else: # mode == 'all'
+            return K.concatenate((K.batch_flatten(self.__crop(frame_prediction, 0)), all_error), axis=-1)
 
     def get_config(self):
         config = {'stack_sizes': self.stack_sizes,
@@ -395,6 +921,11 @@ class PredNet(Recurrent):
                   'LSTM_inner_activation': self.LSTM_inner_activation.__name__,
                   'data_format': self.data_format,
                   'extrap_start_time': self.extrap_start_time,
-                  'output_mode': self.output_mode}
+                  'output_mode': self.output_mode,
+                  'fused_gates': self.fused_gates,
+                  'truncate_inference': self.truncate_inference,
+                  'compute_dtype': self.compute_dtype,
+                  'checkpoint_timesteps': self.checkpoint_timesteps,
+                  'error_layers': self.error_layers}
         base_config = super(PredNet, self).get_config()
         return dict(list(base_config.items()) + list(config.items()))
@@ -1,45 +1,154 @@
 from keras import backend as K
 from keras.models import Model, model_from_json
-from keras.layers import Input, TimeDistributed, Dense, Flatten
+from keras.layers import Input, Masking
+from keras.engine import Layer
+import tensorflow as tf
 import numpy as np
+import os
 
 from prednet import PredNet
+from prednet_weights import load_compact_weights
 
 def load_model(model_json_file, model_weights_file, **extras):   
     print('Loading model: {}'.format(model_weights_file))
     f = open(model_json_file, 'r')
     json_string = f.read()
     f.close()
-    train_model = model_from_json(json_string, custom_objects = {'PredNet': PredNet})
+    train_model = model_from_json(json_string, custom_objects = {'PredNet': PredNet, 
+                                                               'WeightedError': WeightedError})
     train_model.load_weights(model_weights_file)
     return train_model
 
+# options of create_model that change the built model, see model_cache_key
+MODEL_CACHE_OPTIONS = ['n_timesteps', 'output_mode', 'batch_size', 'stateful', 
+                       'fused_gates', 'truncate_inference', 'compute_dtype', 
+                       'dynamic_size', 'mask_value']
+
+# process-level caches of pretrained weights (NumPy arrays) and of built models. 
+# A built model belongs to the graph it was built in, which K.clear_session 
+# (session_config.setup_session) replaces, so models are cached with their graph
+_weights_cache = {}
+_model_cache = {}
+
+def clear_cache():
+    _weights_cache.clear()
+    _model_cache.clear()
+
 def create_model(model_json_file=None, model_weights_file=None, 
-                 train=False, **config):
-    if model_json_file and model_weights_file:
-        pretrained_model = load_model(model_json_file, model_weights_file)
-        model = pretrained_prednet(pretrained_model, train=train, **config)
+                 model_compact_file=None, train=False, cache=True, **config):
+    '''Pretrained models are loaded from model_compact_file (see prednet_weights.py)
+    if given, otherwise from the model_json_file/model_weights_file pair.
+    
+    Pretrained models are cached per process: the weights of a checkpoint
+    are loaded once, and inference models built with the same options are reused.
+    Pass cache=False to get a new model, ex. when the PredNet weights will be trained 
+    or the model changed (ex. frozen layers).'''
+    if model_compact_file:
+        model_files = [model_compact_file]
+    elif model_json_file and model_weights_file:
+        model_files = [model_json_file, model_weights_file]
     else:
-        model = random_prednet(train=train, **config)
+        return random_prednet(train=train, **config)
+    
+    key = None
+    if cache and not train:
+        key = model_cache_key(model_files, **config)
+        model = cached_model(key)
+        if model is not None:
+            if model.layers[1].stateful:
+                model.reset_states()
+            return model
+    layer_config, weights, input_shape = load_pretrained(*model_files)
+    model = pretrained_prednet_from_weights(layer_config, weights, input_shape, 
+                                            train=train, **config)
+    if key is not None:
+        _model_cache[key] = (tf.get_default_graph(), model)
     return model
 
-def pretrained_prednet(pretrained_model, n_timesteps, output_mode='error', 
-                       train=False, stateful=False, batch_size=None, **config):
-    layer_config = pretrained_model.layers[1].get_config()
+def cached_model(key):
+    # the models of a previous graph are dropped, their tensors can't be run anymore
+    graph = tf.get_default_graph()
+    for k in [k for k, (g, _) in _model_cache.items() if g is not graph]:
+        del _model_cache[k]
+    if key in _model_cache:
+        return _model_cache[key][1]
+    return None
+
+def model_files_key(model_files):
+    # the last file holds the weights
+    return tuple(os.path.abspath(f) for f in model_files) + (os.path.getmtime(model_files[-1]),)
+
+def model_cache_key(model_files, **config):
+    key = list(model_files_key(model_files))
+    for option in MODEL_CACHE_OPTIONS:
+        value = config.get(option, None)
+        key.append(tuple(value) if isinstance(value, list) else value)
+    return tuple(key)
+
+def load_pretrained(*model_files):
+    '''Returns (layer config, weights, batch input shape) of the PredNet layer 
+    of a compact weight file or of a (model json, weights) pair. 
+    Each checkpoint is only loaded once per process.'''
+    key = model_files_key(model_files)
+    if key not in _weights_cache:
+        if len(model_files) == 1:
+            print('Loading model: {}'.format(model_files[0]))
+            _weights_cache[key] = load_compact_weights(model_files[0])
+        else:
+            pretrained_model = load_model(*model_files)
+            _weights_cache[key] = (pretrained_model.layers[1].get_config(), 
+                                   pretrained_model.layers[1].get_weights(), 
+                                   pretrained_model.layers[0].batch_input_shape)
+    return _weights_cache[key]
+
+def pretrained_prednet(pretrained_model, n_timesteps, **config):
+    return pretrained_prednet_from_weights(pretrained_model.layers[1].get_config(), 
+                                           pretrained_model.layers[1].get_weights(), 
+                                           pretrained_model.layers[0].batch_input_shape, 
+                                           n_timesteps, **config)
+
+def pretrained_prednet_from_weights(layer_config, weights, batch_input_shape, 
+                                    n_timesteps, output_mode='error', 
+                                    train=False, stateful=False, batch_size=None, 
+                                    fused_gates=None, truncate_inference=None, 
+                                    compute_dtype=None, dynamic_size=False, 
+                                    mask_value=None, carry_states=False, 
+                                    checkpoint_timesteps=None, layer_loss_weights='L_all', 
+                                    time_loss_weights=None, **config):
+    layer_config = dict(layer_config)
     layer_config['output_mode'] = output_mode
+    layer_config['error_layers'] = get_error_layers(train, len(layer_config['stack_sizes']), 
+                                                    layer_loss_weights)
     layer_config['stateful'] = stateful
-    prednet = PredNet(weights=pretrained_model.layers[1].get_weights(), **layer_config)
-    input_shape = list(pretrained_model.layers[0].batch_input_shape[1:])
+    if fused_gates is not None:
+        # legacy per-gate weights are packed by PredNet.set_weights
+        layer_config['fused_gates'] = fused_gates
+    if truncate_inference is not None:
+        layer_config['truncate_inference'] = truncate_inference
+    if compute_dtype is not None:
+        layer_config['compute_dtype'] = compute_dtype
+    if checkpoint_timesteps is not None:
+        layer_config['checkpoint_timesteps'] = checkpoint_timesteps
+    prednet = PredNet(weights=weights, **layer_config)
+    input_shape = list(batch_input_shape[1:])
     input_shape[0] = n_timesteps
+    if dynamic_size:
+        input_shape = dynamic_input_shape(input_shape, prednet.data_format)
     inputs = get_input_layer(batch_size, tuple(input_shape))
-    outputs = get_output_layer(prednet, inputs, n_timesteps, train, output_mode)
+    outputs = get_output_layer(prednet, inputs, n_timesteps, train, output_mode, 
+                               mask_value, carry_states, layer_loss_weights, 
+                               time_loss_weights)
     model = Model(inputs=inputs, outputs=outputs)
     return model
 
 def random_prednet(input_channels, input_height, input_width, 
                    n_timesteps, stack_sizes=(48, 96, 192), 
                    train=False, output_mode='error', stateful=False, 
-                   batch_size=None, **config):
+                   batch_size=None, fused_gates=False, 
+                   truncate_inference=False, compute_dtype=None, 
+                   dynamic_size=False, mask_value=None, carry_states=False, 
+                   checkpoint_timesteps=None, layer_loss_weights='L_all', 
+                   time_loss_weights=None, **config):
     # Model parameters
     if K.image_data_format() == 'channels_first':
         input_shape = (input_channels, input_height, input_width) 
@@ -54,13 +163,30 @@ def random_prednet(input_channels, input_height, input_width,
     prednet = PredNet(stack_sizes, R_stack_sizes,
                       A_filt_sizes, Ahat_filt_sizes, R_filt_sizes,
                       output_mode=output_mode, return_sequences=True, 
-                      stateful=stateful)
+                      stateful=stateful, fused_gates=fused_gates,
+                      truncate_inference=truncate_inference,
+                      compute_dtype=compute_dtype, 
+                      checkpoint_timesteps=checkpoint_timesteps,
+                      error_layers=get_error_layers(train, len(stack_sizes), layer_loss_weights))
     input_shape = (n_timesteps,) + input_shape
+    if dynamic_size:
+        input_shape = dynamic_input_shape(input_shape, prednet.data_format)
     inputs = get_input_layer(batch_size, input_shape)
-    outputs = get_output_layer(prednet, inputs, n_timesteps, train, output_mode)
+    outputs = get_output_layer(prednet, inputs, n_timesteps, train, output_mode, 
+                               mask_value, carry_states, layer_loss_weights, 
+                               time_loss_weights)
     model = Model(inputs=inputs, outputs=outputs)
     return model
 
+def dynamic_input_shape(input_shape, data_format):
+    # the height and width of the frames are only known when the model is run
+    input_shape = list(input_shape)
+    if data_format == 'channels_first':
+        input_shape[-2:] = [None, None]
+    else:
+        input_shape[-3:-1] = [None, None]
+    return tuple(input_shape)
+
 def get_input_layer(batch_size, input_shape):
     if batch_size:
         input_shape = (batch_size,) + input_shape
@@ -69,28 +195,94 @@ def get_input_layer(batch_size, input_shape):
         inputs = Input(shape=input_shape)
     return inputs
 
-def get_output_layer(prednet, inputs, n_timesteps, train, output_mode):
-    outputs = prednet(inputs)
+def get_output_layer(prednet, inputs, n_timesteps, train, output_mode, 
+                     mask_value=None, carry_states=False, layer_loss_weights='L_all', 
+                     time_loss_weights=None):
+    if mask_value is not None:
+        if train:
+            raise ValueError('Padded sequences can not be masked when training')
+        # frames equal to mask_value (ex. padding frames) are skipped by PredNet
+        outputs = prednet(Masking(mask_value=mask_value)(inputs))
+    else:
+        outputs = prednet(inputs)
     if train:
         if output_mode != 'error':
             raise ValueError('When training, output_mode must be equal to "error"')
-        outputs = get_error_layer(outputs, n_timesteps, prednet.nb_layers)
+        outputs = get_error_layer(outputs, n_timesteps, prednet.nb_layers, 
+                                  skip_first_timestep=not carry_states, 
+                                  layer_loss_weights=layer_loss_weights, 
+                                  time_loss_weights=time_loss_weights, 
+                                  error_layers=prednet.error_layers)
     return outputs
 
-def get_error_layer(outputs, n_timesteps, nb_layers):
+def get_layer_loss_weights(layer_loss_weights, nb_layers):
     # weighting for each layer in final loss; "L_0" model:  [1, 0, 0, 0], "L_all": [1, 0.1, 0.1, 0.1]
-    layer_loss_weights = np.array([0.1] * nb_layers)
-    layer_loss_weights[0] = 1
-    layer_loss_weights = np.expand_dims(layer_loss_weights, 1)
-    # equally weight all timesteps except the first
-    time_loss_weights = 1./ (n_timesteps - 1) * np.ones((n_timesteps,1))  
-    time_loss_weights[0] = 0
-
-    # calculate weighted error by layer
-    errors_by_time = TimeDistributed(Dense(1, trainable=False), 
-                                     weights=[layer_loss_weights, np.zeros(1)], 
-                                     trainable=False)(outputs)
-    errors_by_time = Flatten()(errors_by_time)  # will be (batch_size, n_timesteps)
-    final_errors = Dense(1, weights=[time_loss_weights, np.zeros(1)], 
-                         trainable=False)(errors_by_time) # weight errors by time
-    return final_errors
\ No newline at end of file
+    if layer_loss_weights == 'L_0':
+        return [1.] + [0.] * (nb_layers - 1)
+    if layer_loss_weights == 'L_all':
+        return [1.] + [0.1] * (nb_layers - 1)
+    if isinstance(layer_loss_weights, str) or len(layer_loss_weights) != nb_layers:
+        raise ValueError('layer_loss_weights must be "L_0", "L_all" or one weight per layer: ' + 
+                         str(layer_loss_weights))
+    return [float(w) for w in layer_loss_weights]
+
+def get_time_loss_weights(time_loss_weights, n_timesteps, skip_first_timestep=True):
+    if time_loss_weights is None:
+        if skip_first_timestep:
+            # equally weight all timesteps except the first
+            return [0.] + [1. / (n_timesteps - 1)] * (n_timesteps - 1)
+        # states are carried from the previous window, so the first timestep has a prediction
+        return [1. / n_timesteps] * n_timesteps
+    if len(time_loss_weights) != n_timesteps:
+        raise ValueError('time_loss_weights must have one weight per timestep: ' + str(time_loss_weights))
+    return [float(w) for w in time_loss_weights]
+
+def get_error_layers(train, nb_layers, layer_loss_weights='L_all'):
+    # layers whose mean error is output by PredNet: all of them for inference, 
+    # only those with a non zero weight in the loss when training
+    if not train:
+        return None
+    layer_weights = get_layer_loss_weights(layer_loss_weights, nb_layers)
+    return [l for l, w in enumerate(layer_weights) if w != 0]
+
+def get_error_layer(outputs, n_timesteps, nb_layers, skip_first_timestep=True, 
+                    layer_loss_weights='L_all', time_loss_weights=None, error_layers=None):
+    layer_weights = get_layer_loss_weights(layer_loss_weights, nb_layers)
+    time_weights = get_time_loss_weights(time_loss_weights, n_timesteps, skip_first_timestep)
+    if error_layers is None:
+        error_layers = range(nb_layers)
+    # outputs has the mean errors of error_layers only
+    return WeightedError(time_weights, [layer_weights[l] for l in error_layers])(outputs)
+
+
+class WeightedError(Layer):
+    '''Training loss of PredNet from its 'error' output (samples, timesteps, layers): 
+    the sum of the mean layer errors weighted by timestep and by layer, as a (samples, 1) tensor. 
+    Timesteps whose weight is zero are left out of the loss sum, the PredNet layer 
+    still computes them.'''
+    def __init__(self, time_weights, layer_weights, **kwargs):
+        super(WeightedError, self).__init__(**kwargs)
+        self.time_weights = [float(w) for w in time_weights]
+        self.layer_weights = [float(w) for w in layer_weights]
+        self.timesteps = [t for t, w in enumerate(self.time_weights) if w != 0]
+        if not self.timesteps:
+            raise ValueError('At least one timestep must have a non zero loss weight')
+
+    def call(self, inputs):
+        first, last = self.timesteps[0], self.timesteps[-1]
+        if self.timesteps == list(range(first, last + 1)):
+            errors = inputs[:, first:last + 1]
+        else:
+            errors = K.stack([inputs[:, t] for t in self.timesteps], axis=1)
+        weights = np.outer([self.time_weights[t] for t in self.timesteps], self.layer_weights)
+        weighted_errors = errors * K.constant(weights, dtype=K.dtype(errors))
+        return K.sum(K.sum(weighted_errors, axis=-1), axis=-1, keepdims=True)
+
+    def compute_output_shape(self, input_shape):
+        return (input_shape[0], 1)
+
+    def get_config(self):
+        config = {'time_weights': self.time_weights,
+                  'layer_weights': self.layer_weights}
+        base_config = super(WeightedError, self).get_config()
+        return dict(list(base_config.items()) + list(config.items()))
@@ -0,0 +1,258 @@
+'''
+PredNet inference with NumPy only, without importing Keras or TensorFlow.
+
+Reads the PredNet layer config from the model json file and the weights from
+the HDF5 checkpoint, and reproduces PredNet.step with vectorized convolutions
+over the whole batch. Supports the same output modes as the Keras layer.
+'''
+import numpy as np
+
+from prednet_weights import LSTM_GATES, conv_weights, read_model_config, read_hdf5_weights
+from prednet_weights import load_compact_weights
+
+
+def relu(x):
+    return np.maximum(x, 0)
+
+def hard_sigmoid(x):
+    return np.clip(0.2 * x + 0.5, 0., 1.)
+
+def sigmoid(x):
+    return 1. / (1. + np.exp(-x))
+
+def linear(x):
+    return x
+
+activations = {'relu': relu, 'tanh': np.tanh, 'hard_sigmoid': hard_sigmoid,
+               'sigmoid': sigmoid, 'linear': linear}
+
+
+def conv2d(x, kernel, bias):
+    '''Stride 1 'same' convolution of x (batch, rows, cols, channels) with a
+    Keras kernel (kernel_rows, kernel_cols, in_channels, out_channels).
+    Computed as one matrix product per kernel offset over the whole batch.'''
+    k_rows, k_cols = kernel.shape[:2]
+    n, rows, cols, channels = x.shape
+    # same padding as TensorFlow: the extra row/col goes to the bottom/right
+    pad_top, pad_left = (k_rows - 1) // 2, (k_cols - 1) // 2
+    x_pad = np.pad(x, ((0, 0), (pad_top, k_rows - 1 - pad_top),
+                       (pad_left, k_cols - 1 - pad_left), (0, 0)), mode='constant')
+
+    out = np.empty((n * rows * cols, kernel.shape[-1]), dtype=x.dtype)
+    out[:] = bias
+    for i in range(k_rows):
+        for j in range(k_cols):
+            window = x_pad[:, i:i + rows, j:j + cols, :].reshape(-1, channels)
+            out += np.dot(window, kernel[i, j])
+    return out.reshape(n, rows, cols, -1)
+
+def layer_size(size, layer_num):
+    # size of a layer_num feature map for an input of size `size`, as PredNet
+    return -(-size // 2**layer_num)
+
+def upsample(x):
+    return x.repeat(2, axis=1).repeat(2, axis=2)
+
+def pool(x, size=2, func=np.max):
+    n, rows, cols, channels = x.shape
+    rows, cols = rows // size, cols // size
+    x = x[:, :rows * size, :cols * size]
+    return func(x.reshape(n, rows, size, cols, size, channels), axis=(2, 4))
+
+
+class NumpyPredNet(object):
+    '''NumPy version of the PredNet layer for inference. Takes the same arguments
+    as PredNet plus `weights`, the list returned by `PredNet.get_weights()`.
+    Internally works with channels_last arrays; inputs and outputs follow data_format.
+    As in the Keras layer, frames whose height or width is not a multiple of 
+    2**(nb_layers - 1) are zero-padded at the bottom and right, and the outputs 
+    are cropped back.'''
+    def __init__(self, weights, stack_sizes, R_stack_sizes,
+                 A_filt_sizes, Ahat_filt_sizes, R_filt_sizes,
+                 pixel_max=1., error_activation='relu', A_activation='relu',
+                 LSTM_activation='tanh', LSTM_inner_activation='hard_sigmoid',
+                 output_mode='error', extrap_start_time=None,
+                 data_format='channels_last', fused_gates=False,
+                 return_sequences=True, error_layers=None, dtype=np.float32, **kwargs):
+        self.stack_sizes = stack_sizes
+        self.R_stack_sizes = R_stack_sizes
+        self.nb_layers = len(stack_sizes)
+        self.pixel_max = pixel_max
+        self.error_activation = activations[error_activation]
+        self.A_activation = activations[A_activation]
+        self.LSTM_activation = activations[LSTM_activation]
+        self.LSTM_inner_activation = activations[LSTM_inner_activation]
+        self.output_mode = output_mode
+        self.output_modes = list(output_mode) if isinstance(output_mode, (list, tuple)) else [output_mode]
+        self.extrap_start_time = extrap_start_time
+        self.data_format = data_format
+        self.return_sequences = return_sequences
+        self.error_layers = list(range(self.nb_layers)) if error_layers is None else list(error_layers)
+        self.dtype = dtype
+        self.input_size = None  # (rows, cols) of the frames before padding, set in predict
+        weights = [np.asarray(w, dtype=dtype) for w in weights]
+        self.convs = conv_weights(weights, self.nb_layers, fused_gates)
+
+    def conv(self, name, l, x):
+        kernel, bias = self.convs[name][l]
+        return conv2d(x, kernel, bias)
+
+    def get_initial_state(self, batch_size, nb_row, nb_col):
+        states = []
+        for sizes in [self.R_stack_sizes, self.R_stack_sizes, [2 * s for s in self.stack_sizes]]:
+            for l in range(self.nb_layers):
+                shape = (batch_size, nb_row // 2**l, nb_col // 2**l, sizes[l])
+                states.append(np.zeros(shape, dtype=self.dtype))
+        if self.extrap_start_time is not None:
+            # zero initial prediction, the actual frame when extrapolating from t=0
+            states.append(np.zeros((batch_size, nb_row, nb_col, self.stack_sizes[0]), dtype=self.dtype))
+        return states
+
+    def update_representation(self, r_tm1, c_tm1, e_tm1):
+        r = [None] * self.nb_layers
+        c = [None] * self.nb_layers
+        for l in reversed(range(self.nb_layers)):
+            inputs = [r_tm1[l], e_tm1[l]]
+            if l < self.nb_layers - 1:
+                inputs.append(upsample(r[l + 1]))
+            z = self.conv('lstm', l, np.concatenate(inputs, axis=-1))
+            gates = np.split(z, len(LSTM_GATES), axis=-1)
+            i, f, c_hat, o = [self.LSTM_activation(g) if name == 'c' else self.LSTM_inner_activation(g)
+                              for name, g in zip(LSTM_GATES, gates)]
+            c[l] = f * c_tm1[l] + i * c_hat
+            r[l] = o * self.LSTM_activation(c[l])
+        return r, c
+
+    def update_errors(self, a, r):
+        e = []
+        a_layers = []
+        ahat_layers = []
+        for l in range(self.nb_layers):
+            if l == 0:
+                ahat = np.minimum(relu(self.conv('ahat', l, r[l])), self.pixel_max)
+            else:
+                ahat = self.A_activation(self.conv('ahat', l, r[l]))
+            e.append(np.concatenate((self.error_activation(ahat - a),
+                                     self.error_activation(a - ahat)), axis=-1))
+            a_layers.append(a)
+            ahat_layers.append(ahat)
+            if l < self.nb_layers - 1:
+                a = pool(self.A_activation(self.conv('a', l, e[l])))
+        return e, a_layers, ahat_layers
+
+    def step(self, a, states):
+        r_tm1 = states[:self.nb_layers]
+        c_tm1 = states[self.nb_layers:2*self.nb_layers]
+        e_tm1 = states[2*self.nb_layers:3*self.nb_layers]
+        r, c = self.update_representation(r_tm1, c_tm1, e_tm1)
+        e, a_layers, ahat_layers = self.update_errors(a, r)
+        units = {'A': a_layers, 'Ahat': ahat_layers, 'R': r, 'E': e}
+        outputs = [self.get_output(mode, units) for mode in self.output_modes]
+        states = r + c + e
+        if self.extrap_start_time is not None:
+            states.append(ahat_layers[0])  # used as the actual frame when extrapolating
+        return outputs, states
+
+    def get_output(self, mode, units):
+        frame_prediction = self.crop(units['Ahat'][0], 0)
+        for layer_type in ['Ahat', 'A', 'R', 'E']:
+            if mode.startswith(layer_type) and mode[len(layer_type):].isdigit():
+                layer_num = int(mode[len(layer_type):])
+                return self.crop(units[layer_type][layer_num], layer_num)
+
+        batch_flatten = lambda x: x.reshape(x.shape[0], -1)
+        if mode == 'prediction':
+            return frame_prediction
+        elif mode == 'representation':
+            # flattened in the layer's data_format, as in the Keras layer
+            return np.concatenate([batch_flatten(self.__to_data_format(self.crop(r_l, l))) 
+                                   for l, r_l in enumerate(units['R'])], axis=-1)
+        elif mode == 'pooled_representation':
+            top = self.nb_layers - 1
+            pooled = np.concatenate([pool(r_l, 2**(top - l), np.mean) if l < top else r_l
+                                     for l, r_l in enumerate(units['R'])], axis=-1)
+            return self.crop(pooled, top)
+
+        all_error = np.stack([batch_flatten(self.crop(units['E'][l], l)).mean(axis=-1) 
+                              for l in self.error_layers], axis=-1)
+        if mode == 'error':
+            return all_error
+        else: # mode == 'all'
+            prediction = batch_flatten(self.__to_data_format(frame_prediction))
+            return np.concatenate((prediction, all_error), axis=-1)
+
+    def padded_size(self, size):
+        # input size padded to a multiple of 2**(nb_layers - 1)
+        return layer_size(size, self.nb_layers - 1) * 2**(self.nb_layers - 1)
+
+    def pad(self, X):
+        # zero-pad channels_last frames (batch, timesteps, rows, cols, channels) at the bottom and right
+        self.input_size = X.shape[2:4]
+        pads = [self.padded_size(size) - size for size in self.input_size]
+        if not any(pads):
+            return X
+        return np.pad(X, ((0, 0), (0, 0), (0, pads[0]), (0, pads[1]), (0, 0)), mode='constant')
+
+    def crop(self, x, layer_num):
+        # crop a channels_last layer_num feature map to the part computed from the frames before padding
+        if self.input_size is None:
+            return x
+        rows, cols = [layer_size(size, layer_num) for size in self.input_size]
+        return x[:, :rows, :cols]
+
+    def __to_data_format(self, x):
+        if self.data_format == 'channels_first' and x.ndim == 4:
+            return np.transpose(x, (0, 3, 1, 2))
+        return x
+
+    def predict(self, X):
+        '''X has shape (batch, timesteps) + image_shape in the layer's data_format.
+        Returns one array per output mode (a single array for a single mode).'''
+        X = np.asarray(X, dtype=self.dtype)
+        if self.data_format == 'channels_first':
+            X = np.transpose(X, (0, 1, 3, 4, 2))
+        X = self.pad(X)
+        n_timesteps = X.shape[1]
+        states = self.get_initial_state(X.shape[0], X.shape[2], X.shape[3])
+
+        outputs = [[] for _ in self.output_modes]
+        for t in range(n_timesteps):
+            a = X[:, t]
+            if self.extrap_start_time is not None and t >= self.extrap_start_time:
+                a = states[-1]  # the previous prediction is treated as the actual
+            outputs_t, states = self.step(a, states)
+            for k, output in enumerate(outputs_t):
+                outputs[k].append(self.__to_data_format(output))
+
+        if self.return_sequences:
+            outputs = [np.stack(o, axis=1) for o in outputs]
+        else:
+            outputs = [o[-1] for o in outputs]
+        return outputs[0] if len(outputs) == 1 else outputs
+
+
+def load_model(model_json_file, model_weights_file, output_mode=None, 
+               model_class=NumpyPredNet, **kwargs):
+    '''Builds a NumpyPredNet (or a subclass) from the json/HDF5 pair saved by train.py.'''
+    layer_name, config, input_shape = read_model_config(model_json_file)
+    weights = read_hdf5_weights(model_weights_file, layer_name)
+    return create_model(config, weights, output_mode, model_class, **kwargs)
+
+def load_compact_model(model_compact_file, output_mode=None, 
+                       model_class=NumpyPredNet, **kwargs):
+    '''Builds a NumpyPredNet (or a subclass) from a compact weight file. 
+    The weights of fused models are used directly from the memory map.'''
+    config, weights, input_shape = load_compact_weights(model_compact_file)
+    return create_model(config, weights, output_mode, model_class, **kwargs)
+
+def create_model(config, weights, output_mode=None, 
+                 model_class=NumpyPredNet, **kwargs):
+    config = dict(config)
+    if 'data_format' not in config and 'dim_ordering' in config:
+        config['data_format'] = {'tf': 'channels_last', 'th': 'channels_first'}[config['dim_ordering']]
+    if output_mode is not None:
+        config['output_mode'] = output_mode
+    # all the layer errors for inference, as prednet_model, whatever layers the model was trained on
+    config['error_layers'] = None
+    config.update(kwargs)
+    return model_class(weights, **config)
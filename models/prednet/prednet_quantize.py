@@ -0,0 +1,192 @@
+'''
+Post-training int8 quantization of PredNet for bulk inference.
+
+Kernels of the i/f/c/o (fused 'lstm'), a and ahat convolutions are quantized
+to int8 with one scale per output channel. The input of each convolution is
+quantized to int8 with a per-tensor scale calibrated on a few batches of
+the dataset. Products are accumulated in float32 and rescaled, then the bias
+is added in float32.
+
+The report compares the quantized model with the float model: frame prediction
+MSE (computed as in evaluate.evaluate_prediction) and the relative drift of
+the R and E units of each layer.
+'''
+import os
+import copy
+import argparse
+import numpy as np
+
+from prednet_numpy import NumpyPredNet, load_model
+
+INT8_MAX = 127.
+
+
+def quantize(x, scale):
+    return np.clip(np.round(x / scale), -INT8_MAX, INT8_MAX).astype(np.int8)
+
+def quantize_kernel(kernel):
+    '''Per output channel symmetric int8 quantization of a Keras conv kernel.'''
+    max_abs = np.abs(kernel.reshape(-1, kernel.shape[-1])).max(axis=0)
+    scale = np.where(max_abs > 0, max_abs / INT8_MAX, 1.).astype(np.float32)
+    return quantize(kernel, scale), scale
+
+
+class QuantizedPredNet(NumpyPredNet):
+    '''NumpyPredNet with int8 convolutions. Call `calibrate` before `predict`.'''
+    def __init__(self, weights, **config):
+        super(QuantizedPredNet, self).__init__(weights, **config)
+        self.qconvs = {}
+        for name, layers in self.convs.items():
+            self.qconvs[name] = [quantize_kernel(kernel) for kernel, bias in layers]
+        self.input_scales = None
+        self.calibrating = False
+
+    def calibrate(self, batches):
+        '''Computes the int8 scale of the input of each convolution from
+        the max absolute value over the calibration batches.'''
+        self.max_inputs = {name: [0.] * len(layers) for name, layers in self.convs.items()}
+        self.calibrating = True
+        for X in batches:
+            super(QuantizedPredNet, self).predict(X)
+        self.calibrating = False
+        self.input_scales = {}
+        for name, max_inputs in self.max_inputs.items():
+            self.input_scales[name] = [m / INT8_MAX if m > 0 else 1. for m in max_inputs]
+
+    def conv(self, name, l, x):
+        if self.calibrating:
+            self.max_inputs[name][l] = max(self.max_inputs[name][l], float(np.abs(x).max()))
+            return super(QuantizedPredNet, self).conv(name, l, x)
+        if self.input_scales is None:
+            raise ValueError('QuantizedPredNet must be calibrated before predict')
+
+        kernel_q, kernel_scale = self.qconvs[name][l]
+        bias = self.convs[name][l][1]
+        x_scale = self.input_scales[name][l]
+        x_q = quantize(x, x_scale)
+        # the products of int8 values are exact in float32, their sums are rounded to 
+        # float32 once they exceed 2**24 (ex. 3x3 kernels over a few hundred channels)
+        out = conv2d_int8(x_q, kernel_q)
+        return out * (x_scale * kernel_scale) + bias
+
+    def predict(self, X):
+        if self.input_scales is None:
+            raise ValueError('QuantizedPredNet must be calibrated before predict')
+        return super(QuantizedPredNet, self).predict(X)
+
+
+def conv2d_int8(x_q, kernel_q):
+    '''Same as prednet_numpy.conv2d for int8 inputs and kernels, without bias,
+    accumulating in float32.'''
+    k_rows, k_cols = kernel_q.shape[:2]
+    n, rows, cols, channels = x_q.shape
+    pad_top, pad_left = (k_rows - 1) // 2, (k_cols - 1) // 2
+    x_pad = np.pad(x_q, ((0, 0), (pad_top, k_rows - 1 - pad_top),
+                         (pad_left, k_cols - 1 - pad_left), (0, 0)), mode='constant')
+    kernel = kernel_q.astype(np.float32)
+    out = np.zeros((n * rows * cols, kernel.shape[-1]), dtype=np.float32)
+    for i in range(k_rows):
+        for j in range(k_cols):
+            window = x_pad[:, i:i + rows, j:j + cols, :].reshape(-1, channels)
+            out += np.dot(window.astype(np.float32), kernel[i, j])
+    return out.reshape(n, rows, cols, -1)
+
+
+def quantization_report(float_model, quantized_model, batches):
+    '''Compares float and quantized models. MSE values are means over all the frames 
+    of all the batches, without the first timestep of each sequence (as in 
+    evaluate_prediction), whatever the size of each batch.'''
+    nb_layers = float_model.nb_layers
+    modes = ['prediction'] + ['R{}'.format(l) for l in range(nb_layers)] + \
+            ['E{}'.format(l) for l in range(nb_layers)]
+    # the output modes are changed on copies, the weights are shared
+    float_model = copy.copy(float_model)
+    quantized_model = copy.copy(quantized_model)
+    float_model.output_modes = modes
+    quantized_model.output_modes = modes
+
+    n_values = 0
+    mse = {'float': 0., 'quantized': 0., 'prev': 0.}
+    drift = {mode: [0., 0.] for mode in modes}
+    for X in batches:
+        float_outputs = float_model.predict(X)
+        quantized_outputs = quantized_model.predict(X)
+        mse['float'] += np.sum((X[:, 1:] - float_outputs[0][:, 1:]) ** 2)
+        mse['quantized'] += np.sum((X[:, 1:] - quantized_outputs[0][:, 1:]) ** 2)
+        mse['prev'] += np.sum((X[:, :-1] - X[:, 1:]) ** 2)
+        n_values += X[:, 1:].size
+        for mode, f, q in zip(modes, float_outputs, quantized_outputs):
+            drift[mode][0] += np.sum((q - f) ** 2)
+            drift[mode][1] += np.sum(f ** 2)
+
+    report = {'mse_' + k: v / max(n_values, 1) for k, v in mse.items()}
+    for mode in modes:
+        squared_error, squared_norm = drift[mode]
+        report['drift_' + mode] = np.sqrt(squared_error / squared_norm) if squared_norm > 0 else 0.
+    return report
+
+def save_report(report, results_dir):
+    f = open(os.path.join(results_dir, 'quantization_report.txt'), 'w')
+    f.write('Model MSE (float32): %f\n' % report['mse_float'])
+    f.write('Model MSE (int8): %f\n' % report['mse_quantized'])
+    f.write('Previous Frame MSE: %f\n' % report['mse_prev'])
+    f.write('Relative drift (||int8 - float32|| / ||float32||):\n')
+    for key in sorted(report):
+        if key.startswith('drift_'):
+            f.write('    %s: %f\n' % (key[len('drift_'):], report[key]))
+    f.close()
+
+
+def generator_batches(data_generator, n_batches):
+    data_iterator = iter(data_generator)
+    for i in range(min(n_batches, len(data_generator))):
+        yield next(data_iterator)[0]
+
+
+if __name__ == '__main__':
+    import sys
+    import utils
+    sys.path.append("../classifier")
+    from data import DataGenerator
+
+    parser = argparse.ArgumentParser(description='Quantize PredNet to int8 and report the accuracy drift.')
+    parser.add_argument('config', help='experiment config name defined in settings.py')
+    parser.add_argument('--task', help='choose dataset to evaluate', choices=['3c', '10c', 'full'])
+    parser.add_argument('--pretrained', help='choose pre-trained model dataset', choices=['3c', '10c', 'full'])
+    parser.add_argument('--calibration_batches', type=int, default=10)
+    parser.add_argument('--eval_batches', type=int, default=100)
+    FLAGS, unparsed = parser.parse_known_args()
+    config_name, config = utils.get_config(vars(FLAGS))
+
+    float_model = load_model(config['model_json_file'], config['model_weights_file'])
+    quantized_model = load_model(config['model_json_file'], config['model_weights_file'],
+                                 model_class=QuantizedPredNet)
+
+    resize = lambda img: utils.resize_img(img, target_size=(config['input_height'],
+                                                            config['input_width']))
+    def create_generator(split):
+        data_generator = DataGenerator(classes=config['classes'],
+                                       seq_length=config['n_timesteps'],
+                                       seq_overlap=config['seq_overlap'],
+                                       min_seq_length=config['n_timesteps'],
+                                       sample_step=config['frame_step'],
+                                       rescale=config['rescale'],
+                                       fn_preprocess=resize,
+                                       batch_size=config['batch_size'],
+                                       index_start=config.get(split + '_index_start', 0),
+                                       max_per_class=config.get(split + '_max_per_class', None),
+                                       data_format=float_model.data_format)
+        return data_generator.flow_from_directory(config[split + '_data_dir'])
+
+    print('==> Calibrating on {} batches'.format(FLAGS.calibration_batches))
+    quantized_model.calibrate(generator_batches(create_generator('training'),
+                                                FLAGS.calibration_batches))
+
+    split = 'test' if config.get('test_data_dir', None) else 'validation'
+    print('==> Comparing float32 and int8 models on {} ({} batches)'.format(split, FLAGS.eval_batches))
+    report = quantization_report(float_model, quantized_model,
+                                 generator_batches(create_generator(split), FLAGS.eval_batches))
+    results_dir = utils.get_create_results_dir(config_name, config['base_results_dir'])
+    save_report(report, results_dir)
+    for key in sorted(report):
+        print('{}: {}'.format(key, report[key]))
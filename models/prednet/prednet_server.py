@@ -0,0 +1,263 @@
+'''
+Serve PredNet next-frame predictions to many concurrent video streams.
+
+Frames from different sessions are gathered into dynamic micro-batches under
+a latency budget. Each session keeps its own R and cell states between frames,
+until it is reset, idle for session_timeout seconds or the least recently used
+of more than max_sessions sessions. It then starts again from the initial states.
+
+Protocol (HTTP):
+    POST /predict?session=<id>  body: one frame saved with np.save (frame_shape of the model)
+                                response: npz file with 'prediction' (next frame) and 'errors' (per layer),
+                                500 if the batch of the frame failed
+    POST /reset?session=<id>    drops the states of a session
+    GET  /stats                 throughput and latency counters (JSON)
+'''
+import io
+import json
+import time
+import threading
+import collections
+import argparse
+import numpy as np
+
+from six.moves import BaseHTTPServer, socketserver, queue
+from six.moves.urllib.parse import urlparse, parse_qs
+
+import utils
+import prednet_model
+from prednet_stream import PredNetStream
+
+
+class MicroBatcher(object):
+    '''Gathers frames from many sessions into batches of up to max_batch_size frames.
+    A batch is run as soon as it is full or when its oldest frame has waited max_wait seconds.
+    Frames of the same session are always run in order, one per batch.
+    The states of at most max_sessions sessions are kept (least recently used 
+    dropped first), and none idle for more than session_timeout seconds.'''
+    def __init__(self, stream, max_batch_size=32, max_wait=0.01,
+                 latency_window=10000, max_sessions=256, session_timeout=300):
+        self.stream = stream
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.max_sessions = max_sessions
+        self.session_timeout = session_timeout
+        self.requests = queue.Queue()
+        # session => (r, c, last used), least recently used first
+        self.sessions = collections.OrderedDict()
+        self.n_expired = 0
+        self.lock = threading.Lock()
+        self.latencies = collections.deque(maxlen=latency_window)
+        self.batch_sizes = collections.deque(maxlen=latency_window)
+        self.n_frames = 0
+        self.start_time = time.time()
+        self.thread = threading.Thread(target=self.__run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, session, frame):
+        '''Blocks until the frame is processed and returns (prediction, errors).'''
+        request = {'session': session, 'frame': frame,
+                   'submitted': time.time(), 'done': threading.Event()}
+        self.requests.put(request)
+        request['done'].wait()
+        if 'error' in request:
+            raise request['error']
+        return request['prediction'], request['errors']
+
+    def reset(self, session):
+        with self.lock:
+            self.sessions.pop(session, None)
+
+    def __gather(self, pending):
+        batch = []
+        sessions = set()
+        deferred = []
+        for request in pending:
+            if len(batch) < self.max_batch_size and request['session'] not in sessions:
+                batch.append(request)
+                sessions.add(request['session'])
+            else:
+                deferred.append(request)
+
+        if len(batch) > 0:
+            deadline = batch[0]['submitted'] + self.max_wait
+            while len(batch) < self.max_batch_size:
+                # past the deadline, only take the frames that are already queued
+                timeout = deadline - time.time()
+                try:
+                    if timeout > 0:
+                        request = self.requests.get(timeout=timeout)
+                    else:
+                        request = self.requests.get_nowait()
+                except queue.Empty:
+                    break
+                if request['session'] in sessions:
+                    deferred.append(request)
+                else:
+                    batch.append(request)
+                    sessions.add(request['session'])
+        return batch, deferred
+
+    def __run(self):
+        pending = []
+        while True:
+            if len(pending) == 0:
+                pending.append(self.requests.get())
+            batch = []
+            try:
+                batch, pending = self.__gather(pending)
+                self.__process(batch)
+            except Exception as e:
+                if len(batch) == 0:
+                    batch, pending = pending, []
+                # the waiting handlers raise it (HTTP 500), the thread keeps serving
+                for request in batch:
+                    request['error'] = e
+                    request['done'].set()
+
+    def __process(self, batch):
+        nb_layers = self.stream.prednet.nb_layers
+        with self.lock:
+            for request in batch:
+                if request['session'] not in self.sessions:
+                    r, c, _ = self.stream.initial_states()
+                    self.sessions[request['session']] = (r, c, None)
+            states = [self.sessions[request['session']] for request in batch]
+
+        frames = np.stack([request['frame'] for request in batch])
+        r = [np.concatenate([s[0][l] for s in states]) for l in range(nb_layers)]
+        c = [np.concatenate([s[1][l] for s in states]) for l in range(nb_layers)]
+        prediction, errors, r, c = self.stream.run(frames, r, c)
+
+        done = time.time()
+        with self.lock:
+            for i, request in enumerate(batch):
+                # moved to the most recently used end
+                self.sessions.pop(request['session'], None)
+                self.sessions[request['session']] = ([r_l[i:i+1] for r_l in r],
+                                                     [c_l[i:i+1] for c_l in c], done)
+                request['prediction'] = prediction[i]
+                request['errors'] = errors[i]
+                self.latencies.append(done - request['submitted'])
+            self.batch_sizes.append(len(batch))
+            self.n_frames += len(batch)
+            self.__expire_sessions(done)
+
+        for request in batch:
+            request['done'].set()
+
+    def __expire_sessions(self, now):
+        while len(self.sessions) > 0:
+            session = next(iter(self.sessions))
+            last_used = self.sessions[session][2]
+            if len(self.sessions) <= self.max_sessions and (
+                    not self.session_timeout or now - last_used <= self.session_timeout):
+                break
+            del self.sessions[session]
+            self.n_expired += 1
+
+    def stats(self):
+        with self.lock:
+            latencies = np.array(self.latencies)
+            stats = {'frames': self.n_frames,
+                     'sessions': len(self.sessions),
+                     'expired_sessions': self.n_expired,
+                     'throughput': self.n_frames / (time.time() - self.start_time)}
+            if len(latencies) > 0:
+                stats.update({'mean_batch_size': float(np.mean(self.batch_sizes)),
+                              'latency_mean': float(latencies.mean()),
+                              'latency_p50': float(np.percentile(latencies, 50)),
+                              'latency_p99': float(np.percentile(latencies, 99))})
+        return stats
+
+
+class PredictionHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def __send(self, body, content_type, status=200):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if urlparse(self.path).path != '/stats':
+            return self.send_error(404)
+        body = json.dumps(self.server.batcher.stats()).encode('utf-8')
+        self.__send(body, 'application/json')
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        session = parse_qs(url.query).get('session', [None])[0]
+        if session is None:
+            return self.send_error(400, 'Missing session')
+
+        if url.path == '/reset':
+            self.server.batcher.reset(session)
+            return self.__send(b'', 'text/plain')
+        elif url.path != '/predict':
+            return self.send_error(404)
+
+        length = int(self.headers['Content-Length'])
+        try:
+            frame = np.load(io.BytesIO(self.rfile.read(length)))
+        except Exception:
+            return self.send_error(400, 'Expected a frame saved with np.save')
+        if frame.shape != self.server.batcher.stream.frame_shape:
+            msg = 'Expected frame of shape {}, got {}'
+            return self.send_error(400, msg.format(self.server.batcher.stream.frame_shape, frame.shape))
+
+        try:
+            prediction, errors = self.server.batcher.submit(session, frame)
+        except Exception as e:
+            # first line only, the message goes in the status line
+            return self.send_error(500, '{}: {}'.format(type(e).__name__, str(e).split('\n')[0]))
+        out = io.BytesIO()
+        np.savez(out, prediction=prediction, errors=errors)
+        self.__send(out.getvalue(), 'application/octet-stream')
+
+    def log_message(self, format, *args):
+        pass
+
+
+class PredictionServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128  # many streams connect at the same time
+
+    def __init__(self, address, batcher):
+        BaseHTTPServer.HTTPServer.__init__(self, address, PredictionHandler)
+        self.batcher = batcher
+
+
+def create_batcher(max_batch_size=32, max_wait=0.01, max_sessions=256, 
+                   session_timeout=300, **config):
+    config.update({'n_timesteps': 1, 'output_mode': 'prediction',
+                   'stateful': False, 'batch_size': None, 'train': False})
+    model = prednet_model.create_model(**config)
+    stream = PredNetStream(model.layers[1], batch_size=max_batch_size)
+    return MicroBatcher(stream, max_batch_size=max_batch_size, max_wait=max_wait, 
+                        max_sessions=max_sessions, session_timeout=session_timeout)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve PredNet next-frame predictions.')
+    parser.add_argument('config', help='experiment config name defined in settings.py')
+    parser.add_argument('--pretrained', help='choose pre-trained model dataset', choices=['3c', '10c', 'full'])
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--max_batch_size', type=int, default=32)
+    parser.add_argument('--max_wait', type=float, default=0.01, help='latency budget (seconds) to fill a batch')
+    parser.add_argument('--max_sessions', type=int, default=256, 
+                        help='sessions whose states are kept, the least recently used are dropped')
+    parser.add_argument('--session_timeout', type=float, default=300, 
+                        help='seconds after which the states of an idle session are dropped (0 to keep them)')
+    FLAGS, unparsed = parser.parse_known_args()
+    config_name, config = utils.get_config(vars(FLAGS))
+
+    batcher = create_batcher(max_batch_size=FLAGS.max_batch_size,
+                             max_wait=FLAGS.max_wait, max_sessions=FLAGS.max_sessions,
+                             session_timeout=FLAGS.session_timeout, **config)
+    server = PredictionServer((FLAGS.host, FLAGS.port), batcher)
+    print('==> Serving {} on {}:{}'.format(config_name, FLAGS.host, FLAGS.port))
+    server.serve_forever()
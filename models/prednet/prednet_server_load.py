@@ -0,0 +1,75 @@
+'''
+Load generator for prednet_server.py.
+
+Simulates concurrent video streams, each one sending frames to its own
+session, and reports the client-side throughput and latency.
+'''
+import io
+import json
+import time
+import threading
+import argparse
+import numpy as np
+
+from six.moves.urllib.request import urlopen, Request
+
+
+def send_frame(url, session, frame):
+    body = io.BytesIO()
+    np.save(body, frame)
+    request = Request('{}/predict?session={}'.format(url, session), data=body.getvalue())
+    response = np.load(io.BytesIO(urlopen(request).read()))
+    return response['prediction'], response['errors']
+
+
+def run_session(url, session, frame_shape, n_frames, fps, latencies):
+    interval = 1. / fps if fps else 0
+    frame = np.random.rand(*frame_shape).astype(np.float32)
+    for i in range(n_frames):
+        start = time.time()
+        send_frame(url, session, frame)
+        latency = time.time() - start
+        latencies.append(latency)
+        if interval > latency:
+            time.sleep(interval - latency)
+    urlopen(Request('{}/reset?session={}'.format(url, session), data=b''))
+
+
+def load_test(url, frame_shape, n_sessions=16, n_frames=100, fps=None):
+    latencies = []
+    threads = [threading.Thread(target=run_session,
+                                args=(url, 'load_{}'.format(i), frame_shape,
+                                      n_frames, fps, latencies))
+               for i in range(n_sessions)]
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - start
+
+    latencies = np.array(latencies)
+    results = {'frames': len(latencies),
+               'throughput': len(latencies) / elapsed,
+               'latency_mean': latencies.mean(),
+               'latency_p50': np.percentile(latencies, 50),
+               'latency_p99': np.percentile(latencies, 99)}
+    results['server'] = json.loads(urlopen(url + '/stats').read().decode('utf-8'))
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load test the PredNet prediction server.')
+    parser.add_argument('--url', default='http://localhost:8000')
+    parser.add_argument('--sessions', type=int, default=16, help='number of concurrent streams')
+    parser.add_argument('--frames', type=int, default=100, help='frames sent per stream')
+    parser.add_argument('--fps', type=float, help='frame rate of each stream (default: as fast as possible)')
+    parser.add_argument('--frame_shape', type=int, nargs=3, default=[128, 160, 3])
+    FLAGS = parser.parse_args()
+
+    results = load_test(FLAGS.url, tuple(FLAGS.frame_shape), FLAGS.sessions,
+                        FLAGS.frames, FLAGS.fps)
+    print('==> Client: {} frames, {:.1f} frames/s, latency mean {:.4f}s, p50 {:.4f}s, p99 {:.4f}s'.format(
+        results['frames'], results['throughput'], results['latency_mean'],
+        results['latency_p50'], results['latency_p99']))
+    print('==> Server: {}'.format(results['server']))
@@ -0,0 +1,157 @@
+'''
+Next-frame prediction on a live video stream, one frame at a time.
+'''
+import time
+import collections
+import numpy as np
+
+from keras import backend as K
+
+import prednet_model
+
+
+class PredNetStream(object):
+    '''Runs a trained PredNet on one frame at a time, keeping the R, cell 
+    and error states between calls.
+
+    Each call to `predict` takes the frames at time t (one per stream in the batch)
+    and returns the prediction of the frames at time t+1, together with the errors of
+    the prediction made for time t (mean E response of each layer, as in output_mode 'error').
+    The top-down R update of a timestep only depends on the states, so it is computed
+    right after the errors of the previous frame and each frame costs a single PredNet step.
+
+    # Arguments
+        prednet: a built PredNet layer, ex. `model.layers[1]` of a model created by `prednet_model`.
+        batch_size: number of streams processed together. Each stream keeps its own states.
+        latency_budget: per-frame latency budget in seconds. Frames over budget are counted in `stats()`.
+        latency_window: number of recent frames used for the latency statistics.
+        warmup: if True, run one frame at construction time so that the session setup 
+            is not paid by the first frame of the stream.
+    '''
+    def __init__(self, prednet, batch_size=1, latency_budget=None, 
+                 latency_window=1000, warmup=True):
+        self.prednet = prednet
+        self.batch_size = batch_size
+        self.latency_budget = latency_budget
+        self.frame_shape = tuple(prednet.input_spec[0].shape[2:])
+        self.latencies = collections.deque(maxlen=latency_window)
+        self.n_frames = 0
+        self.n_over_budget = 0
+        self.__build()
+        
+        if warmup:
+            r, c, _ = self.initial_states(batch_size)
+            self.run(np.zeros((batch_size,) + self.frame_shape, np.float32), r, c)
+        self.reset()
+        self.reset_stats()
+        
+    def __state_shape(self, stack_size, l):
+        nb_row = self.frame_shape[self.prednet.row_axis] // 2**l
+        nb_col = self.frame_shape[self.prednet.column_axis] // 2**l
+        if self.prednet.data_format == 'channels_first':
+            return (stack_size, nb_row, nb_col)
+        return (nb_row, nb_col, stack_size)
+    
+    def __build(self):
+        prednet = self.prednet
+        nb_layers = prednet.nb_layers
+        r_shapes = [self.__state_shape(prednet.R_stack_sizes[l], l) for l in range(nb_layers)]
+        e_shapes = [self.__state_shape(2 * prednet.stack_sizes[l], l) for l in range(nb_layers)]
+        
+        frame = K.placeholder((None,) + self.frame_shape)
+        r = [K.placeholder((None,) + shape) for shape in r_shapes]
+        c = [K.placeholder((None,) + shape) for shape in r_shapes]
+        e = [K.placeholder((None,) + shape) for shape in e_shapes]
+        # states are fed and returned in floatx, but computed in the PredNet compute_dtype
+        to_compute = lambda xs: [K.cast(x, prednet.compute_dtype) for x in xs]
+        to_floatx = lambda xs: [K.cast(x, K.floatx()) for x in xs]
+        
+        # R units and prediction for the first frame, from zero states
+        r_0, c_0 = prednet.update_representation(*[to_compute(x) for x in [r, c, e]])
+        self.__initial_fn = K.function(r + c + e, to_floatx(r_0 + c_0 + [prednet.predict_frame(r_0)]))
+        
+        # errors of the current frame, then R units and prediction for the next one
+        r_t, c_t = to_compute(r), to_compute(c)
+        e_t, _, _ = prednet.update_errors(to_compute([frame])[0], r_t)
+        errors = [K.mean(K.batch_flatten(e_l), axis=-1, keepdims=True) for e_l in e_t]
+        r_tp1, c_tp1 = prednet.update_representation(r_t, c_t, e_t)
+        self.__frame_fn = K.function([frame] + r + c, 
+                                     to_floatx([K.concatenate(errors, axis=-1), prednet.predict_frame(r_tp1)] + 
+                                               r_tp1 + c_tp1))
+        
+        zeros = [np.zeros((1,) + shape, np.float32) for shape in r_shapes + r_shapes + e_shapes]
+        initial = self.__initial_fn(zeros)
+        self.initial_r = initial[:nb_layers]
+        self.initial_c = initial[nb_layers:2*nb_layers]
+        self.initial_prediction = initial[-1]
+        
+    def initial_states(self, n=1):
+        '''Returns (r, c, prediction) for n new streams.'''
+        tile = lambda x: np.repeat(x, n, axis=0)
+        return ([tile(r_l) for r_l in self.initial_r], 
+                [tile(c_l) for c_l in self.initial_c], 
+                tile(self.initial_prediction))
+        
+    def run(self, frames, r, c):
+        '''Runs one step for a batch of frames with the given states, without 
+        changing the states of this stream. Returns (prediction, errors, r, c), 
+        where r and c are the updated states.'''
+        nb_layers = self.prednet.nb_layers
+        outputs = self.__frame_fn([frames] + list(r) + list(c))
+        errors, prediction = outputs[:2]
+        return prediction, errors, outputs[2:2+nb_layers], outputs[2+nb_layers:]
+        
+    def reset(self, streams=None):
+        '''Resets the states of the given stream indices (all streams by default), 
+        ex. when a stream moves to a new video.'''
+        if streams is None:
+            self.r, self.c, self.prediction = self.initial_states(self.batch_size)
+            return
+        
+        for i in streams:
+            for l in range(self.prednet.nb_layers):
+                self.r[l][i] = self.initial_r[l][0]
+                self.c[l][i] = self.initial_c[l][0]
+            self.prediction[i] = self.initial_prediction[0]
+            
+    def predict(self, frames):
+        '''Feeds the frames at time t and returns (prediction for t+1, errors for t).
+        frames has shape (batch_size,) + frame_shape, or frame_shape if batch_size is 1.'''
+        single = frames.ndim == len(self.frame_shape)
+        if single:
+            frames = frames[np.newaxis]
+        
+        start = time.time()
+        self.prediction, errors, self.r, self.c = self.run(frames, self.r, self.c)
+        latency = time.time() - start
+        
+        self.latencies.append(latency)
+        self.n_frames += 1
+        if self.latency_budget and latency > self.latency_budget:
+            self.n_over_budget += 1
+        
+        if single:
+            return self.prediction[0], errors[0]
+        return self.prediction, errors
+    
+    def reset_stats(self):
+        self.latencies.clear()
+        self.n_frames = 0
+        self.n_over_budget = 0
+        
+    def stats(self):
+        '''Per-frame latency statistics (in seconds) over the recent frames.'''
+        latencies = np.array(self.latencies)
+        if len(latencies) == 0:
+            return {'frames': self.n_frames}
+        return {'frames': self.n_frames,
+                'mean': latencies.mean(),
+                'p50': np.percentile(latencies, 50),
+                'p99': np.percentile(latencies, 99),
+                'max': latencies.max(),
+                'over_budget': self.n_over_budget}
+    
+
+def load_stream(model_json_file, model_weights_file, **kwargs):
+    model = prednet_model.load_model(model_json_file, model_weights_file)
+    return PredNetStream(model.layers[1], **kwargs)
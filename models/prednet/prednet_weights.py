@@ -0,0 +1,138 @@
+'''
+PredNet weight layouts and checkpoint readers that do not depend on Keras.
+'''
+import json
+import numpy as np
+
+# order of the gates in the output channels of a fused LSTM convolution
+LSTM_GATES = ['i', 'f', 'c', 'o']
+
+
+def pack_gate_weights(weights, nb_layers):
+    '''Converts weights of an unfused PredNet into the fused gates layout.
+
+    Weights are ordered by sorted conv layer name and then by layer, i.e.
+    a, ahat, c, f, i, o for an unfused model and a, ahat, lstm for a fused one.
+    '''
+    n = 2 * nb_layers  # kernel and bias per layer
+    n_a = 2 * (nb_layers - 1)
+    legacy = {'a': weights[:n_a], 'ahat': weights[n_a:n_a + n]}
+    for k, c in enumerate(sorted(LSTM_GATES)):
+        start = n_a + n * (k + 1)
+        legacy[c] = weights[start:start + n]
+
+    packed = []
+    for l in range(nb_layers):
+        for w in range(2):
+            packed.append(np.concatenate([legacy[c][2 * l + w] for c in LSTM_GATES], axis=-1))
+    return list(legacy['a']) + list(legacy['ahat']) + packed
+
+
+def conv_weights(weights, nb_layers, fused_gates=False):
+    '''Maps the flat PredNet weight list to {conv_name: [(kernel, bias) per layer]},
+    with the LSTM gates always in the fused layout (conv_name 'lstm').'''
+    if not fused_gates:
+        weights = pack_gate_weights(weights, nb_layers)
+    convs = {}
+    index = 0
+    for c, n in [('a', nb_layers - 1), ('ahat', nb_layers), ('lstm', nb_layers)]:
+        convs[c] = [(weights[index + 2 * l], weights[index + 2 * l + 1]) for l in range(n)]
+        index += 2 * n
+    return convs
+
+
+def read_model_config(model_json_file):
+    '''Returns (PredNet layer name, PredNet layer config, model input shape)
+    from a model saved with model.to_json().'''
+    with open(model_json_file, 'r') as f:
+        model_config = json.load(f)
+
+    layers = model_config['config']['layers']
+    for layer in layers:
+        if layer['class_name'] == 'PredNet':
+            input_shape = layers[0]['config']['batch_input_shape']
+            return layer['config']['name'], layer['config'], tuple(input_shape)
+    raise ValueError('No PredNet layer found in {}'.format(model_json_file))
+
+
+def read_hdf5_weights(model_weights_file, layer_name):
+    '''Reads the weights of one layer from a Keras HDF5 weights file,
+    in the same order as layer.get_weights().'''
+    import h5py
+
+    def decode(name):
+        return name.decode('utf8') if isinstance(name, bytes) else name
+
+    with h5py.File(model_weights_file, 'r') as f:
+        if 'model_weights' in f:  # saved with model.save
+            f = f['model_weights']
+        layer_names = [decode(n) for n in f.attrs['layer_names']]
+        if layer_name not in layer_names:
+            raise ValueError('Layer {} not found in {}'.format(layer_name, model_weights_file))
+        g = f[layer_name]
+        return [np.asarray(g[decode(n)]) for n in g.attrs['weight_names']]
+
+
+# compact weight file: magic, header size (uint64), json header, then the
+# float32 weights one after the other, starting at a multiple of COMPACT_ALIGN
+COMPACT_MAGIC = b'PREDNETW'
+COMPACT_ALIGN = 64
+
+def save_compact_weights(compact_file, layer_config, weights, batch_input_shape):
+    '''Writes the PredNet layer config, the model input shape and the layer
+    weights to a single file that can be loaded with load_compact_weights.'''
+    weights = [np.asarray(w, dtype=np.float32) for w in weights]
+    shapes = [list(w.shape) for w in weights]
+    header = json.dumps({'config': layer_config, 
+                         'batch_input_shape': list(batch_input_shape),
+                         'dtype': 'float32', 'shapes': shapes}).encode('utf8')
+    data_offset = len(COMPACT_MAGIC) + 8 + len(header)
+    padding = -data_offset % COMPACT_ALIGN
+    with open(compact_file, 'wb') as f:
+        f.write(COMPACT_MAGIC)
+        f.write(np.array(len(header) + padding, dtype='<u8').tobytes())
+        f.write(header + b' ' * padding)
+        for w in weights:
+            f.write(np.ascontiguousarray(w, dtype='<f4').tobytes())
+
+def load_compact_weights(compact_file):
+    '''Returns (layer config, weights, batch input shape) from a file written by
+    save_compact_weights. Weights are read-only views of one np.memmap, so the
+    pages are shared by all the processes that load the same file.'''
+    with open(compact_file, 'rb') as f:
+        if f.read(len(COMPACT_MAGIC)) != COMPACT_MAGIC:
+            raise ValueError('{} is not a compact PredNet weight file'.format(compact_file))
+        header_size = int(np.frombuffer(f.read(8), dtype='<u8')[0])
+        header = json.loads(f.read(header_size).decode('utf8'))
+
+    data_offset = len(COMPACT_MAGIC) + 8 + header_size
+    sizes = [int(np.prod(shape)) for shape in header['shapes']]
+    data = np.memmap(compact_file, dtype='<f4', mode='r', 
+                     offset=data_offset, shape=(sum(sizes),))
+    weights = []
+    index = 0
+    for shape, size in zip(header['shapes'], sizes):
+        weights.append(data[index:index + size].reshape(shape))
+        index += size
+    return header['config'], weights, tuple(header['batch_input_shape'])
+
+def export_compact_weights(model_json_file, model_weights_file, compact_file):
+    '''Converts a json/HDF5 checkpoint saved by train.py to a compact weight file.'''
+    layer_name, config, batch_input_shape = read_model_config(model_json_file)
+    weights = read_hdf5_weights(model_weights_file, layer_name)
+    save_compact_weights(compact_file, config, weights, batch_input_shape)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Export a PredNet checkpoint to a compact weight file.')
+    parser.add_argument('model_json_file')
+    parser.add_argument('model_weights_file')
+    parser.add_argument('compact_file', nargs='?', 
+                        help='default: model_weights_file with the .prednet extension')
+    FLAGS = parser.parse_args()
+    
+    import os
+    compact_file = FLAGS.compact_file or os.path.splitext(FLAGS.model_weights_file)[0] + '.prednet'
+    export_compact_weights(FLAGS.model_json_file, FLAGS.model_weights_file, compact_file)
+    print('==> Saved {}'.format(compact_file))
@@ -0,0 +1,71 @@
+'''
+TensorFlow session setup of the training, evaluation and extraction scripts.
+
+The session is created when a script calls `setup_session`, not when a module
+is imported. The thread pools are chosen per phase ('train', 'eval' or
+'extract') with the config key `<phase>_threads`, an (intra_op, inter_op)
+pair where 0 lets TensorFlow use all the cores, or the `--<phase>_threads`
+flag added by `add_arguments`.
+
+Training is deterministic by default: the TensorFlow seed is set and the
+deterministic op implementations are requested where the TensorFlow version
+has them. Single-threaded pools (the training default) also keep the
+results reproducible; more threads may change the order of the reductions.
+'''
+import os
+
+PHASES = ['train', 'eval', 'extract']
+
+# (intra_op, inter_op) threads of each phase, 0 for all the cores
+DEFAULT_THREADS = {'train': (1, 1), 'eval': (0, 0), 'extract': (0, 0)}
+
+SEED = 1234
+
+
+def add_arguments(parser, phases=PHASES):
+    for phase in phases:
+        parser.add_argument('--{}_threads'.format(phase), type=int, nargs=2,
+                            metavar=('INTRA_OP', 'INTER_OP'),
+                            help='TensorFlow threads of the {} phase, 0 for all the cores'.format(phase))
+    parser.add_argument('--deterministic', action='store_true',
+                        help='seeded and deterministic ops in every phase (training always is)')
+
+def update_config(config, flags):
+    '''Copies the flags of add_arguments to the config.'''
+    for phase in PHASES:
+        key = phase + '_threads'
+        if flags.get(key, None):
+            config[key] = tuple(flags[key])
+    if flags.get('deterministic', False):
+        config['deterministic'] = True
+    return config
+
+def session_threads(phase, config=None):
+    config = config or {}
+    return tuple(config.get(phase + '_threads', None) or DEFAULT_THREADS[phase])
+
+def setup_session(phase, config=None):
+    '''Creates the Keras session of the phase in a new graph and returns it.'''
+    import tensorflow as tf
+    from keras import backend as K
+
+    config = config or {}
+    intra_op_threads, inter_op_threads = session_threads(phase, config)
+    deterministic = config.get('deterministic', False) or phase == 'train'
+
+    K.clear_session()
+    if deterministic:
+        # deterministic kernels (TensorFlow >= 1.14, GPU)
+        os.environ['TF_DETERMINISTIC_OPS'] = '1'
+        experimental = getattr(getattr(tf, 'config', None), 'experimental', None)
+        if hasattr(experimental, 'enable_op_determinism'):
+            experimental.enable_op_determinism()
+        tf.set_random_seed(SEED)
+    session_conf = tf.ConfigProto(intra_op_parallelism_threads=intra_op_threads,
+                                  inter_op_parallelism_threads=inter_op_threads)
+    sess = tf.Session(graph=tf.get_default_graph(), config=session_conf)
+    K.set_session(sess)
+    print('==> TensorFlow session for {}: {} intra-op, {} inter-op threads{}'.format(
+        phase, intra_op_threads or 'all', inter_op_threads or 'all',
+        ', deterministic' if deterministic else ''))
+    return sess
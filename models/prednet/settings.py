@@ -68,12 +68,25 @@ eval_base_config = {
     'timestep_start': -1,
     'batch_size': 1,
     'stateful': False,
+    # batch sequences of similar length and drop the padding past the longest one (with pad_sequences)
+    'bucket_by_length': False,
     'input_channels': 3, 
     'input_height': 128, 
     'input_width': 160,
     'rescale': 1./255,
     'shuffle': False,
     'workers': 4,
+    # TensorFlow (intra_op, inter_op) threads, 0 for all the cores, see session_config.py
+    'eval_threads': (0, 0),
+    'extract_threads': (0, 0),
+    # directory of the resized frames cached as uint8 (ex. './frame_cache/'), None to disable
+    'frame_cache_dir': None,
+    # directory of the sequence indexes of the data directories (ex. './sequence_index/'), None to disable
+    'sequence_index_dir': None,
+    # threads decoding the frames of each batch in every generator worker, None to decode serially
+    'decode_threads': 4,
+    # bytes of decoded frames kept in memory, the frames shared by overlapping sequences are decoded once
+    'frame_lru_bytes': 64 * 2**20,
     # DATA
     'training_data_dir': os.path.join(DATA_DIR, 'training'),
     'validation_data_dir': os.path.join(DATA_DIR, 'validation'),
@@ -151,6 +164,11 @@ add_config(configs, 'prednet_kitti_finetuned_moments__prediction',
              'model_name': 'prednet_kitti_finetuned_moments',
              'output_mode': 'prediction' }, eval_base_config)
 
+add_config(configs, 'prednet_kitti_finetuned_moments__prediction_representation', 
+           { 'description': 'Using PredNet pre-trained on Moments in Time dataset to evaluate predictions and extract features in a single pass.',
+             'model_name': 'prednet_kitti_finetuned_moments',
+             'output_mode': ['prediction', 'representation'] }, eval_base_config)
+
 add_config(configs, 'prednet_random_finetuned_moments__representation', 
            { 'description': 'Using PredNet pre-trained on Moments in Time dataset to extract features.',
              'model_name': 'prednet_random_finetuned_moments',
@@ -200,6 +218,20 @@ add_config(configs, 'prednet_kitti_finetuned_moments__ucf_01__representation',
              'training_max_per_class': None,
              'output_mode': 'representation' }, eval_base_config)
 
+add_config(configs, 'prednet_kitti_finetuned_moments__ucf_01__representation__dynamic_size', 
+           { 'description': 'Using PredNet pre-trained on Moments in Time dataset to extract features from the UCF-101 frames at their original size.',
+             'model_name': 'prednet_kitti_finetuned_moments',
+             'training_data_dir': os.path.join(UCF_DATA_DIR, 'train_01'),
+             'validation_data_dir': os.path.join(UCF_DATA_DIR, 'test_01'),
+             'task': 'full',
+             'min_seq_length': 5,
+             'pad_sequences': True,
+             'pretrained': 'full',
+             'training_index_start': 0,
+             'training_max_per_class': None,
+             'dynamic_size': True,
+             'output_mode': 'representation' }, eval_base_config)
+
 add_config(configs, 'prednet_random__ucf_01_audio__representation', 
            { 'description': 'Using PredNet (random weights) to extract audio features.',
              'model_name': 'prednet_random_finetuned_moments_audio',
@@ -275,6 +307,14 @@ train_base_config.update({
     'batch_size': 2 * SEQUENCES_PER_VIDEO,
     'shuffle': True,
     'task': '10c',
+    # weights of the layer errors in the loss: 'L_0', 'L_all' or one weight per layer
+    'layer_loss_weights': 'L_all',
+    # single threaded for reproducible results
+    'train_threads': (1, 1),
+    # batches between full training checkpoints (train.py --resume)
+    'checkpoint_every': 200,
+    # one weight per timestep, None to equally weight all timesteps but the first
+    'time_loss_weights': None,
     #'gpus': 2,
     #'stopping_patience': 100,
     'training_index_start': 0,
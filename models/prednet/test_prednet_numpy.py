@@ -0,0 +1,94 @@
+'''
+Parity of NumpyPredNet (prednet_numpy.py) with the Keras PredNet layer, on
+random weights, for every output mode, for frames whose size is not a
+multiple of 2**(nb_layers - 1) and when extrapolating. Skipped without Keras.
+
+> python -m pytest test_prednet_numpy.py
+'''
+import unittest
+import numpy as np
+
+try:
+    import keras
+except ImportError:
+    keras = None
+
+if keras is not None:
+    from keras import backend as K
+    from keras.layers import Input
+    from keras.models import Model
+    from prednet import PredNet
+    import prednet_model
+    import prednet_numpy
+
+OUTPUT_MODES = ['error', 'all', 'prediction', 'representation', 
+                'pooled_representation', 'Ahat0', 'A1', 'R2', 'E1']
+STACK_SIZES = (3, 4, 6)
+
+
+@unittest.skipIf(keras is None, 'Keras is not installed')
+class NumpyPredNetParityTest(unittest.TestCase):
+
+    def setUp(self):
+        K.clear_session()
+        self.random_state = np.random.RandomState(0)
+
+    def keras_model(self, input_size, output_mode, train=False, **config):
+        model = prednet_model.create_model(train=train, n_timesteps=3, input_channels=3,
+                                           input_height=input_size[0], input_width=input_size[1],
+                                           output_mode=output_mode, stack_sizes=STACK_SIZES, **config)
+        layer = model.layers[1]
+        weights = [0.3 * self.random_state.randn(*w.shape).astype(np.float32) for w in layer.get_weights()]
+        layer.set_weights(weights)
+        return model
+
+    def check(self, input_size, output_mode):
+        model = self.keras_model(input_size, output_mode)
+        layer = model.layers[1]
+        numpy_model = prednet_numpy.create_model(layer.get_config(), layer.get_weights())
+        X = self.random_state.rand(2, 3, input_size[0], input_size[1], 3).astype(np.float32)
+        expected = model.predict(X)
+        output = numpy_model.predict(X)
+        self.assertEqual(output.shape, expected.shape, output_mode)
+        np.testing.assert_allclose(output, expected, rtol=1e-4, atol=1e-5, err_msg=output_mode)
+
+    def test_output_modes(self):
+        for output_mode in OUTPUT_MODES:
+            self.check((16, 20), output_mode)
+
+    def test_output_modes_padded_frames(self):
+        # not multiples of 4, padded and cropped
+        for output_mode in OUTPUT_MODES:
+            self.check((13, 18), output_mode)
+
+    def test_extrapolation(self):
+        # from t=0 the first frame is the zero initial prediction
+        for input_size in [(16, 20), (13, 18)]:
+            for extrap_start_time in [0, 2]:
+                for output_mode in ['prediction', 'error']:
+                    layer = self.keras_model(input_size, output_mode).layers[1]
+                    config = dict(layer.get_config(), extrap_start_time=extrap_start_time)
+                    extrap_layer = PredNet.from_config(config)
+                    inputs = Input(shape=(3,) + tuple(input_size) + (3,))
+                    model = Model(inputs, extrap_layer(inputs))
+                    extrap_layer.set_weights(layer.get_weights())
+                    numpy_model = prednet_numpy.create_model(config, layer.get_weights())
+                    X = self.random_state.rand(2, 3, input_size[0], input_size[1], 3).astype(np.float32)
+                    np.testing.assert_allclose(numpy_model.predict(X), model.predict(X), rtol=1e-4, atol=1e-5,
+                                               err_msg='{} {} {}'.format(input_size, extrap_start_time, output_mode))
+
+    def test_inference_errors_of_all_layers(self):
+        # a model trained on the errors of the first layer only outputs 
+        # the errors of all the layers for inference, as prednet_model
+        train_model = self.keras_model((16, 20), 'error', train=True, layer_loss_weights='L_0')
+        layer = train_model.layers[1]
+        self.assertEqual(layer.get_config()['error_layers'], [0])
+        numpy_model = prednet_numpy.create_model(layer.get_config(), layer.get_weights(), 
+                                                 output_mode='error')
+        X = self.random_state.rand(2, 3, 16, 20, 3).astype(np.float32)
+        nb_layers = len(layer.get_config()['stack_sizes'])
+        self.assertEqual(numpy_model.predict(X).shape, (2, 3, nb_layers))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+'''
+Round trips of the prediction server (prednet_server.py) over HTTP, with a 
+batcher built by create_batcher on a PredNet with random weights: predictions 
+and session states, session expiry and failed batches. Skipped without Keras.
+
+> python -m pytest test_prednet_server.py
+'''
+import io
+import time
+import threading
+import unittest
+import numpy as np
+
+from six.moves import http_client
+
+try:
+    import keras
+except ImportError:
+    keras = None
+
+if keras is not None:
+    from keras import backend as K
+    import prednet_server
+
+FRAME_SHAPE = (16, 24, 3)
+
+
+@unittest.skipIf(keras is None, 'Keras is not installed')
+class PredictionServerTest(unittest.TestCase):
+
+    def setUp(self):
+        K.clear_session()
+        self.batcher = prednet_server.create_batcher(max_batch_size=4, max_wait=0.01, 
+                                                     max_sessions=2, session_timeout=60,
+                                                     input_channels=3, input_height=FRAME_SHAPE[0], 
+                                                     input_width=FRAME_SHAPE[1], 
+                                                     stack_sizes=(3, 4, 6), cache=False)
+        self.server = prednet_server.PredictionServer(('localhost', 0), self.batcher)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.random_state = np.random.RandomState(0)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def post(self, path, frame=None):
+        body = b''
+        if frame is not None:
+            buffer = io.BytesIO()
+            np.save(buffer, frame)
+            body = buffer.getvalue()
+        conn = http_client.HTTPConnection('localhost', self.server.server_address[1])
+        conn.request('POST', path, body)
+        response = conn.getresponse()
+        body = response.read()
+        conn.close()
+        if response.status != 200:
+            return response.status, None
+        return response.status, np.load(io.BytesIO(body)) if body else None
+
+    def frame(self):
+        return self.random_state.rand(*FRAME_SHAPE).astype(np.float32)
+
+    def test_predict(self):
+        stream = self.batcher.stream
+        r, c, _ = stream.initial_states()
+        for t in range(3):
+            frame = self.frame()
+            status, outputs = self.post('/predict?session=a', frame)
+            self.assertEqual(status, 200)
+            # the states of the session are carried between the requests
+            expected, errors, r, c = stream.run(frame[np.newaxis], r, c)
+            np.testing.assert_allclose(outputs['prediction'], expected[0], rtol=1e-5, atol=1e-6)
+            np.testing.assert_allclose(outputs['errors'], errors[0], rtol=1e-5, atol=1e-6)
+        self.assertEqual(self.post('/reset?session=a')[0], 200)
+        self.assertEqual(len(self.batcher.sessions), 0)
+
+    def test_session_expiry(self):
+        for session in 'abc':
+            self.assertEqual(self.post('/predict?session=' + session, self.frame())[0], 200)
+        # least recently used dropped past max_sessions
+        self.assertEqual(list(self.batcher.sessions), ['b', 'c'])
+        self.batcher.session_timeout = 0.2
+        time.sleep(0.3)
+        self.assertEqual(self.post('/predict?session=d', self.frame())[0], 200)
+        self.assertEqual(list(self.batcher.sessions), ['d'])
+        self.assertEqual(self.batcher.stats()['expired_sessions'], 3)
+
+    def test_failed_batch(self):
+        status, outputs = self.post('/predict?session=a', self.frame())
+        states = self.batcher.sessions['a']
+        # right shape, but the model can't be fed strings
+        status, _ = self.post('/predict?session=a', np.full(FRAME_SHAPE, 'x'))
+        self.assertEqual(status, 500)
+        self.assertIs(self.batcher.sessions['a'], states)
+        # the batcher keeps serving
+        self.assertEqual(self.post('/predict?session=a', self.frame())[0], 200)
+        self.assertEqual(self.post('/predict', self.frame())[0], 400)
+        conn = http_client.HTTPConnection('localhost', self.server.server_address[1])
+        conn.request('POST', '/predict?session=a', b'not a frame')
+        self.assertEqual(conn.getresponse().status, 400)
+        conn.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+'''
+PredNetStream (prednet_stream.py), built with its default arguments, against 
+the 'prediction' output of the Keras PredNet layer on the same frames. 
+Skipped without Keras.
+
+> python -m pytest test_prednet_stream.py
+'''
+import unittest
+import numpy as np
+
+try:
+    import keras
+except ImportError:
+    keras = None
+
+if keras is not None:
+    from keras import backend as K
+    import prednet_model
+    from prednet_stream import PredNetStream
+
+N_TIMESTEPS = 4
+
+
+@unittest.skipIf(keras is None, 'Keras is not installed')
+class PredNetStreamTest(unittest.TestCase):
+
+    def setUp(self):
+        K.clear_session()
+        self.random_state = np.random.RandomState(0)
+        self.model = prednet_model.create_model(train=False, n_timesteps=N_TIMESTEPS, input_channels=3,
+                                                input_height=16, input_width=24, output_mode='prediction',
+                                                stack_sizes=(3, 4, 6), cache=False)
+        layer = self.model.layers[1]
+        layer.set_weights([0.3 * self.random_state.randn(*w.shape).astype(np.float32) 
+                           for w in layer.get_weights()])
+
+    def test_default_stream(self):
+        stream = PredNetStream(self.model.layers[1])
+        X = self.random_state.rand(1, N_TIMESTEPS, 16, 24, 3).astype(np.float32)
+        # the prediction of frame t is made from the frames before t
+        expected = self.model.predict(X)[0]
+        np.testing.assert_allclose(stream.prediction[0], expected[0], rtol=1e-4, atol=1e-5)
+        for t in range(N_TIMESTEPS - 1):
+            prediction, errors = stream.predict(X[0, t])
+            np.testing.assert_allclose(prediction, expected[t + 1], rtol=1e-4, atol=1e-5)
+            self.assertEqual(errors.shape, (stream.prednet.nb_layers,))
+        self.assertEqual(stream.stats()['frames'], N_TIMESTEPS - 1)
+
+    def test_reset_streams(self):
+        stream = PredNetStream(self.model.layers[1], batch_size=2)
+        X = self.random_state.rand(2, 16, 24, 3).astype(np.float32)
+        stream.predict(X)
+        stream.reset([1])
+        self.assertFalse(np.allclose(stream.prediction[0], stream.initial_prediction[0]))
+        np.testing.assert_array_equal(stream.prediction[1], stream.initial_prediction[0])
+        for l in range(stream.prednet.nb_layers):
+            np.testing.assert_array_equal(stream.r[l][1], stream.initial_r[l][0])
+
+
+if __name__ == '__main__':
+    unittest.main()
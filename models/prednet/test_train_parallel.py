@@ -0,0 +1,64 @@
+'''
+Tests of the shared memory all-reduce of train_parallel.py, in worker processes.
+
+> python -m pytest test_train_parallel.py
+'''
+import unittest
+import multiprocessing
+import numpy as np
+
+from train_parallel import SharedMemoryAllReduce
+
+
+def worker_vector(worker, size, iteration):
+    return np.random.RandomState(1000 * iteration + worker).randn(size).astype(np.float32)
+
+def run_worker(worker, n_workers, all_reduce, size, n_iterations, errors):
+    try:
+        for iteration in range(n_iterations):
+            x = worker_vector(worker, size, iteration)
+            expected = np.mean([worker_vector(k, size, iteration) for k in range(n_workers)], axis=0)
+            np.testing.assert_allclose(all_reduce.average(worker, x), expected, rtol=1e-5, atol=1e-6)
+            received = all_reduce.broadcast(worker, x, root=iteration % n_workers)
+            np.testing.assert_array_equal(received, worker_vector(iteration % n_workers, size, iteration))
+    except Exception as e:
+        errors.put('worker {}: {}'.format(worker, e))
+        raise
+
+
+class SharedMemoryAllReduceTest(unittest.TestCase):
+
+    def check(self, n_workers, size, chunk_size, n_iterations=20):
+        all_reduce = SharedMemoryAllReduce(n_workers, chunk_size=chunk_size)
+        errors = multiprocessing.Queue()
+        processes = [multiprocessing.Process(target=run_worker,
+                                             args=(k, n_workers, all_reduce, size,
+                                                   n_iterations, errors))
+                     for k in range(n_workers)]
+        for p in processes:
+            p.start()
+        for p in processes:
+            p.join(60)
+        alive = [p for p in processes if p.is_alive()]
+        for p in alive:
+            p.terminate()
+        self.assertFalse(alive, 'workers blocked on the barrier')
+        self.assertTrue(errors.empty(), errors.get() if not errors.empty() else '')
+        self.assertEqual([p.exitcode for p in processes], [0] * n_workers)
+
+    def test_single_chunk(self):
+        self.check(3, 1000, chunk_size=2**12)
+
+    def test_several_chunks(self):
+        # pieces smaller than the vector, parts not divisible by the workers
+        self.check(4, 1001, chunk_size=97)
+
+    def test_more_workers_than_values(self):
+        self.check(4, 2, chunk_size=16)
+
+    def test_single_worker(self):
+        self.check(1, 100, chunk_size=16)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,14 +4,15 @@ Adapted from https://github.com/coxlab/prednet/blob/master/kitti_train.py
 '''
 import os
 import numpy as np
-import tensorflow as tf
 import random as rn
+from six.moves import cPickle as pkl
 
 from keras import backend as K
 from keras.models import Model
 from keras.callbacks import Callback, LearningRateScheduler, ModelCheckpoint
 from keras.callbacks import CSVLogger, EarlyStopping, LambdaCallback
 from keras.utils.training_utils import multi_gpu_model
+from keras.utils import Sequence
 from keras.optimizers import Adam
 
 # Getting reproducible results:
@@ -19,16 +20,13 @@ from keras.optimizers import Adam
 os.environ['PYTHONHASHSEED'] = '0'
 np.random.seed(42)
 rn.seed(12345)
-# Force TensorFlow to use single thread.
-# Multiple threads are a potential source of
-# non-reproducible results.
+# The TensorFlow session (seed and threads) is set up in __main__, see session_config.py.
+# Multiple threads are a potential source of non-reproducible results, training uses 
+# a single thread by default.
 # For further details, see: https://stackoverflow.com/questions/42022950/which-seeds-have-to-be-set-where-to-realize-100-reproducibility-of-training-res
-session_conf = tf.ConfigProto(intra_op_parallelism_threads=1, inter_op_parallelism_threads=1)
-tf.set_random_seed(1234)
-sess = tf.Session(graph=tf.get_default_graph(), config=session_conf)
-K.set_session(sess)
 
 import utils
+import session_config
 import prednet_model
 import argparse
 import sys
@@ -40,6 +38,142 @@ class StateResetter(Callback):
     def on_batch_end(self, batch, logs={}):
         self.model.reset_states()
         
+class SlotStateResetter(Callback):
+    '''
+    Truncated BPTT: states are carried between the consecutive windows of the 
+    videos in each batch slot and only reset when a slot moves to a new video.
+    The validation loss is computed here with the same state carry, as Keras 
+    does not call callbacks on validation batches. Must come before the callbacks
+    that use val_loss.
+    '''
+    def __init__(self, prednet, train_generator, val_generator=None):
+        super(SlotStateResetter, self).__init__()
+        self.prednet = prednet
+        self.train_generator = train_generator
+        self.val_generator = val_generator
+        # first batch when an interrupted epoch is resumed
+        self.batch_offset = 0
+        
+    def on_epoch_begin(self, epoch, logs={}):
+        # the schedule of the epoch does not depend on when the generator is shuffled
+        _, self.slot_resets = self.train_generator.slot_schedule(epoch)
+        
+    def on_batch_begin(self, batch, logs={}):
+        self.prednet.reset_samples(self.slot_resets[self.batch_offset + batch])
+        
+    def on_epoch_end(self, epoch, logs={}):
+        if self.val_generator is None:
+            return
+        losses = []
+        for i in range(len(self.val_generator)):
+            self.prednet.reset_samples(self.val_generator.slot_resets[i])
+            X, y = self.val_generator[i]
+            losses.append(self.model.test_on_batch(X, y))
+        logs['val_loss'] = np.mean(losses)
+        
+class TrainingCheckpoint(Callback):
+    '''
+    Full training checkpoint, saved every `period` batches and at the end of 
+    each epoch, from which an interrupted training continues at the same batch 
+    (see train, resume). It holds the weights, the optimizer state, the next 
+    epoch and batch, the numpy and python RNG states, the DataGenerator 
+    permutation of the epoch, the PredNet states when they are carried between 
+    batches and the state of the `callbacks` (best val_loss, early stopping wait). 
+    Must come after these callbacks.
+    '''
+    def __init__(self, filepath, train_generator, period=None, prednet=None, 
+                 callback_states=None):
+        super(TrainingCheckpoint, self).__init__()
+        self.filepath = filepath
+        self.train_generator = train_generator
+        self.period = period
+        self.prednet = prednet
+        self.callbacks = []
+        self.callback_states = callback_states
+        # first batch when an interrupted epoch is resumed
+        self.batch_offset = 0
+        
+    def on_train_begin(self, logs={}):
+        # EarlyStopping resets its state when training begins
+        if self.callback_states is not None:
+            set_callback_states(self.callbacks, self.callback_states)
+        
+    def on_epoch_begin(self, epoch, logs={}):
+        self.epoch = epoch
+        
+    def on_batch_end(self, batch, logs={}):
+        batch += self.batch_offset + 1
+        # the generator moves to the next permutation after the last batch
+        if self.period and batch % self.period == 0 and batch < len(self.train_generator):
+            self.save(self.epoch, batch, self.train_generator.indexes)
+        
+    def on_epoch_end(self, epoch, logs={}):
+        self.batch_offset = 0
+        self.save(epoch + 1, 0)
+        
+    def save(self, epoch, batch, indexes=None):
+        self.callback_states = get_callback_states(self.callbacks)
+        state = {'epoch': epoch, 
+                 'batch': batch,
+                 'indexes': indexes,
+                 'weights': self.model.get_weights(),
+                 'optimizer_weights': self.model.optimizer.get_weights(),
+                 'numpy_rng': np.random.get_state(),
+                 'python_rng': rn.getstate(),
+                 'prednet_states': K.batch_get_value(self.prednet.states) if self.prednet else None,
+                 'callbacks': self.callback_states}
+        save_training_state(self.filepath, state)
+        
+class BatchOffset(Sequence):
+    '''The batches of a sequence from `offset` on, to finish an interrupted epoch.
+    The permutation of the next epoch is set by train, not by the enqueuer.'''
+    def __init__(self, sequence, offset):
+        self.sequence = sequence
+        self.offset = offset
+        
+    def __len__(self):
+        return len(self.sequence) - self.offset
+    
+    def __getitem__(self, index):
+        return self.sequence[self.offset + index]
+    
+    def on_epoch_end(self):
+        pass
+        
+# attributes of ModelCheckpoint and EarlyStopping saved in training checkpoints
+CALLBACK_STATE = ['best', 'wait']
+
+def get_callback_states(callbacks):
+    return [{k: getattr(c, k) for k in CALLBACK_STATE if hasattr(c, k)} for c in callbacks]
+
+def set_callback_states(callbacks, states):
+    for callback, state in zip(callbacks, states):
+        for k, v in state.items():
+            setattr(callback, k, v)
+
+def save_training_state(filepath, state):
+    # through a temporary file, so that an interruption never leaves a partial checkpoint
+    tmp_filepath = filepath + '.tmp'
+    with open(tmp_filepath, 'wb') as f:
+        pkl.dump(state, f, protocol=pkl.HIGHEST_PROTOCOL)
+    os.rename(tmp_filepath, filepath)
+
+def load_training_state(filepath):
+    if not os.path.exists(filepath):
+        return None
+    with open(filepath, 'rb') as f:
+        return pkl.load(f)
+
+def restore_training_state(model, state, prednet=None):
+    model.set_weights(state['weights'])
+    # the optimizer weights (Adam iterations and moments) are created with the train function
+    model._make_train_function()
+    model.optimizer.set_weights(state['optimizer_weights'])
+    np.random.set_state(state['numpy_rng'])
+    rn.setstate(state['python_rng'])
+    if prednet is not None and state['prednet_states'] is not None:
+        K.batch_set_value(list(zip(prednet.states, state['prednet_states'])))
+
 class CustomModelCheckpoint(ModelCheckpoint):
     '''
     Trick to use multi_gpu_model. We save the original model instead.
@@ -53,10 +187,15 @@ class CustomModelCheckpoint(ModelCheckpoint):
         self.model = self.model_to_save
         super(CustomModelCheckpoint, self).on_epoch_end(epoch, logs)
 
-def get_callbacks(model, results_dir, stopping_patience=None, stateful=False):
+def lr_schedule(epoch):
     # start with lr of 0.001 and then drop to 0.0001 after 75 epochs
-    lr_schedule = lambda epoch: 0.001 if epoch < 75 else 0.0001    
+    return 0.001 if epoch < 75 else 0.0001
+
+def get_callbacks(model, results_dir, stopping_patience=None, stateful=False, 
+                  state_resetter=None, training_checkpoint=None, append_log=False):
     callbacks = [LearningRateScheduler(lr_schedule)]
+    if state_resetter:
+        callbacks.append(state_resetter)
     
     checkpoint_path = os.path.join(results_dir, 'weights.hdf5')
     csv_path = os.path.join(results_dir, 'train.log')
@@ -65,7 +204,7 @@ def get_callbacks(model, results_dir, stopping_patience=None, stateful=False):
                                          model_to_save=model,
                                          verbose=1, save_best_only=True)
     
-    csv_logger = CSVLogger(csv_path)
+    csv_logger = CSVLogger(csv_path, append=append_log)
     callbacks.append(checkpointer)
     callbacks.append(csv_logger)
     if stopping_patience:
@@ -74,10 +213,51 @@ def get_callbacks(model, results_dir, stopping_patience=None, stateful=False):
                                 verbose=0, mode='auto')
         callbacks.append(stopper)
     
-    if stateful:
+    if stateful and not state_resetter:
         callbacks.append(StateResetter())
+    if training_checkpoint:
+        # after the callbacks whose state it saves
+        training_checkpoint.callbacks = [c for c in callbacks if isinstance(c, (ModelCheckpoint, EarlyStopping))]
+        callbacks.append(training_checkpoint)
     return callbacks
     
+def create_generator(data_dir, classes, n_timesteps, seq_overlap, frame_step, 
+                     rescale, input_height, input_width, batch_size, data_format, 
+                     shuffle=False, index_start=0, max_per_class=None, 
+                     consecutive_windows=False, shard=None, seed=None, 
+                     frame_cache_dir=None, sequence_index_dir=None, 
+                     decode_threads=None, batch_buffers=None, max_queue_size=0, 
+                     workers=0):
+    if batch_buffers and batch_buffers < max_queue_size + workers + 2:
+        # a batch still queued by Keras would be overwritten in the ring
+        raise ValueError('batch_buffers={} is less than max_queue_size + workers + 2 = {}'.format(
+            batch_buffers, max_queue_size + workers + 2))
+    resize = lambda img: utils.resize_img(img, target_size=(input_height, 
+                                                            input_width))
+    generator = DataGenerator(classes=classes,
+                              seq_length=n_timesteps,
+                              min_seq_length=n_timesteps,
+                              seq_overlap=seq_overlap,
+                              sample_step=frame_step,
+                              target_size=None,
+                              rescale=rescale,
+                              fn_preprocess=resize,
+                              batch_size=batch_size, 
+                              shuffle=shuffle,
+                              data_format=data_format,
+                              output_mode='error',
+                              index_start=index_start,
+                              max_per_class=max_per_class,
+                              consecutive_windows=consecutive_windows,
+                              shard=shard,
+                              seed=seed,
+                              frame_cache_dir=frame_cache_dir,
+                              frame_cache_config='resize_{}x{}'.format(input_height, input_width),
+                              sequence_index_dir=sequence_index_dir,
+                              decode_threads=decode_threads,
+                              batch_buffers=batch_buffers)
+    return generator.flow_from_directory(data_dir)
+    
 def train(config_name, training_data_dir, validation_data_dir, 
           base_results_dir, test_data_dir=None, epochs=150, 
           use_multiprocessing=False, workers=1, shuffle=True,
@@ -88,16 +268,25 @@ def train(config_name, training_data_dir, validation_data_dir,
           frame_step=1, stateful=False, rescale=None, gpus=None,
           validation_index_start=0, validation_max_per_class=None, 
           data_format=K.image_data_format(), 
-          seq_overlap=0, **config):
+          seq_overlap=0, carry_states=False, checkpoint_every=None, 
+          resume=False, data_seed=42, frame_cache_dir=None, 
+          sequence_index_dir=None, decode_threads=None, **config):
+    
+    if carry_states:
+        # truncated BPTT over consecutive windows of the same videos
+        stateful = True
+        seq_overlap = 0
+        if gpus:
+            raise ValueError('carry_states is not supported with multiple gpus')
     
-    model = prednet_model.create_model(train=True, stateful=stateful,
+    model = prednet_model.create_model(train=True, stateful=stateful, 
+                                       carry_states=carry_states,
                                        input_channels=input_channels, 
                                        input_width=input_width, 
                                        batch_size=batch_size,
                                        input_height=input_height, **config)
     
     results_dir = utils.get_create_results_dir(config_name, base_results_dir)
-    callbacks = get_callbacks(model, results_dir, stopping_patience, stateful)
     
     json_file = os.path.join(results_dir, 'model.json')
     json_string = model.to_json()
@@ -113,67 +302,134 @@ def train(config_name, training_data_dir, validation_data_dir,
     layer_config = model.layers[1].get_config()
     data_format = layer_config['data_format'] if 'data_format' in layer_config else data_format #layer_config['dim_ordering']
     
-    resize = lambda img: utils.resize_img(img, target_size=(input_height, 
-                                                            input_width))
-    
-    train_generator = DataGenerator(classes=classes,
-                                    seq_length=n_timesteps,
-                                    min_seq_length=n_timesteps,
-                                    seq_overlap=seq_overlap,
-                                    sample_step=frame_step,
-                                    target_size=None,
-                                    rescale=rescale,
-                                    fn_preprocess=resize,
-                                    batch_size=batch_size, 
-                                    shuffle=shuffle,
-                                    data_format=data_format,
-                                    output_mode='error',
-                                    index_start=training_index_start,
-                                    max_per_class=training_max_per_class)
-    
-    val_generator = DataGenerator(classes=classes,
-                                  seq_length=n_timesteps,
-                                  min_seq_length=n_timesteps,
-                                  seq_overlap=seq_overlap,
-                                  sample_step=frame_step,
-                                  target_size=None,
-                                  rescale=rescale,
-                                  fn_preprocess=resize,
-                                  batch_size=batch_size,
-                                  data_format=data_format,
-                                  output_mode='error', 
-                                  index_start=validation_index_start,
-                                  max_per_class=validation_max_per_class)
-    
-    train_generator = train_generator.flow_from_directory(training_data_dir)
-    val_generator = val_generator.flow_from_directory(validation_data_dir)
+    train_generator = create_generator(training_data_dir, classes, n_timesteps, 
+                                       seq_overlap, frame_step, rescale, 
+                                       input_height, input_width, batch_size, 
+                                       data_format, shuffle=shuffle, 
+                                       index_start=training_index_start, 
+                                       max_per_class=training_max_per_class, 
+                                       consecutive_windows=carry_states, 
+                                       seed=data_seed, 
+                                       frame_cache_dir=frame_cache_dir, 
+                                       sequence_index_dir=sequence_index_dir, 
+                                       decode_threads=decode_threads, 
+                                       batch_buffers=max_queue_size + workers + 2, 
+                                       max_queue_size=max_queue_size, workers=workers)
+    val_generator = create_generator(validation_data_dir, classes, n_timesteps, 
+                                     seq_overlap, frame_step, rescale, 
+                                     input_height, input_width, batch_size, 
+                                     data_format, 
+                                     index_start=validation_index_start, 
+                                     max_per_class=validation_max_per_class, 
+                                     consecutive_windows=carry_states, 
+                                     frame_cache_dir=frame_cache_dir, 
+                                     sequence_index_dir=sequence_index_dir, 
+                                     decode_threads=decode_threads, 
+                                     batch_buffers=max_queue_size + workers + 2, 
+                                     max_queue_size=max_queue_size, workers=workers)
     
     if len(train_generator) == 0 or len(val_generator) == 0:
         return
     
-    history = model.fit_generator(train_generator, 
-                                  len(train_generator), 
-                                  epochs, callbacks=callbacks, 
-                                  validation_data=val_generator, 
-                                  validation_steps=len(val_generator), 
-                                  use_multiprocessing=use_multiprocessing,
-                                  max_queue_size=max_queue_size, 
-                                  workers=workers)
+    state = None
+    training_file = os.path.join(results_dir, 'training_checkpoint.pkl')
+    if resume:
+        state = load_training_state(training_file)
+        if state is None:
+            print('==> No training checkpoint in {}, starting from scratch'.format(results_dir))
+    
+    initial_epoch, initial_batch = 0, 0
+    if state:
+        restore_training_state(model, state, model.layers[1] if carry_states else None)
+        initial_epoch, initial_batch = state['epoch'], state['batch']
+        if state['indexes'] is not None:
+            train_generator.epoch = initial_epoch
+            train_generator.indexes = state['indexes']
+        else:
+            train_generator.set_epoch(initial_epoch)
+        print('==> Resuming training at epoch {}, batch {}'.format(initial_epoch, initial_batch))
+    
+    state_resetter = None
+    if carry_states:
+        state_resetter = SlotStateResetter(model.layers[1], train_generator, val_generator)
+    training_checkpoint = TrainingCheckpoint(training_file, train_generator, checkpoint_every, 
+                                             prednet=model.layers[1] if carry_states else None,
+                                             callback_states=state['callbacks'] if state else None)
+    callbacks = get_callbacks(model, results_dir, stopping_patience, stateful, 
+                              state_resetter, training_checkpoint, 
+                              append_log=state is not None)
+    
+    # the batches follow the permutation of the generator (shuffled for each epoch), 
+    # so that a training checkpoint knows the next batch
+    fit_args = dict(callbacks=callbacks, 
+                    validation_data=None if carry_states else val_generator, 
+                    validation_steps=None if carry_states else len(val_generator), 
+                    use_multiprocessing=use_multiprocessing,
+                    max_queue_size=max_queue_size, 
+                    workers=workers, 
+                    shuffle=False)
+    if initial_batch > 0 and initial_epoch < epochs:
+        # finish the interrupted epoch
+        training_checkpoint.batch_offset = initial_batch
+        if state_resetter:
+            state_resetter.batch_offset = initial_batch
+        model.fit_generator(BatchOffset(train_generator, initial_batch), 
+                            len(train_generator) - initial_batch, 
+                            initial_epoch + 1, initial_epoch=initial_epoch, **fit_args)
+        if state_resetter:
+            state_resetter.batch_offset = 0
+        if model.stop_training:
+            return
+        initial_epoch += 1
+        train_generator.set_epoch(initial_epoch)
+    
+    if initial_epoch < epochs:
+        model.fit_generator(train_generator, 
+                            len(train_generator), 
+                            epochs, initial_epoch=initial_epoch, **fit_args)
     
         
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Train PredNet model.')
     parser.add_argument('config', help='experiment config name defined in moments_settings.py')
     parser.add_argument('--stateful', help='use stateful PredNet model', action='store_true')
+    parser.add_argument('--n_timesteps', type=int, help='length of the training sequences')
+    parser.add_argument('--checkpoint_timesteps', type=int, 
+                        help='gradient checkpointing: timesteps per segment whose activations are recomputed in the backward pass')
+    parser.add_argument('--carry_states', action='store_true', 
+                        help='truncated BPTT: carry the states between consecutive windows of the same videos')
+    parser.add_argument('--layer_loss_weights', choices=['L_0', 'L_all'], 
+                        help='weights of the layer errors in the loss')
     parser.add_argument('--task', help='use stateful PredNet model', choices=['3c', '10c', 'full'])
     parser.add_argument('--gpus', type=int, help='number of gpus')
+    parser.add_argument('--resume', action='store_true', 
+                        help='continue from the last training checkpoint of the experiment')
+    parser.add_argument('--checkpoint_every', type=int, 
+                        help='batches between training checkpoints (also saved after each epoch)')
+    parser.add_argument('--compute_dtype', help='dtype of PredNet states and activations (weights stay float32)', 
+                        choices=['float32', 'float16'])
+    session_config.add_arguments(parser, ['train'])
     FLAGS, unparsed = parser.parse_known_args()
     
     config_name, config = utils.get_config(vars(FLAGS))
+    session_config.update_config(config, vars(FLAGS))
+    if FLAGS.compute_dtype:
+        config['compute_dtype'] = FLAGS.compute_dtype
+    if FLAGS.carry_states:
+        config['carry_states'] = True
+    if FLAGS.n_timesteps:
+        config['n_timesteps'] = FLAGS.n_timesteps
+    if FLAGS.checkpoint_timesteps:
+        config['checkpoint_timesteps'] = FLAGS.checkpoint_timesteps
+    if FLAGS.layer_loss_weights:
+        config['layer_loss_weights'] = FLAGS.layer_loss_weights
+    if FLAGS.checkpoint_every:
+        config['checkpoint_every'] = FLAGS.checkpoint_every
     
     print('\n==> Starting experiment: {}\n'.format(config['description']))
     config_str = utils.get_config_str(config)
     print('==> Using configuration:\n{}'.format(config_str))
     
-    train(config_name, **config)
+    session_config.setup_session('train', config)
+    train(config_name, resume=FLAGS.resume, **config)
     utils.save_experiment_config(config_name, config['base_results_dir'], config)
\ No newline at end of file
@@ -0,0 +1,309 @@
+'''
+Data-parallel PredNet training on CPU with several worker processes.
+
+Each worker trains a replica of the model on its own shard of the training
+sequences (see the `shard` option of DataGenerator). After each batch the
+gradients of all workers are averaged by an all-reduce over shared memory and
+every worker applies the averaged gradients with its own Adam optimizer, so
+the replicas stay identical. The workers start from the weights of worker 0.
+
+Sums over the workers are always computed in worker order, so training is
+deterministic for a fixed number of workers. The effective batch size is
+n_workers * batch_size.
+
+TensorFlow is only imported by the workers, after they are forked.
+'''
+import os
+import csv
+import time
+import ctypes
+import argparse
+import multiprocessing
+import numpy as np
+
+import utils
+
+
+class SharedBarrier(object):
+    '''Reusable barrier of n_workers processes, created before they are forked
+    (multiprocessing.Barrier only exists in Python 3). The workers pass two
+    turnstiles, so a worker that returns from wait cannot overtake the others
+    on the next wait.'''
+    def __init__(self, n_workers):
+        self.n_workers = n_workers
+        self.count = multiprocessing.Value(ctypes.c_int, 0, lock=False)
+        self.lock = multiprocessing.Lock()
+        self.turnstiles = [multiprocessing.Semaphore(0), multiprocessing.Semaphore(0)]
+
+    def __phase(self, turnstile, last_count, step):
+        with self.lock:
+            self.count.value += step
+            if self.count.value == last_count:
+                for _ in range(self.n_workers):
+                    turnstile.release()
+        turnstile.acquire()
+
+    def wait(self):
+        self.__phase(self.turnstiles[0], self.n_workers, 1)
+        self.__phase(self.turnstiles[1], 0, -1)
+
+
+class SharedMemoryAllReduce(object):
+    '''Averages float32 vectors across n_workers processes. Created before the
+    workers are forked. Vectors are reduced in pieces of up to chunk_size values:
+    each worker sums its part of the piece over all the workers (reduce-scatter),
+    then all the workers read the whole averaged piece (all-gather).'''
+    def __init__(self, n_workers, chunk_size=2**22):
+        self.n_workers = n_workers
+        self.chunk_size = chunk_size
+        self.inputs = multiprocessing.RawArray(ctypes.c_float, n_workers * chunk_size)
+        self.result = multiprocessing.RawArray(ctypes.c_float, chunk_size)
+        self.barrier = SharedBarrier(n_workers)
+
+    def __buffers(self):
+        inputs = np.frombuffer(self.inputs, dtype=np.float32).reshape(self.n_workers, self.chunk_size)
+        result = np.frombuffer(self.result, dtype=np.float32)
+        return inputs, result
+
+    def average(self, worker, x):
+        inputs, result = self.__buffers()
+        x = np.asarray(x, dtype=np.float32)
+        averaged = np.empty_like(x)
+        for start in range(0, len(x), self.chunk_size):
+            size = min(self.chunk_size, len(x) - start)
+            inputs[worker, :size] = x[start:start + size]
+            self.barrier.wait()
+            # part of the piece reduced by this worker
+            part = -(-size // self.n_workers)
+            begin, end = worker * part, min((worker + 1) * part, size)
+            if begin < end:
+                result[begin:end] = inputs[0, begin:end]
+                for k in range(1, self.n_workers):
+                    result[begin:end] += inputs[k, begin:end]
+                result[begin:end] /= self.n_workers
+            self.barrier.wait()
+            averaged[start:start + size] = result[:size]
+        return averaged
+
+    def broadcast(self, worker, x, root=0):
+        inputs, _ = self.__buffers()
+        x = np.asarray(x, dtype=np.float32)
+        received = np.empty_like(x)
+        for start in range(0, len(x), self.chunk_size):
+            size = min(self.chunk_size, len(x) - start)
+            # through the inputs of the root, the workers may still be reading the result of an average
+            if worker == root:
+                inputs[root, :size] = x[start:start + size]
+            self.barrier.wait()
+            received[start:start + size] = inputs[root, :size]
+            self.barrier.wait()
+        return received
+
+
+def flatten(arrays):
+    return np.concatenate([np.ravel(a) for a in arrays])
+
+def unflatten(x, shapes):
+    arrays = []
+    start = 0
+    for shape in shapes:
+        size = int(np.prod(shape))
+        arrays.append(x[start:start + size].reshape(shape))
+        start += size
+    return arrays
+
+
+class ReplicaTrainer(object):
+    '''Keras functions of one worker: the loss and gradients of a batch,
+    and the Adam update from the averaged gradients.'''
+    def __init__(self, model):
+        from keras import backend as K
+        from keras import losses
+        from keras.optimizers import Adam
+
+        self.model = model
+        self.params = model.trainable_weights
+        self.shapes = [K.int_shape(p) for p in self.params]
+        targets = K.placeholder(ndim=2)
+        loss = K.mean(losses.mean_absolute_error(targets, model.output))
+        self.gradients = K.function(model.inputs + [targets],
+                                    [loss] + K.gradients(loss, self.params))
+
+        self.optimizer = Adam()
+        grad_inputs = [K.placeholder(shape=shape) for shape in self.shapes]
+        # the optimizer applies the averaged gradients instead of those of the loss
+        self.optimizer.get_gradients = lambda loss, params: grad_inputs
+        updates = self.optimizer.get_updates(loss, self.params)
+        self.apply_gradients = K.function(grad_inputs, [], updates=updates)
+        self.loss = K.function(model.inputs + [targets], [loss])
+
+    def set_lr(self, lr):
+        from keras import backend as K
+        K.set_value(self.optimizer.lr, lr)
+
+    def compute_gradients(self, X, y):
+        outputs = self.gradients([X, np.reshape(y, (len(y), 1))])
+        return outputs[0], flatten(outputs[1:])
+
+    def update(self, gradients):
+        self.apply_gradients(unflatten(gradients, self.shapes))
+
+    def test_on_batch(self, X, y):
+        return self.loss([X, np.reshape(y, (len(y), 1))])[0]
+
+
+def train_worker(worker, n_workers, all_reduce, threads_per_worker,
+                 config_name, training_data_dir, validation_data_dir,
+                 base_results_dir, epochs=150, shuffle=True, n_timesteps=10,
+                 batch_size=4, stopping_patience=None, input_channels=3,
+                 input_width=160, input_height=128, classes=None,
+                 training_index_start=0, training_max_per_class=None,
+                 frame_step=1, rescale=None, validation_index_start=0,
+                 validation_max_per_class=None, seq_overlap=0,
+                 steps_per_epoch=None, frame_cache_dir=None,
+                 sequence_index_dir=None, decode_threads=None, **config):
+    # importing train sets the seeds of train.py
+    import train
+    import prednet_model
+    import session_config
+
+    session_config.setup_session('train', {'train_threads': (threads_per_worker, 1)})
+
+    model = prednet_model.create_model(train=True, input_channels=input_channels,
+                                       input_width=input_width,
+                                       input_height=input_height,
+                                       batch_size=batch_size,
+                                       n_timesteps=n_timesteps, **config)
+    trainer = ReplicaTrainer(model)
+    weights = model.get_weights()
+    weights = all_reduce.broadcast(worker, flatten(weights))
+    model.set_weights(unflatten(weights, [w.shape for w in model.get_weights()]))
+
+    data_format = model.layers[1].data_format
+    if worker != 0:
+        # the sequence index is built by worker 0 only
+        all_reduce.barrier.wait()
+    train_generator = train.create_generator(training_data_dir, classes, n_timesteps,
+                                             seq_overlap, frame_step, rescale,
+                                             input_height, input_width, batch_size,
+                                             data_format, shuffle=shuffle,
+                                             index_start=training_index_start,
+                                             max_per_class=training_max_per_class,
+                                             shard=(worker, n_workers),
+                                             frame_cache_dir=frame_cache_dir,
+                                             sequence_index_dir=sequence_index_dir,
+                                             decode_threads=decode_threads,
+                                             batch_buffers=2)
+    val_generator = train.create_generator(validation_data_dir, classes, n_timesteps,
+                                           seq_overlap, frame_step, rescale,
+                                           input_height, input_width, batch_size,
+                                           data_format,
+                                           index_start=validation_index_start,
+                                           max_per_class=validation_max_per_class,
+                                           shard=(worker, n_workers),
+                                           frame_cache_dir=frame_cache_dir,
+                                           sequence_index_dir=sequence_index_dir,
+                                           decode_threads=decode_threads,
+                                           batch_buffers=2)
+    if worker == 0:
+        all_reduce.barrier.wait()
+    # all the shards have the same number of batches
+    n_batches = len(train_generator)
+    if steps_per_epoch:
+        n_batches = min(n_batches, steps_per_epoch)
+    if n_batches == 0 or len(val_generator) == 0:
+        return
+
+    results_dir = utils.get_create_results_dir(config_name, base_results_dir)
+    if worker == 0:
+        with open(os.path.join(results_dir, 'model.json'), 'w') as f:
+            f.write(model.to_json())
+        log_file = open(os.path.join(results_dir, 'train.log'), 'w')
+        log = csv.writer(log_file)
+        log.writerow(['epoch', 'loss', 'val_loss', 'sequences_per_second'])
+
+    best_val_loss = np.inf
+    wait = 0
+    for epoch in range(epochs):
+        trainer.set_lr(train.lr_schedule(epoch))
+        losses = []
+        start = time.time()
+        for i in range(n_batches):
+            X, y = train_generator[i]
+            loss, gradients = trainer.compute_gradients(X, y)
+            # the loss is averaged along with the gradients
+            averaged = all_reduce.average(worker, np.append(gradients, loss))
+            trainer.update(averaged[:-1])
+            losses.append(averaged[-1])
+        sequences_per_second = n_workers * batch_size * n_batches / (time.time() - start)
+        train_generator.on_epoch_end()
+
+        val_losses = [trainer.test_on_batch(*val_generator[i]) for i in range(len(val_generator))]
+        val_loss = all_reduce.average(worker, [np.mean(val_losses)])[0]
+
+        if worker == 0:
+            print('Epoch {}/{} - loss: {:.4f} - val_loss: {:.4f} - {:.1f} sequences/s'.format(
+                epoch + 1, epochs, np.mean(losses), val_loss, sequences_per_second))
+            log.writerow([epoch, np.mean(losses), val_loss, sequences_per_second])
+            log_file.flush()
+            if val_loss < best_val_loss:
+                model.save_weights(os.path.join(results_dir, 'weights.hdf5'))
+        # every worker has the same val_loss, so they all stop at the same epoch
+        if val_loss < best_val_loss:
+            best_val_loss = val_loss
+            wait = 0
+        else:
+            wait += 1
+            if stopping_patience and wait >= stopping_patience:
+                break
+    if worker == 0:
+        log_file.close()
+
+def train(config_name, n_workers, threads_per_worker=1, **config):
+    if config.get('carry_states', False) or config.get('stateful', False):
+        raise ValueError('Stateful models are not supported by the data-parallel trainer')
+    all_reduce = SharedMemoryAllReduce(n_workers)
+    processes = [multiprocessing.Process(target=train_worker,
+                                         args=(k, n_workers, all_reduce,
+                                               threads_per_worker, config_name),
+                                         kwargs=config)
+                 for k in range(n_workers)]
+    for p in processes:
+        p.start()
+    # a failed worker would leave the others waiting for its gradients
+    while any(p.is_alive() for p in processes):
+        if any(p.exitcode not in (None, 0) for p in processes):
+            for p in processes:
+                p.terminate()
+            raise RuntimeError('A training worker failed')
+        time.sleep(1)
+    if any(p.exitcode != 0 for p in processes):
+        raise RuntimeError('A training worker failed')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Train PredNet with data-parallel worker processes.')
+    parser.add_argument('config', help='experiment config name defined in settings.py')
+    parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count(),
+                        help='number of worker processes')
+    parser.add_argument('--threads_per_worker', type=int, default=1,
+                        help='TensorFlow intra-op threads of each worker')
+    parser.add_argument('--steps_per_epoch', type=int,
+                        help='limit the number of batches of each epoch, ex. to measure throughput')
+    parser.add_argument('--n_timesteps', type=int, help='length of the training sequences')
+    parser.add_argument('--task', help='use stateful PredNet model', choices=['3c', '10c', 'full'])
+    FLAGS, unparsed = parser.parse_known_args()
+
+    config_name, config = utils.get_config(vars(FLAGS))
+    if FLAGS.n_timesteps:
+        config['n_timesteps'] = FLAGS.n_timesteps
+    if FLAGS.steps_per_epoch:
+        config['steps_per_epoch'] = FLAGS.steps_per_epoch
+
+    print('\n==> Starting experiment: {}\n'.format(config['description']))
+    config_str = utils.get_config_str(config)
+    print('==> Using configuration:\n{}'.format(config_str))
+    print('==> {} workers, {} threads each'.format(FLAGS.workers, FLAGS.threads_per_worker))
+
+    train(config_name, FLAGS.workers, FLAGS.threads_per_worker, **config)
+    utils.save_experiment_config(config_name, config['base_results_dir'], config)
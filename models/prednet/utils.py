@@ -74,8 +74,12 @@ def get_config(FLAGS):
         config['model_weights_file'] = config['model_weights_file'].format(model_suffix)
     if config['model_json_file']:
         config['model_json_file'] = config['model_json_file'].format(model_suffix)
+    if config.get('model_compact_file', None):
+        config['model_compact_file'] = config['model_compact_file'].format(model_suffix)
         
-    if config['output_mode'] in ['prediction', 'representation']:
+    output_mode = config['output_mode']
+    output_modes = output_mode if isinstance(output_mode, (list, tuple)) else [output_mode]
+    if all(mode in ['prediction', 'representation', 'pooled_representation'] for mode in output_modes):
         name = FLAGS['config'] + model_suffix
     else:
         name = FLAGS['config'] + task_suffix